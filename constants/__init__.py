@@ -55,9 +55,59 @@ WEIGHT_SKEW_FACTOR      = 1.2
 TOP_MINER_FRACTION      = 0.1
 
 MAX_SEQUENCE_LEN        = 4096
+# Attention implementation of models loaded for evaluation (in bfloat16)
+EVAL_ATTN_IMPLEMENTATION = "flash_attention_2"
+# Evaluate samples in length-bucketed batches of at most this many (padded) tokens; 0 to disable.
+# Batching changes the floating point summation of the losses, which all validators need to agree on,
+# so it is opt-in. Competitions can override this using 'eval_batch_tokens'.
+EVAL_BATCH_TOKENS       = 0
+# Evaluate samples packed into sequences of at most this many tokens (if supported by the model); 0 to disable.
+# Takes precedence over batching. Competitions can override this using 'eval_pack_tokens'.
+EVAL_PACK_TOKENS        = 0
+# Evaluate lm_head and loss in chunks of this many positions, to avoid materializing full-vocabulary logits; 0 to disable.
+# Like batching, this changes the floating point summation of the losses, so it is opt-in (samples that
+# run out of memory are still retried chunked). Competitions can override this using 'eval_logits_chunk_tokens'.
+EVAL_LOGITS_CHUNK_TOKENS = 0
+# Chunk size used when retrying samples that ran out of memory, if chunking was disabled.
+EVAL_OOM_LOGITS_CHUNK_TOKENS = 256
+# Fraction of the free GPU memory that sliced evaluation may use. Slices are planned using measured
+# parameter sizes and estimated activation memory for the samples at hand; models are only sliced if
+# they don't fit. Competitions can override this using 'eval_slice_memory_fraction'.
+EVAL_SLICE_MEMORY_FRACTION = 0.9
+# Copy the next slice of a sliced model to the GPU while evaluating the current one.
+# Two consecutive slices need to fit in GPU memory, so more (smaller) slices are used.
+# Competitions can override this using 'eval_stream_slices'.
+EVAL_STREAM_SLICES      = True
+# Where sliced evaluation keeps hidden states between slices: 'device', 'host' (pinned CPU memory)
+# or 'disk' (temporary file in EVAL_STATE_STORE_PATH, None for the default temporary directory).
+# Competitions can override these using 'eval_state_store' and 'eval_state_store_path'.
+EVAL_STATE_STORE        = 'device'
+EVAL_STATE_STORE_PATH   = None
+# Order of sliced evaluation: 'slice' (all samples through each slice in turn, holding the hidden
+# states of all samples), 'group' (groups of samples through all slices, reloading slices for each
+# group) or 'auto' (whichever moves fewer bytes, given the GPU memory left for hidden states).
+# Competitions can override this using 'eval_slice_schedule'.
+EVAL_SLICE_SCHEDULE     = 'slice'
+# Evaluate unsliced models with torch.compile (CUDA graphs on GPU), padding samples to power-of-two
+# length buckets. Compiled artifacts are cached in EVAL_COMPILE_CACHE_DIR per model geometry, so
+# models with the same geometry compile quickly after the first one.
+# Competitions can override this using 'eval_compile'.
+EVAL_COMPILE            = False
+EVAL_COMPILE_CACHE_DIR  = str(ROOT_DIR / 'compile_cache')
+# Evaluate models that are new to the pool in this many interleaved groups of samples, stopping
+# early once a model is unlikely to enter the pool; 0 or 1 to disable. This is a heuristic: skipped
+# samples get nan loss, so the stopped model no longer blocks older models on them, which changes
+# the wins of other models. Competitions can opt in using 'eval_early_stop_groups'.
+EVAL_EARLY_STOP_GROUPS  = 1
 MAX_TOKENIZE_FAILS      = 3
 TTL_RUN_STEP            = 7200
 TTL_MODEL_EVAL          = 600
+# Replace an evaluation worker process after this many evaluations (0 for no limit).
+# Note that replacing a worker drops the models it has cached.
+EVAL_WORKER_MAX_TASKS   = 0
+# Evaluate models whose checkpoint exceeds this fraction of the available RAM without loading
+# them: each slice loads its weights from disk when evaluated (sliced model types only).
+LAZY_LOAD_RAM_FRACTION  = 0.5
 
 # validator weight moving average term
 weight_alpha = 0.5
@@ -82,5 +132,7 @@ MODEL_UNFORCED_N_PER_LOOP   = 5
 WEIGHT_SET_MIN_INTERVAL     = 25*60
 LIMIT_MIN_FREE_GB           = 30
 DEFAULT_MIN_FREE_GB         = 120
+# Default size of the in-RAM cache of loaded models (0 to disable)
+DEFAULT_MODEL_CACHE_GB      = 0
 DOWNLOAD_MIN_FREE_MARGIN_GB = 5
 MAX_VALIDATOR_AGE_BLOCKS    = (3600//12 * 4)
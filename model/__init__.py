@@ -1 +1,16 @@
-from .model_utils import *
+import importlib.util
+
+
+def __getattr__(name):
+    # The names of model_utils are available from model, as before, but it is
+    # only imported when one is used: it pulls in the chain and Hugging Face
+    # clients, which evaluation workers don't need (see neurons/eval_worker.py).
+    # Submodules are left to the import system, so that e.g.
+    # "from model import competitions" doesn't import model_utils.
+    if name.startswith('_') or importlib.util.find_spec(f'{__name__}.{name}') is not None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from . import model_utils
+    try:
+        return getattr(model_utils, name)
+    except AttributeError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
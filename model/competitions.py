@@ -1,6 +1,7 @@
 import json
 import requests
-import bittensor as bt
+
+from utilities.logs import logger
 
 required_keys = {"reward", "dataset", "model_types", "model_size", "parameters"}
 
@@ -12,7 +13,7 @@ def validate_competitions(d):
     return competitions dictionary if valid, None otherwise.
     '''
     if type(d) is not dict:
-        bt.logging.warning("Competitions not a dict")
+        logger.warning("Competitions not a dict")
         return None
 
     defaults = d.get('default',{})
@@ -25,7 +26,7 @@ def validate_competitions(d):
             continue
 
         if type(cinfo) is not dict:
-            bt.logging.warning(f"Competition {cname} info not a dict")
+            logger.warning(f"Competition {cname} info not a dict")
             return None
 
         add_c = defaults.copy()
@@ -33,7 +34,7 @@ def validate_competitions(d):
 
         missing_keys = required_keys - set(add_c.keys())
         if len(missing_keys) > 0:
-            bt.logging.warning(f"Competition {cname} missing keys {missing_keys}")
+            logger.warning(f"Competition {cname} missing keys {missing_keys}")
             return None
 
         ret[cname] = add_c
@@ -53,11 +54,11 @@ def load_competitions(loc,warn_failure=True):
         else:
             with open(loc) as f:
                 d = json.load(f)
-        bt.logging.info(f"Fetched competitions content, containing {len(d)} entries")
+        logger.info(f"Fetched competitions content, containing {len(d)} entries")
 
     except Exception as e:
         if warn_failure:
-            bt.logging.warning(f"Failed to load competitions: {e}")
+            logger.warning(f"Failed to load competitions: {e}")
         return None
 
     return validate_competitions(d)
@@ -97,6 +98,7 @@ def model_get_valid_competitions(mdl, competitions):
     return ret
 
 if __name__ == "__main__":
+    import bittensor as bt
     bt.logging.on()
     bt.logging.set_debug(True)
     c = load_competitions("../../sn29/competitions.json")
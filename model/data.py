@@ -3,7 +3,7 @@ from enum import IntEnum
 from typing import Any, ClassVar, Dict, Optional, Type
 from transformers import PreTrainedModel
 from pydantic import BaseModel, Field, PositiveInt
-import bittensor as bt
+from utilities.logs import TRACE, logger
 
 # The maximum bytes for metadata on the chain.
 MAX_METADATA_BYTES = 128
@@ -101,7 +101,7 @@ class ModelMetadata(BaseModel):
             model_id = ModelId.from_compressed_str(chain_str)
         except:
             # If the metadata format is not correct on the chain then we return None.
-            bt.logging.trace(
+            logger.log(TRACE,
                 f"Failed to parse metadata {chain_str} / {hex_data} / {commitment}"
             )
             return None
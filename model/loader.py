@@ -0,0 +1,320 @@
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+import traceback
+from typing import Optional
+
+import torch
+from safetensors import safe_open
+from transformers import AutoConfig, AutoModelForCausalLM, PreTrainedModel
+
+from model.data import Model, ModelId
+from model.storage.disk import utils as disk_utils
+from utilities.logs import logger
+
+# Model classes that can be loaded by fast_load_model(); these are the vendored
+# versions, which are known to need no more than their safetensors weights.
+FAST_LOAD_MODEL_TYPES = {'SlicedLlamaForCausalLM', 'SlicedPhiForCausalLM', 'SlicedPhi3ForCausalLM'}
+
+
+def peak_rss() -> int:
+    """Return peak resident set size of this process, in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Set while the current thread creates a model with empty weights
+_empty_weights = threading.local()
+_register_parameter = torch.nn.Module.register_parameter
+
+
+def _register_parameter_maybe_empty(module, name, param):
+    _register_parameter(module, name, param)
+    if param is not None and getattr(_empty_weights, 'active', False):
+        param_cls = type(module._parameters[name])
+        module._parameters[name] = param_cls(module._parameters[name].to('meta'), requires_grad=param.requires_grad)
+
+
+@contextlib.contextmanager
+def init_empty_weights():
+    """
+    Context manager in which parameters of modules created by the calling
+    thread are put on the meta device, i.e. not allocated nor initialized.
+    Modules created concurrently by other threads (e.g. by the model
+    prefetcher) are not affected. Buffers (e.g. rotary inv_freq, which is not
+    stored in checkpoints) are created as usual, which is why this is not
+    simply torch.device('meta').
+    """
+    # Installed once and left in place, so there is nothing to restore that could race
+    torch.nn.Module.register_parameter = _register_parameter_maybe_empty
+    active = getattr(_empty_weights, 'active', False)
+    _empty_weights.active = True
+    try:
+        yield
+    finally:
+        _empty_weights.active = active
+
+
+def get_safetensors_files(path: str) -> list:
+    """Return list of safetensors files of the model at path."""
+    index_fn = os.path.join(path, 'model.safetensors.index.json')
+    if os.path.exists(index_fn):
+        with open(index_fn) as f:
+            weight_map = json.load(f)['weight_map']
+        return [os.path.join(path, fn) for fn in sorted(set(weight_map.values()))]
+    fn = os.path.join(path, 'model.safetensors')
+    if os.path.exists(fn):
+        return [fn]
+    raise FileNotFoundError(f"No safetensors files found in {path}")
+
+
+def _set_tensor(model: torch.nn.Module, name: str, tensor: torch.Tensor) -> bool:
+    """
+    Set parameter or persistent buffer name of model to tensor, converted to
+    the dtype the model has for it. Buffers that are not saved in the state
+    dict (e.g. rotary inv_freq) are computed by the model and never replaced.
+    """
+    module_name, _, tensor_name = name.rpartition('.')
+    try:
+        module = model.get_submodule(module_name)
+    except AttributeError:
+        return False
+    if tensor_name in module._parameters:
+        param = module._parameters[tensor_name]
+        if param.shape != tensor.shape:
+            raise ValueError(f"Shape mismatch for {name}: expected {tuple(param.shape)}, found {tuple(tensor.shape)}")
+        if tensor.is_floating_point() and tensor.dtype != param.dtype:
+            tensor = tensor.to(param.dtype)
+        module._parameters[tensor_name] = torch.nn.Parameter(tensor, requires_grad=param.requires_grad)
+        return True
+    if tensor_name in module._buffers and tensor_name not in module._non_persistent_buffers_set:
+        buffer = module._buffers[tensor_name]
+        if buffer is not None:
+            if buffer.shape != tensor.shape:
+                raise ValueError(f"Shape mismatch for {name}: expected {tuple(buffer.shape)}, found {tuple(tensor.shape)}")
+            tensor = tensor.to(buffer.dtype)
+        module._buffers[tensor_name] = tensor
+        return True
+    return False
+
+
+def _create_empty_model(
+    path: str, torch_dtype=torch.bfloat16, attn_implementation: Optional[str] = None
+) -> Optional[PreTrainedModel]:
+    """Create model for config at path with parameters on the meta device; None if not supported."""
+    config = AutoConfig.from_pretrained(path, local_files_only=True)
+    model_class = AutoModelForCausalLM._model_mapping.get(type(config), None)
+    if model_class is None or model_class.__name__ not in FAST_LOAD_MODEL_TYPES:
+        return None
+
+    kwargs = dict(torch_dtype=torch_dtype)
+    if attn_implementation is not None:
+        kwargs['attn_implementation'] = attn_implementation
+    with init_empty_weights():
+        return model_class._from_config(config, **kwargs)
+
+
+def fast_load_model(
+    path: str, torch_dtype=torch.bfloat16, attn_implementation: Optional[str] = None, device: str = 'cpu'
+) -> Optional[PreTrainedModel]:
+    """
+    Load a model by creating it on the meta device (no allocation or random
+    initialization of weights) and copying the tensors from the memory mapped
+    safetensors files straight into their final dtype and device, one at a time.
+    There is no intermediate copy of the full model in CPU RAM.
+
+    Returns None if the model type is not supported, raises on failure.
+    """
+    model = _create_empty_model(path, torch_dtype, attn_implementation)
+    if model is None:
+        return None
+
+    # Only what from_pretrained() would load: parameters and persistent buffers
+    expected = set(model.state_dict().keys())
+    n_loaded = 0
+    for fn in get_safetensors_files(path):
+        with safe_open(fn, framework='pt', device=str(device)) as f:
+            for name in f.keys():
+                tensor = f.get_tensor(name)
+                if name in expected and _set_tensor(model, name, tensor):
+                    n_loaded += 1
+                else:
+                    logger.debug(f"Ignoring unexpected tensor {name} in {fn}")
+                del tensor
+    logger.debug(f"Loaded {n_loaded} tensors from {path}")
+
+    model.tie_weights()
+    missing = [name for name, p in model.named_parameters() if p.device.type == 'meta']
+    if len(missing):
+        raise ValueError(f"Missing weights in checkpoint: {missing[:5]}{'...' if len(missing)>5 else ''}")
+    # Buffers that are not in the checkpoint were created on the CPU
+    model.to(device)
+    model.eval()
+    return model
+
+
+def lazy_load_model(
+    path: str, torch_dtype=torch.bfloat16, attn_implementation: Optional[str] = None
+) -> Optional[PreTrainedModel]:
+    """
+    Create a model with all parameters on the meta device, to be evaluated
+    sliced: each slice loads its own tensors from the safetensors files at
+    path when it is evaluated, and releases them afterwards. This allows
+    evaluation of models that don't fit in CPU RAM.
+
+    Returns None if the model type is not supported.
+    """
+    model = _create_empty_model(path, torch_dtype, attn_implementation)
+    if model is None:
+        return None
+    # Check that the weights are available
+    get_safetensors_files(path)
+    model.lazy_weights_path = path
+    model.eval()
+    return model
+
+
+def get_checkpoint_bytes(path: str) -> int:
+    """Return total size of the safetensors files of the model at path."""
+    return sum(os.path.getsize(fn) for fn in get_safetensors_files(path))
+
+
+def available_ram() -> int:
+    """Return an estimate of the available RAM in bytes."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def needs_lazy_load(path: str, ram_fraction: float) -> bool:
+    """Check whether the checkpoint at path is larger than ram_fraction of the available RAM."""
+    try:
+        return get_checkpoint_bytes(path) > ram_fraction * available_ram()
+    except FileNotFoundError:
+        return False
+
+
+def readahead_model(path: str):
+    """Ask the kernel to read model files at path into the page cache, asynchronously."""
+    if not hasattr(os, 'posix_fadvise') or not os.path.isdir(path):
+        return
+    for fn in os.listdir(path):
+        fn = os.path.join(path, fn)
+        if not os.path.isfile(fn):
+            continue
+        try:
+            fd = os.open(fn, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.debug(f"readahead of {fn} failed: {e}")
+
+
+def pin_model_memory(model: torch.nn.Module):
+    """Move CPU parameters of model to pinned memory, for faster (async) transfer to the GPU."""
+    if not torch.cuda.is_available():
+        return
+    try:
+        for p in model.parameters():
+            if p.device.type == 'cpu' and not p.data.is_pinned():
+                p.data = p.data.pin_memory()
+    except Exception as e:
+        logger.warning(f"Failed to pin model memory: {e}")
+
+
+class _PrefetchJob:
+    """A background load of one model; its result is dropped once the job is cancelled."""
+    def __init__(self, key):
+        self.key = key
+        self.thread = None
+        self.model = None
+        self.cancelled = False
+
+
+class ModelPrefetcher:
+    """
+    Loads a single model in a background thread, while the current model is
+    being evaluated, so that disk I/O and deserialization overlap with compute.
+    The staged model is picked up by take() or dropped by the next prefetch().
+    A load that is no longer wanted is not waited for: it runs to completion
+    in the background and its result is dropped.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.job = None
+
+    def _load(self, job: _PrefetchJob, local_store, hotkey: str, model_id: ModelId, path: Optional[str], pin_memory: bool):
+        t0 = time.time()
+        try:
+            model = local_store.retrieve_model(hotkey, model_id, path=path)
+            if pin_memory and not job.cancelled:
+                pin_model_memory(model.pt_model)
+            with self.lock:
+                if job.cancelled:
+                    logger.debug(f"Dropped stale prefetch of model of {hotkey}")
+                    return
+                job.model = model
+            logger.debug(f"Prefetched model of {hotkey} in {time.time()-t0:.1f}s")
+        except Exception as e:
+            # Not fatal, the model will be loaded (and the error raised) when it is needed
+            logger.warning(f"Failed to prefetch model of {hotkey}: {e}\n{traceback.format_exc()}")
+
+    def prefetch(self, local_store, hotkey: str, model_id: ModelId, path: Optional[str] = None, pin_memory: bool = False):
+        """Start loading a model in the background, dropping any previously staged model."""
+        key = (hotkey, model_id)
+        with self.lock:
+            if self.job is not None and self.job.key == key:
+                return
+            self._discard()
+            if path is None:
+                path = disk_utils.get_local_model_snapshot_dir(local_store.base_dir, hotkey, model_id)
+            readahead_model(path)
+            job = _PrefetchJob(key)
+            job.thread = threading.Thread(
+                    target=self._load,
+                    args=(job, local_store, hotkey, model_id, path, pin_memory),
+                    daemon=True,
+            )
+            self.job = job
+            job.thread.start()
+
+    def take(self, hotkey: str, model_id: ModelId) -> Optional[Model]:
+        """Return the staged model if it matches, waiting for it to finish loading."""
+        with self.lock:
+            job = self.job
+            if job is None or job.key != (hotkey, model_id):
+                return None
+            self.job = None
+        # Without the lock, so that other prefetch requests don't wait for this load
+        job.thread.join()
+        return job.model
+
+    def _discard(self):
+        if self.job is not None:
+            self.job.cancelled = True
+            self.job.model = None
+        self.job = None
+
+    def discard(self):
+        """Drop the staged model, if any."""
+        with self.lock:
+            self._discard()
+
+
+# Process-wide prefetcher, used by long-lived evaluation workers.
+_model_prefetcher = None
+
+def get_model_prefetcher() -> ModelPrefetcher:
+    global _model_prefetcher
+    if _model_prefetcher is None:
+        _model_prefetcher = ModelPrefetcher()
+    return _model_prefetcher
@@ -0,0 +1,154 @@
+import collections
+import contextlib
+import threading
+from typing import Optional
+
+import torch
+
+from model.data import Model, ModelId
+from model.loader import pin_model_memory
+from utilities.logs import logger
+
+
+def model_bytes(model: torch.nn.Module) -> int:
+    """Return the number of bytes used by parameters and buffers of model (shared tensors counted once)."""
+    seen = set()
+    total = 0
+    for t in list(model.parameters()) + list(model.buffers()):
+        key = (t.device, t.data_ptr())
+        if key in seen:
+            continue
+        seen.add(key)
+        total += t.numel() * t.element_size()
+    return total
+
+
+@contextlib.contextmanager
+def preserve_weights(model: torch.nn.Module):
+    """
+    Context manager that restores the tensors of model on exit. Evaluation moves
+    the model to a device (or strips it when slicing); restoring the original
+    CPU tensors afterwards leaves the model unchanged, without copying back.
+    """
+    params = [(p, p.data) for p in model.parameters()]
+    buffers = [
+        (module, name, buf)
+            for module in model.modules()
+            for name, buf in module._buffers.items()
+            if buf is not None
+    ]
+    try:
+        yield model
+    finally:
+        for p, data in params:
+            p.data = data
+        for module, name, buf in buffers:
+            module._buffers[name] = buf
+
+
+class ModelCache:
+    """
+    LRU cache of loaded models in CPU RAM, limited to max_bytes.
+
+    Models are keyed by (hotkey, model hash); storing a model for a hotkey
+    invalidates models previously cached for that hotkey. Cached models are
+    shared, so users must not modify them, see preserve_weights().
+    """
+    def __init__(self, max_bytes: int = 0, pin_memory: bool = False):
+        self.max_bytes = max_bytes
+        self.pin_memory = pin_memory
+        self.lock = threading.RLock()
+        # key -> (Model, n_bytes), least recently used first
+        self.entries = collections.OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(hotkey: str, model_id: ModelId) -> Optional[tuple]:
+        """Return cache key, or None if the model can not be identified reliably."""
+        version = model_id.hash if model_id.hash is not None else model_id.commit
+        if version is None:
+            return None
+        return (hotkey, version)
+
+    def get(self, hotkey: str, model_id: ModelId) -> Optional[Model]:
+        key = self.get_key(hotkey, model_id)
+        with self.lock:
+            if key is None or key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+    def put(self, hotkey: str, model_id: ModelId, model: Model) -> bool:
+        """Store model, evicting least recently used models as needed. Returns False if not cached."""
+        key = self.get_key(hotkey, model_id)
+        if key is None or self.max_bytes <= 0:
+            return False
+        self.invalidate(hotkey)
+        n_bytes = model_bytes(model.pt_model)
+        if n_bytes > self.max_bytes:
+            logger.debug(f"Model of {hotkey} ({n_bytes/1e9:.1f} GB) exceeds model cache size")
+            return False
+
+        if self.pin_memory:
+            pin_model_memory(model.pt_model)
+
+        with self.lock:
+            self.evict(n_bytes)
+            self.entries[key] = (model, n_bytes)
+            self.n_bytes += n_bytes
+        logger.debug(f"Cached model {key}, {n_bytes/1e9:.1f} GB; cache: {len(self.entries)} models, {self.n_bytes/1e9:.1f}/{self.max_bytes/1e9:.1f} GB")
+        return True
+
+    def evict(self, n_bytes: int = 0):
+        """Evict least recently used models until n_bytes fit within max_bytes."""
+        with self.lock:
+            while len(self.entries) and self.n_bytes + n_bytes > self.max_bytes:
+                evicted_key, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.n_bytes -= evicted_bytes
+                logger.debug(f"Evicted model {evicted_key} from model cache")
+
+    def invalidate(self, hotkey: str, model_id: Optional[ModelId] = None):
+        """Drop cached models of hotkey (only model_id if specified)."""
+        key = None if model_id is None else self.get_key(hotkey, model_id)
+        with self.lock:
+            for k in list(self.entries.keys()):
+                if k[0] != hotkey or (key is not None and k != key):
+                    continue
+                _, n_bytes = self.entries.pop(k)
+                self.n_bytes -= n_bytes
+
+    def contains(self, hotkey: str, model_id: ModelId) -> bool:
+        with self.lock:
+            return self.get_key(hotkey, model_id) in self.entries
+
+    def retrieve_model(self, local_store, hotkey: str, model_id: ModelId, path=None, prefetcher=None) -> Model:
+        """Return cached model, or retrieve it (from prefetcher or local_store) and cache it."""
+        model = self.get(hotkey, model_id)
+        if model is not None:
+            logger.info(f"Using cached model of {hotkey} ({model_id.format_label()})")
+            return model
+        if prefetcher is not None:
+            model = prefetcher.take(hotkey, model_id)
+        if model is None:
+            model = local_store.retrieve_model(hotkey, model_id, path=path)
+        self.put(hotkey, model_id, model)
+        return model
+
+
+# Process-wide cache, used by long-lived evaluation workers.
+_model_cache = None
+
+def get_model_cache(max_bytes: int, pin_memory: bool = False) -> ModelCache:
+    """Return the process-wide model cache, updating its configuration."""
+    global _model_cache
+    if _model_cache is None:
+        _model_cache = ModelCache(max_bytes=max_bytes, pin_memory=pin_memory)
+    _model_cache.pin_memory = pin_memory
+    if _model_cache.max_bytes != max_bytes:
+        _model_cache.max_bytes = max_bytes
+        _model_cache.evict()
+    return _model_cache
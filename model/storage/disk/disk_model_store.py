@@ -1,14 +1,17 @@
 import trace
 import traceback
-import bittensor as bt
 from typing import Dict
 import os
 import shutil
+import time
 
 import torch
+import constants
 from model.data import Model, ModelId
 from model.storage.disk import utils
 from model.storage.local_model_store import LocalModelStore
+from model.loader import fast_load_model, peak_rss
+from utilities.logs import TRACE, logger
 from transformers import AutoModelForCausalLM
 from pathlib import Path
 
@@ -53,37 +56,56 @@ class DiskModelStore(LocalModelStore):
         '''
         path = utils.get_local_model_snapshot_dir(self.base_dir, hotkey, model_id)
         if not os.path.exists(path):
-            bt.logging.debug(f"delete_model(): path {path} does not exist")
+            logger.debug(f"delete_model(): path {path} does not exist")
             return False
         try:
             dir_size = sum(f.stat().st_size for f in Path(path).glob('**/*') if f.is_file())
             shutil.rmtree(path=path, ignore_errors=True)
-            bt.logging.trace(
+            logger.log(TRACE,
                 f"Removed directory {path}, freed {dir_size} bytes = {dir_size/1e9:.1f} GB."
             )
         except Exception:
-            bt.logging.warning(traceback.format_exc())
+            logger.warning(traceback.format_exc())
             return False
         return True
 
     def retrieve_model(
-        self, hotkey: str, model_id: ModelId, optimized: bool = True, path=None
+        self, hotkey: str, model_id: ModelId, optimized: bool = True, path=None, device: str = 'cpu', fast: bool = True
     ) -> Model:
         """
-        Retrieves a trained model locally. If optimized use bfloat16 and flash attention.
-        If path is None, use hotkey/model_id, otherwise load from path directly
+        Retrieves a trained model locally. If optimized use bfloat16 and constants.EVAL_ATTN_IMPLEMENTATION.
+        If path is None, use hotkey/model_id, otherwise load from path directly.
+        If fast, load supported model types directly from safetensors to device.
         """
         if path is None:
             path = utils.get_local_model_snapshot_dir(self.base_dir, hotkey, model_id)
-        bt.logging.info(f"Loading model from {path}")
-        kwargs = dict(torch_dtype=torch.bfloat16, attn_implementation="flash_attention_2") if optimized else {}
-        model = AutoModelForCausalLM.from_pretrained(
-            pretrained_model_name_or_path=path,
-            revision=model_id.commit,
-            local_files_only=True,
-            use_safetensors=True,
-            **kwargs
-        )
+        logger.info(f"Loading model from {path}")
+        t0 = time.time()
+        model = None
+        if fast and optimized:
+            try:
+                model = fast_load_model(
+                    path,
+                    torch_dtype=torch.bfloat16,
+                    attn_implementation=constants.EVAL_ATTN_IMPLEMENTATION,
+                    device=device
+                )
+            except Exception as e:
+                logger.warning(f"Fast loading failed, falling back to from_pretrained(): {e}")
+                model = None
+        method = "fast_load_model"
+        if model is None:
+            method = "from_pretrained"
+            kwargs = dict(torch_dtype=torch.bfloat16, attn_implementation=constants.EVAL_ATTN_IMPLEMENTATION) if optimized else {}
+            model = AutoModelForCausalLM.from_pretrained(
+                pretrained_model_name_or_path=path,
+                revision=model_id.commit,
+                local_files_only=True,
+                use_safetensors=True,
+                **kwargs
+            )
+            model.to(device)
+        logger.info(f"Loaded model using {method}() in {time.time()-t0:.1f}s, peak RSS {peak_rss()/1e9:.1f} GB")
         return Model(id=model_id, pt_model=model)
 
     def delete_unreferenced_models(
@@ -124,7 +146,7 @@ class DiskModelStore(LocalModelStore):
                     )
                     if deleted_hotkey:
                         bytes_deleted += dir_size
-                        bt.logging.trace(
+                        logger.log(TRACE,
                             f"Removed directory for unreferenced hotkey: {hotkey}, freed {dir_size} bytes = {dir_size/1e9:.1f} GB."
                         )
 
@@ -158,11 +180,11 @@ class DiskModelStore(LocalModelStore):
                                     )
                                     if deleted_model:
                                         bytes_deleted += dir_size
-                                        bt.logging.trace(
+                                        logger.log(TRACE,
                                             f"Removing directory for unreferenced model at: {commit_path}, freed {dir_size} bytes = {dir_size/1e9:.1f} GB."
                                         )
             except Exception:
                 # Catch the exception so we continue with the rest of the cleanup.
-                bt.logging.warning(traceback.format_exc())
+                logger.warning(traceback.format_exc())
 
-        bt.logging.trace(f'cleanup done: deleted {bytes_deleted} bytes = {bytes_deleted/1e9:.1f} GB.')
+        logger.log(TRACE, f'cleanup done: deleted {bytes_deleted} bytes = {bytes_deleted/1e9:.1f} GB.')
@@ -14,6 +14,32 @@ def validator_config():
         default="cuda" if torch.cuda.is_available() else "cpu",
         help="Device name.",
     )
+    parser.add_argument(
+        "--eval_devices",
+        type=str,
+        nargs="+",
+        default=None,
+        metavar='DEVICE',
+        help="Evaluate models concurrently on these devices, one worker process each (default: --device). A device may be repeated, e.g. 'cpu cpu' for two CPU workers.",
+    )
+    parser.add_argument(
+        "--eval_coordinator_port",
+        type=int,
+        default=None,
+        help="Hand out evaluations to remote workers (neurons/remote_eval_worker.py) connecting to this port; the shared secret is read from environment variable EVAL_COORDINATOR_SECRET.",
+    )
+    parser.add_argument(
+        "--eval_coordinator_host",
+        type=str,
+        default="127.0.0.1",
+        help="Address the evaluation coordinator listens on; use e.g. 0.0.0.0 to accept workers on other hosts.",
+    )
+    parser.add_argument(
+        "--eval_remote_slots",
+        type=int,
+        default=4,
+        help="Maximum number of evaluations running on remote workers at a time.",
+    )
     parser.add_argument(
         "--wandb.off",
         dest="wandb.on",
@@ -60,6 +86,24 @@ def validator_config():
         help="Maximum size of model store (>0) or minimum space to keep free on disk (<=0) after model cleanup; please keep enough free space to download new models.",
     )
 
+    parser.add_argument(
+        "--model_cache_gb",
+        default=constants.DEFAULT_MODEL_CACHE_GB,
+        metavar='GB',
+        type=float,
+        help="Keep up to this many GB of loaded models in RAM across steps (0 to disable), to avoid reloading pool models every step.",
+    )
+    parser.add_argument(
+        "--model_cache_pin",
+        action="store_true",
+        help="Use pinned memory for cached and prefetched models, for faster transfer to the GPU.",
+    )
+    parser.add_argument(
+        "--no_model_prefetch",
+        action="store_true",
+        help="Don't load the next model while evaluating the current one (saves RAM).",
+    )
+
     bt.subtensor.add_args(parser)
     bt.logging.add_args(parser)
     bt.wallet.add_args(parser)
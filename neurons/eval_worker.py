@@ -0,0 +1,231 @@
+# Entry point of evaluation worker processes.
+#
+# Spawned workers import this module as their main module, instead of the
+# validator's (see WorkerPool main_module), and check_and_compute_losses() is
+# pickled by reference to it. Keep its imports to what evaluating a model
+# takes: torch, transformers, the vendored model packages and the modules
+# loading and evaluating models. In particular, don't import bittensor (log
+# through utilities.logs), neurons.validator, wandb, rich or the chain/Hugging
+# Face clients here; see tests/pretrain/test_eval_worker.py.
+
+import contextlib
+import functools
+import math
+
+import numpy as np
+
+import constants
+# Register the vendored model types with transformers' Auto classes
+import transformers_llama
+import transformers_phi
+import transformers_phi3
+from model import competitions
+from model.data import Model, ModelId
+from model.loader import get_model_prefetcher, lazy_load_model, needs_lazy_load
+from model.model_cache import get_model_cache, preserve_weights
+from model.storage.disk import utils as disk_utils
+from neurons import validation
+from utilities.logs import logger
+from utilities.shared_samples import get_sample_tensors
+from utilities.sliced_model import get_slice_adapter
+
+
+class Container:
+    '''
+    Empty container object, e.g. for model metadata. Defined here rather than
+    in the validator script, so that workers can unpickle it.
+    '''
+    pass
+
+
+class ModelIssue(Exception):
+    '''
+    Exception class to signal issues with models preventing evaluation.
+    '''
+    pass
+
+
+def check_and_compute_losses(
+        local_store=None,
+        metadata=None,
+        competition_info=None,
+        batches=None,
+        max_token_id=None,
+        device=None,
+        model_cache_bytes=0,
+        model_cache_pin=False,
+        prefetch_metadata=None,
+        early_stop=None,
+    ):
+    cinfo = competition_info
+    batches = get_sample_tensors(batches)
+    # This runs in a long-lived worker process, so the cache and the prefetched
+    # model persist across calls.
+    prefetcher = get_model_prefetcher()
+    model_cache = None
+    model_i = None
+    model_path = metadata.path
+    if model_path is None:
+        model_path = disk_utils.get_local_model_snapshot_dir(local_store.base_dir, metadata.hotkey, metadata.id)
+    if needs_lazy_load(model_path, constants.LAZY_LOAD_RAM_FRACTION):
+        # Too large for RAM; weights are loaded per slice during evaluation
+        pt_model = lazy_load_model(model_path, attn_implementation=constants.EVAL_ATTN_IMPLEMENTATION)
+        if pt_model is not None and type(pt_model).__name__ in cinfo['model_types']:
+            logger.info(f"Model at {model_path} is evaluated with lazily loaded weights")
+            model_i = Model(id=metadata.id, pt_model=pt_model)
+    if model_i is None and model_cache_bytes > 0:
+        model_cache = get_model_cache(model_cache_bytes, pin_memory=model_cache_pin)
+        model_i = model_cache.retrieve_model(local_store, metadata.hotkey, metadata.id, path=metadata.path, prefetcher=prefetcher)
+    elif model_i is None:
+        model_i = prefetcher.take(metadata.hotkey, metadata.id)
+        if model_i is None:
+            model_i = local_store.retrieve_model(metadata.hotkey, metadata.id, path=metadata.path)
+
+    # Load the next model in the background, overlapping with evaluation of this one
+    prefetch_path = None
+    if prefetch_metadata is not None:
+        prefetch_path = prefetch_metadata.path
+        if prefetch_path is None:
+            prefetch_path = disk_utils.get_local_model_snapshot_dir(local_store.base_dir, prefetch_metadata.hotkey, prefetch_metadata.id)
+    if prefetch_metadata is None or needs_lazy_load(prefetch_path, constants.LAZY_LOAD_RAM_FRACTION):
+        prefetcher.discard()
+    elif model_cache is None or not model_cache.contains(prefetch_metadata.hotkey, prefetch_metadata.id):
+        prefetcher.prefetch(
+                local_store,
+                prefetch_metadata.hotkey,
+                prefetch_metadata.id,
+                path=prefetch_metadata.path,
+                pin_memory=model_cache_pin,
+        )
+    mdl_allowed, reason = competitions.validate_model_constraints(model_i.pt_model, cinfo)
+    if not mdl_allowed:
+        raise ModelIssue(f"Model violates competition {metadata.id.competition} constraints: {reason}")
+    allow_sliced = False
+    model_type = type(model_i.pt_model).__name__
+    if get_slice_adapter(model_i.pt_model) is not None:
+        # Test the exact model type name to check whether slicing is allowed by config:
+        allow_sliced = model_type in cinfo['model_types']
+
+    embed_size = None
+    try:
+        embed_size = model_i.pt_model.model.embed_tokens.weight.shape[0]
+    except Exception as e:
+        # Currently supported models should have the queried parameter, but in case they don't, just skip this check.
+        logger.warning(f'could not find embed size, skipping check: {e}')
+
+    if embed_size:
+        if max_token_id>=embed_size:
+            raise ModelIssue(f"Vocabulary size mismatch between tokenizer and model: {max_token_id} >= {embed_size}")
+    else:
+        embed_size = max_token_id
+
+    early_stop_check = None
+    if early_stop is not None:
+        early_stop_check = functools.partial(validation.cannot_enter_pool, **early_stop)
+
+    # Cached models must be left intact (on CPU) after evaluation
+    with preserve_weights(model_i.pt_model) if model_cache_bytes > 0 else contextlib.nullcontext():
+        losses = validation.compute_losses(
+                model_i.pt_model,
+                allow_sliced,
+                batches,
+                device,
+                max_batch_tokens=cinfo.get('eval_batch_tokens', constants.EVAL_BATCH_TOKENS),
+                max_pack_tokens=cinfo.get('eval_pack_tokens', constants.EVAL_PACK_TOKENS),
+                logits_chunk_tokens=cinfo.get('eval_logits_chunk_tokens', constants.EVAL_LOGITS_CHUNK_TOKENS),
+                early_stop=early_stop_check,
+                early_stop_groups=cinfo.get('eval_early_stop_groups', constants.EVAL_EARLY_STOP_GROUPS),
+                stream_slices=cinfo.get('eval_stream_slices', constants.EVAL_STREAM_SLICES),
+                state_store=cinfo.get('eval_state_store', constants.EVAL_STATE_STORE),
+                state_store_path=cinfo.get('eval_state_store_path', constants.EVAL_STATE_STORE_PATH),
+                slice_memory_fraction=cinfo.get('eval_slice_memory_fraction', constants.EVAL_SLICE_MEMORY_FRACTION),
+                slice_schedule=cinfo.get('eval_slice_schedule', constants.EVAL_SLICE_SCHEDULE),
+                compile_eval=cinfo.get('eval_compile', constants.EVAL_COMPILE),
+                compile_cache_dir=constants.EVAL_COMPILE_CACHE_DIR,
+        )
+    # Samples skipped by early stopping have nan loss, which never wins in compute_wins()
+    n_skipped = 0 if early_stop is None else int(np.sum(np.isnan(losses)))
+    losses_pt = [loss_sum / len(batch[0]) if batch is not None else math.inf for loss_sum, batch in zip(losses, batches)]
+    sample_lengths = [len(batch[0]) for batch in batches if batch is not None]
+    avg_sample_length = 0 if len(sample_lengths) == 0 else np.mean(sample_lengths)
+
+    return {
+        'losses':losses,
+        'losses_pt':losses_pt,
+        'avg_sample_length':avg_sample_length,
+        'n_skipped':n_skipped,
+        'model_geometry':{
+            'n_parameters':model_i.pt_model.num_parameters(),
+            'n_layers':model_i.pt_model.config.num_hidden_layers,
+            'embed_size':embed_size,
+        },
+    }
+
+
+# Mappings from uid in the early stopping arguments, sent as lists of pairs
+# since JSON object keys are strings
+_EARLY_STOP_UID_MAPPINGS = ('losses_per_uid', 'uid_to_block')
+
+
+def describe_remote_eval(metadata, competition: str, competition_info: dict, batches, max_token_id, early_stop=None) -> dict:
+    """
+    Describe an evaluation by check_and_compute_losses() as JSON-able data, for
+    a remote worker (see neurons/remote_eval_worker.py). The worker downloads
+    the model by metadata.content_hash. batches (SharedSamples) is left as is,
+    for the coordinator to publish.
+    """
+    if early_stop is not None:
+        early_stop = dict(early_stop)
+        for name in _EARLY_STOP_UID_MAPPINGS:
+            early_stop[name] = list(early_stop[name].items())
+    return {
+        'metadata': {
+            'hotkey': metadata.hotkey,
+            'id': metadata.id.dict(),
+            'block': metadata.block,
+            'content_hash': metadata.content_hash,
+        },
+        'competition': competition,
+        'competition_info': competition_info,
+        'batches': batches,
+        'max_token_id': int(max_token_id),
+        'early_stop': early_stop,
+    }
+
+
+def remote_eval_kwargs(description: dict) -> dict:
+    """
+    Return the arguments of check_and_compute_losses() given by a description
+    from describe_remote_eval(); the worker adds its own model store and device.
+    """
+    metadata = Container()
+    metadata.hotkey = description['metadata']['hotkey']
+    metadata.id = ModelId(**description['metadata']['id'])
+    metadata.block = description['metadata']['block']
+    metadata.content_hash = description['metadata']['content_hash']
+    metadata.path = None
+    early_stop = description['early_stop']
+    if early_stop is not None:
+        early_stop = dict(early_stop)
+        for name in _EARLY_STOP_UID_MAPPINGS:
+            early_stop[name] = {uid: value for uid, value in early_stop[name]}
+    return dict(
+        metadata=metadata,
+        competition_info=description['competition_info'],
+        batches=description['batches'],
+        max_token_id=description['max_token_id'],
+        early_stop=early_stop,
+    )
+
+
+def eval_results_to_json(results: dict) -> dict:
+    """Return the results of check_and_compute_losses() with plain floats and ints, for JSON."""
+    return {
+        'losses': [float(loss) for loss in results['losses']],
+        'losses_pt': [float(loss) for loss in results['losses_pt']],
+        'avg_sample_length': float(results['avg_sample_length']),
+        'n_skipped': int(results['n_skipped']),
+        'model_geometry': {
+            name: None if value is None else int(value) for name, value in results['model_geometry'].items()
+        },
+    }
@@ -0,0 +1,276 @@
+# Evaluation worker for another host than the validator's.
+#
+# Pulls evaluation tasks from the coordinator of a validator started with
+# --eval_coordinator_port, downloads the models to its own model store and
+# evaluates them on its own device. Run one per device:
+#
+#   EVAL_COORDINATOR_SECRET=... python neurons/remote_eval_worker.py \
+#       --coordinator http://validator-host:port --device cuda:0
+#
+# The secret must match the validator's; it signs all requests and responses.
+# Tasks and results are exchanged as JSON data, but are not encrypted.
+#
+# Downloaded models are kept by content hash and removed least recently used
+# first when the model store exceeds --model_store_size_gb.
+
+import argparse
+import asyncio
+import contextlib
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import bittensor as bt
+
+import constants
+from model.storage.disk import utils as disk_utils
+from model.storage.disk.disk_model_store import DiskModelStore
+from neurons.eval_worker import check_and_compute_losses, eval_results_to_json, remote_eval_kwargs
+from utilities.eval_coordinator import SECRET_ENV_VAR, CoordinatorClient
+from utilities.worker_pool import WorkerPool
+
+# Content hash -> snapshot directory and time of last use, of the models in the model store
+HASH_INDEX_FILENAME = 'content_hashes.json'
+
+
+def _is_current(lock, path: str) -> bool:
+    """Whether the open file lock is (still) the file at path."""
+    try:
+        return os.path.samestat(os.fstat(lock.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+def _lock(path: str, operation: int):
+    """
+    Open lock file path and flock() it with operation. Returns the file, or
+    None if operation includes LOCK_NB and the lock is taken. Holders of an
+    exclusive lock may remove the file, so the lock is taken again if the
+    file was replaced meanwhile.
+    """
+    while True:
+        lock = open(path, 'a')
+        try:
+            fcntl.flock(lock, operation)
+        except BlockingIOError:
+            lock.close()
+            return None
+        if _is_current(lock, path):
+            return lock
+        lock.close()
+
+
+def _model_lock_path(base_dir: str, content_hash: str) -> str:
+    return os.path.join(base_dir, f'.model-{hashlib.sha1(content_hash.encode()).hexdigest()}.lock')
+
+
+@contextlib.contextmanager
+def _hash_index(base_dir: str):
+    """Yield the hash index of the model store at base_dir, under its lock; changes are saved."""
+    with open(os.path.join(base_dir, HASH_INDEX_FILENAME + '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index_path = os.path.join(base_dir, HASH_INDEX_FILENAME)
+        index = {}
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+        saved = json.dumps(index, sort_keys=True)
+        yield index
+        if json.dumps(index, sort_keys=True) != saved:
+            with open(index_path + '.tmp', 'w') as f:
+                json.dump(index, f)
+            os.replace(index_path + '.tmp', index_path)
+
+
+@contextlib.contextmanager
+def use_model(base_dir: str, metadata, download):
+    """
+    Yield the directory of the model of metadata in the model store at
+    base_dir, calling download(metadata) to fetch it if it isn't there yet.
+    The model is not removed by evict_models() until the context is left.
+
+    Models are identified by metadata.content_hash, the hash of the model
+    directory, so a model that several hotkeys submitted is downloaded once.
+    Workers sharing the model store wait for each other's download of the
+    same model instead of downloading it again.
+    """
+    content_hash = getattr(metadata, 'content_hash', None)
+    if content_hash is None:
+        raise Exception(f"No content hash for model {metadata.id}")
+    os.makedirs(base_dir, exist_ok=True)
+    lock_path = _model_lock_path(base_dir, content_hash)
+    while True:
+        with contextlib.closing(_lock(lock_path, fcntl.LOCK_EX)) as lock:
+            with _hash_index(base_dir) as index:
+                path = index.get(content_hash, {}).get('path', None)
+            if path is None or not os.path.isdir(path):
+                try:
+                    path = download(metadata)
+                    downloaded_hash = disk_utils.get_hash_of_directory(path)
+                    if downloaded_hash != content_hash:
+                        shutil.rmtree(path, ignore_errors=True)
+                        raise Exception(f"Hash of downloaded model {metadata.id} is {downloaded_hash}, expected {content_hash}")
+                except Exception:
+                    os.unlink(lock_path)
+                    raise
+            with _hash_index(base_dir) as index:
+                index[content_hash] = {'path': path, 'last_used': time.time()}
+            # Shared while in use, so that other workers can use the model as
+            # well. The conversion is not atomic: check that no eviction came
+            # in between.
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            if os.path.isdir(path) and _is_current(lock, lock_path):
+                yield path
+                return
+
+
+def evict_models(base_dir: str, bytes_to_free: float) -> int:
+    """
+    Remove models from the model store at base_dir, least recently used
+    first, until bytes_to_free bytes are freed; models in use are kept.
+    Forgets models whose directories are gone. Returns the number of bytes freed.
+    """
+    freed = 0
+    with _hash_index(base_dir) as index:
+        for content_hash, entry in sorted(index.items(), key=lambda item: item[1]['last_used']):
+            path = entry['path']
+            if freed >= bytes_to_free and os.path.isdir(path):
+                continue
+            lock_path = _model_lock_path(base_dir, content_hash)
+            lock = _lock(lock_path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if lock is None:
+                continue
+            with lock:
+                if os.path.isdir(path):
+                    dir_size = sum(f.stat().st_size for f in Path(path).glob('**/*') if f.is_file())
+                    shutil.rmtree(path, ignore_errors=True)
+                    freed += dir_size
+                    bt.logging.debug(f"Removed model {content_hash} at {path}, freed {dir_size/1e9:.1f} GB")
+                del index[content_hash]
+                os.unlink(lock_path)
+    return freed
+
+
+class RemoteEvalWorker:
+    def __init__(self, config):
+        self.config = config
+        os.makedirs(config.model_dir, exist_ok=True)
+        self.local_store = DiskModelStore(base_dir=config.model_dir)
+        # Evaluations run isolated, like in the validator
+        self.pool = WorkerPool(
+            mode="spawn",
+            max_tasks=constants.EVAL_WORKER_MAX_TASKS,
+            name="remote-eval",
+            main_module=check_and_compute_losses.__module__,
+        )
+
+    def download(self, metadata, model_size_limit: int) -> str:
+        from model.storage.hugging_face.hugging_face_model_store import HuggingFaceModelStore
+        bt.logging.info(f"Downloading model {metadata.id}")
+        asyncio.run(HuggingFaceModelStore().download_model(
+            metadata.id, self.local_store.get_path(metadata.hotkey), model_size_limit
+        ))
+        return disk_utils.get_local_model_snapshot_dir(self.local_store.base_dir, metadata.hotkey, metadata.id)
+
+    def clean_models(self):
+        """Remove least recently used models while the model store exceeds its size budget."""
+        state = disk_utils.storage_state(self.local_store.base_dir, self.config)
+        if state['gb_to_delete'] <= 0:
+            return
+        bt.logging.info(f"Model store: {state['usage_str']}; removing models")
+        freed = evict_models(self.local_store.base_dir, state['gb_to_delete']*1e9)
+        bt.logging.info(f"Removed {freed/1e9:.1f} GB of models")
+
+    def execute(self, task: dict, ttl: float, expected_errors: set, started) -> dict:
+        """
+        Evaluate the model of a task described by describe_remote_eval(). The
+        ttl applies to the evaluation; started() is called once the model is
+        downloaded.
+        """
+        kwargs = remote_eval_kwargs(task)
+        metadata = kwargs['metadata']
+        bt.logging.info(f"Evaluating model {metadata.id} for competition {task['competition']}")
+        model_size_limit = kwargs['competition_info'].get('model_size', constants.MAX_MODEL_SIZE)
+        self.clean_models()
+        download = functools.partial(self.download, model_size_limit=model_size_limit)
+        with use_model(self.local_store.base_dir, metadata, download) as path:
+            metadata.path = path
+            started()
+            func = functools.partial(
+                check_and_compute_losses,
+                local_store=self.local_store,
+                device=self.config.device,
+                model_cache_bytes=int(self.config.model_cache_gb*1e9),
+                model_cache_pin=self.config.model_cache_pin,
+                # The next model is not known here
+                prefetch_metadata=None,
+                **kwargs,
+            )
+            results = self.pool.run(func, ttl=ttl, expected_errors=expected_errors)
+        return eval_results_to_json(results)
+
+    def run(self):
+        secret = os.environ.get(SECRET_ENV_VAR, None)
+        if not secret:
+            bt.logging.error(f"Please set the coordinator secret in environment variable {SECRET_ENV_VAR}")
+            sys.exit(-1)
+        client = CoordinatorClient(self.config.coordinator, secret)
+        bt.logging.info(f"Evaluating models for {self.config.coordinator} on {self.config.device} as {client.worker}")
+        try:
+            client.serve(self.execute)
+        finally:
+            self.pool.shutdown()
+
+
+def remote_eval_worker_config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--coordinator",
+        type=str,
+        required=True,
+        help="URL of the validator's evaluation coordinator, e.g. http://host:port",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda",
+        help="Device name.",
+    )
+    parser.add_argument(
+        "--model_dir",
+        default=os.path.join(constants.ROOT_DIR, "model-store/"),
+        help="Where to store downloaded models",
+    )
+    parser.add_argument(
+        "--model_store_size_gb",
+        default=-constants.DEFAULT_MIN_FREE_GB,
+        metavar='GB',
+        type=int,
+        help="Maximum size of model store (>0) or minimum space to keep free on disk (<=0); least recently used models are removed first.",
+    )
+    parser.add_argument(
+        "--model_cache_gb",
+        default=constants.DEFAULT_MODEL_CACHE_GB,
+        metavar='GB',
+        type=float,
+        help="Keep up to this many GB of loaded models in RAM across tasks (0 to disable).",
+    )
+    parser.add_argument(
+        "--model_cache_pin",
+        action="store_true",
+        help="Use pinned memory for cached models, for faster transfer to the GPU.",
+    )
+    bt.logging.add_args(parser)
+    return bt.config(parser)
+
+
+if __name__ == "__main__":
+    config = remote_eval_worker_config()
+    bt.logging(config=config)
+    RemoteEvalWorker(config).run()
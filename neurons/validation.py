@@ -18,15 +18,30 @@
 
 # Tools for performing validation over models.
 
+import gc
+import contextlib
 import math
 import torch
 import typing
 import constants
 import traceback
-import bittensor as bt
 import numpy as np
 import itertools
 from utilities.mathutils import *
+from utilities.losses import chunked_cross_entropy, get_decoder_and_head, is_oom_error
+from model.model_cache import preserve_weights
+from utilities.causal_mask import clear_causal_mask_cache
+from utilities.compiled_eval import compile_cache, compile_decoder, get_compile_cache_dir, get_length_bucket, reset_compiled
+from utilities.rotary_cache import clear_rotary_cache
+from utilities.lazy_weights import is_lazy_model
+from utilities.sliced_model import SlicedModelWrapper
+from utilities.slice_planner import get_device_budget, get_state_budget, plan_resident_slices, plan_slices
+from utilities.logs import logger
+
+# Evaluation settings that were needed to evaluate all samples of a model
+# geometry without running out of memory: geometry -> dict(logits_chunk_tokens, n_slices).
+# Evaluation workers are long-lived, so these are remembered across steps.
+eval_configs = {}
 
 def compute_wins(
     losses_per_uid: typing.Dict[int, typing.List[float]],
@@ -102,24 +117,198 @@ def compute_wins(
     return dict(wins=wins, win_rate=win_fractions, advantage_factors=uid_advantage_factors, matrix=matrix)
 
 
+def cannot_enter_pool(
+    losses: typing.List[float],
+    evaluated: typing.List[int],
+    uid: int,
+    losses_per_uid: typing.Dict[int, typing.List[float]],
+    uid_to_block: typing.Dict[int, int],
+    pool_size: int,
+    current_block,
+    advantage_initial,
+    advantage_decay_per_epoch
+) -> bool:
+    """
+    Determine whether a partially evaluated model can be dropped, because even
+    when winning all remaining samples it would likely not make it into the pool.
+
+    Wins are counted on the evaluated samples only, against the models in
+    losses_per_uid. The upper bound on wins of uid is its wins so far plus the
+    number of remaining samples; other models are assumed to win none of the
+    remaining samples. This is not an exact bound: models not in
+    losses_per_uid can block others on some samples, which can move wins to
+    uid as well as to the models it is compared with. Dropping uid also
+    changes the wins of other models, because its skipped samples (nan
+    losses) no longer block older models. Hence early stopping is opt-in
+    (see constants.EVAL_EARLY_STOP_GROUPS).
+
+    Parameters:
+        losses (list): Losses of uid, for all samples.
+        evaluated (list): Indices of samples evaluated so far.
+        uid (int): The uid under evaluation.
+        losses_per_uid (dict): Sample losses of fully evaluated uids.
+        uid_to_block (dict): A dictionary of blocks for each uid (including uid).
+        pool_size (int): Number of models kept in the pool.
+        current_block (int): current block id
+        advantage_initial (float)
+        advantage_decay_per_epoch (float)
+    Returns:
+        bool: True if at least pool_size models are guaranteed to have more wins.
+    """
+    others = {other: other_losses for other, other_losses in losses_per_uid.items() if other != uid and other_losses is not None}
+    if len(evaluated) == 0 or len(others) < pool_size:
+        return False
+
+    partial_losses = {other: [other_losses[i] for i in evaluated] for other, other_losses in others.items()}
+    partial_losses[uid] = [losses[i] for i in evaluated]
+    wins = compute_wins(
+        partial_losses,
+        uid_to_block,
+        current_block,
+        advantage_initial,
+        advantage_decay_per_epoch,
+    )['wins']
+
+    max_wins = wins[uid] + len(losses) - len(evaluated)
+    n_better = sum(1 for other, n_wins in wins.items() if other != uid and n_wins > max_wins)
+    return n_better >= pool_size
+
+def duplicate_to_evaluate(
+    n_skipped: int,
+    decided: bool,
+    dup_uids: typing.List[int],
+    pool: typing.Iterable[int],
+    uid_to_block: typing.Dict[int, int]
+) -> typing.Optional[int]:
+    """
+    Decide whether the result of a model applies to its byte-identical
+    duplicates dup_uids. Losses or a model issue are decided by the model and
+    hold for all duplicates, unless the model stopped early (n_skipped > 0):
+    that depends on its own uid, block and pool membership.
+
+    Parameters:
+        n_skipped (int): Number of samples the model skipped (0 if it failed).
+        decided (bool): Whether the model was evaluated or failed with
+            ModelIssue; False for other failures, e.g. timeouts.
+        dup_uids (list): uids of the duplicates.
+        pool (iterable): uids of the current pool.
+        uid_to_block (dict): A dictionary of blocks for each uid.
+    Returns:
+        Optional[int]: None if the result can be copied to the duplicates,
+        else the duplicate to evaluate in place of the model: a pool member,
+        or the one with the earliest block, being least likely to stop early.
+    """
+    if decided and n_skipped == 0:
+        return None
+    return min(dup_uids, key=lambda uid: (uid not in pool, uid_to_block[uid]))
+
+def gen_sample_groups(n_samples: int, n_groups: int) -> typing.List[typing.List[int]]:
+    """
+    Split sample indices into n_groups interleaved groups (0, n_groups, 2*n_groups, ...),
+    so that each group is spread over all pages.
+    """
+    groups = [list(range(i, n_samples, n_groups)) for i in range(n_groups)]
+    return [group for group in groups if len(group)]
+
+
 def compute_losses_sliced(
-    model, batches: typing.List[torch.Tensor], device: str, n_slices=1
+    model, batches: typing.List[torch.Tensor], device: str, n_slices=1, logits_chunk_tokens: int = 0,
+    stream_slices: bool = False, state_store: str = 'device', state_store_path: typing.Optional[str] = None,
+    start_layers: typing.Optional[typing.List[int]] = None, schedule: str = 'slice', state_budget: typing.Optional[int] = None,
+    resident_slices: int = 1, oom_failed: typing.Optional[typing.List[int]] = None
 ) -> typing.List[float]:
+    """
+    Computes the summed loss per sample on the model sliced into n_slices
+    (or at start_layers). Indices of samples that failed because of running
+    out of memory are appended to oom_failed, if specified.
+    """
     with torch.no_grad():
         sliced = model.sliced(
             n_slices=n_slices,
+            start_layers=None if start_layers is None else list(start_layers),
+            schedule=schedule,
+            state_budget=state_budget,
+            resident_slices=resident_slices,
             device=device,
+            logits_chunk_tokens=logits_chunk_tokens,
+            stream_slices=stream_slices,
+            state_store=state_store,
+            state_store_path=state_store_path,
         )
-        losses = sliced.evaluate_samples(batches,reduction='sum')
-        bt.logging.info(f'computed sliced losses: {losses[:10]}...')
+        losses = sliced.evaluate_samples(batches,reduction='sum',oom_failed=oom_failed)
+        logger.info(f'computed sliced losses: {losses[:10]}...')
         return losses
 
+def compute_token_losses(
+    model, inputs: torch.Tensor, logits_chunk_tokens: int = 0, **kwargs
+) -> torch.Tensor:
+    """
+    Computes the loss of every token in inputs, given the preceding tokens.
+    If logits_chunk_tokens is non-zero and the model allows it, the lm_head and
+    loss are evaluated in chunks, to avoid materializing the full-vocabulary logits.
+
+    Parameters:
+        model (torch.nn.Module): The model for which losses are to be computed.
+        inputs (torch.Tensor): [batch_size, seq_len] token ids.
+        logits_chunk_tokens (int): Number of positions per lm_head chunk, 0 to disable.
+        kwargs: Passed on to the model (e.g. attention_mask, position_ids).
+
+    Returns:
+        torch.Tensor: [batch_size, seq_len-1] losses.
+    """
+    batch_size = inputs.shape[0]
+    decoder, lm_head = get_decoder_and_head(model) if logits_chunk_tokens else (None, None)
+    if lm_head is None:
+        logits = model(inputs, **kwargs).logits
+        loss_fct = torch.nn.CrossEntropyLoss(reduction='none')
+        return loss_fct(
+            logits[..., :-1, :].reshape(-1, logits.shape[-1]),
+            inputs[..., 1:].reshape(-1)
+        ).view(batch_size, -1)
+
+    hidden_states = decoder(inputs, **kwargs)[0]
+    return chunked_cross_entropy(
+        hidden_states[:, :-1, :].reshape(-1, hidden_states.shape[-1]),
+        lm_head,
+        inputs[:, 1:].reshape(-1),
+        logits_chunk_tokens,
+        reduction='none'
+    ).view(batch_size, -1)
+
+def free_memory():
+    clear_causal_mask_cache()
+    clear_rotary_cache()
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def get_model_geometry(model, device: str) -> tuple:
+    """Return key identifying models with identical memory requirements."""
+    config = model.config
+    return (
+        type(model).__name__,
+        model.num_parameters(),
+        getattr(config, 'num_hidden_layers', None),
+        getattr(config, 'hidden_size', None),
+        getattr(config, 'vocab_size', None),
+        str(model.dtype),
+        str(device),
+    )
+
 def compute_losses_regular(
-    model, batches: typing.List[torch.Tensor], device: str
+    model, batches: typing.List[torch.Tensor], device: str, logits_chunk_tokens: int = 0,
+    oom_failed: typing.Optional[typing.List[int]] = None
 ) -> typing.List[float]:
+    """
+    Computes the summed loss per sample, one sample at a time.
+    Indices of samples that failed because of running out of memory are
+    appended to oom_failed, if specified.
+    """
     model.to(device)
     model.eval()
 
+    decoder, lm_head = get_decoder_and_head(model) if logits_chunk_tokens else (None, None)
+
     losses = [math.inf]*len(batches) # Use infinity to indicate failure
     with torch.no_grad():
         cuda_errors = 0
@@ -129,35 +318,436 @@ def compute_losses_regular(
                 continue
 
             inputs = None
+            hidden_states = None
             logits = None
+            oom = False
             try:
                 inputs = batch.to(device)
-                logits = model(inputs).logits
-
-                shift_logits = logits[..., :-1, :].contiguous()
-                shift_labels = inputs[..., 1:].contiguous()
-                # Flatten the tokens
-                loss_fct = torch.nn.CrossEntropyLoss(reduction='sum')
-                shift_logits = shift_logits.view(-1, model.config.vocab_size)
-                shift_labels = shift_labels.view(-1)
-                losses[i] = loss_fct(shift_logits, shift_labels).item()
+                if lm_head is not None:
+                    # Never hold more than logits_chunk_tokens x vocab_size logits
+                    hidden_states = decoder(inputs)[0]
+                    losses[i] = chunked_cross_entropy(
+                        hidden_states[0, :-1, :],
+                        lm_head,
+                        inputs[0, 1:],
+                        logits_chunk_tokens
+                    ).item()
+                else:
+                    logits = model(inputs).logits
+
+                    shift_logits = logits[..., :-1, :].contiguous()
+                    shift_labels = inputs[..., 1:].contiguous()
+                    # Flatten the tokens
+                    loss_fct = torch.nn.CrossEntropyLoss(reduction='sum')
+                    shift_logits = shift_logits.view(-1, model.config.vocab_size)
+                    shift_labels = shift_labels.view(-1)
+                    losses[i] = loss_fct(shift_logits, shift_labels).item()
+            except Exception as e:
+                if is_oom_error(e):
+                    logger.warning(f"Out of memory evaluating sample {i} of length {len(batch[0])}")
+                    oom = True
+                    if oom_failed is not None:
+                        oom_failed.append(i)
+                else:
+                    logger.error(f"Exception occurred: {e}")
+                    logger.error(traceback.format_exc())
+                    if 'CUDA error' in str(e):
+                        cuda_errors += 1
+                        if cuda_errors>=4:
+                            logger.error(f'{cuda_errors} CUDA errors, bailing out of evaluation loop')
+                            break
+            finally:
+                del inputs
+                del hidden_states
+                del logits
+            if oom:
+                free_memory()
+
+    logger.info(f'computed losses: {losses[:10]}...')
+
+    return losses
+
+def gen_length_buckets(
+    batches: typing.List[torch.Tensor], max_batch_tokens: int
+) -> typing.List[typing.List[int]]:
+    """
+    Group sample indices into buckets of similar length, for batched evaluation.
+
+    Samples are sorted on length (longest first), so that each bucket pads only
+    a little. A bucket is closed when adding the next sample would make the
+    padded size (n_samples * longest sample) exceed max_batch_tokens. Samples
+    that exceed max_batch_tokens by themselves get a bucket of their own.
+    Samples that are None are skipped.
+
+    Returns:
+        list: A list of lists of sample indices.
+    """
+    indices = [i for i, batch in enumerate(batches) if batch is not None]
+    indices.sort(key=lambda i: len(batches[i][0]), reverse=True)
+
+    buckets = []
+    bucket = []
+    bucket_len = 0
+    for i in indices:
+        if len(bucket) and (len(bucket)+1)*bucket_len > max_batch_tokens:
+            buckets.append(bucket)
+            bucket = []
+        if len(bucket) == 0:
+            # Sorted longest first, so the first sample determines the padded length
+            bucket_len = len(batches[i][0])
+        bucket.append(i)
+    if len(bucket):
+        buckets.append(bucket)
+    return buckets
+
+def compute_losses_batched(
+    model, batches: typing.List[torch.Tensor], device: str, max_batch_tokens: int, logits_chunk_tokens: int = 0,
+    oom_failed: typing.Optional[typing.List[int]] = None
+) -> typing.List[float]:
+    """
+    Computes the summed loss per sample, evaluating length-bucketed batches of
+    samples in a single forward pass. Samples are right-padded within a bucket
+    and padding is masked, so the losses are identical to compute_losses_regular()
+    (up to floating point differences between kernels for different shapes).
+    If evaluation of a bucket fails (e.g. OOM), its samples are evaluated one by one.
+
+    Parameters:
+        model (torch.nn.Module): The model for which losses are to be computed.
+        batches (list): A list of [1, seq_len] token tensors (or None).
+        device (str): The device to use for computation (e.g., 'cpu', 'gpu').
+        max_batch_tokens (int): Maximum padded number of tokens per forward pass.
+        logits_chunk_tokens (int): Evaluate lm_head and loss in chunks of this many positions, 0 to disable.
+        oom_failed (list): If specified, indices of samples that ran out of memory are appended.
+
+    Returns:
+        list: A list of summed losses for each batch.
+    """
+    model.to(device)
+    model.eval()
+
+    losses = [math.inf]*len(batches) # Use infinity to indicate failure
+    buckets = gen_length_buckets(batches, max_batch_tokens)
+    logger.info(f'evaluating {sum(len(b) for b in buckets)} samples in {len(buckets)} batches of at most {max_batch_tokens} tokens')
+    failed = []
+    with torch.no_grad():
+        for bucket in buckets:
+            inputs = None
+            attention_mask = None
+            token_losses = None
+            try:
+                lengths = [len(batches[i][0]) for i in bucket]
+                bucket_len = max(lengths)
+                inputs = torch.zeros((len(bucket), bucket_len), dtype=batches[bucket[0]].dtype)
+                attention_mask = torch.zeros((len(bucket), bucket_len), dtype=torch.long)
+                for row, i in enumerate(bucket):
+                    inputs[row, :lengths[row]] = batches[i][0]
+                    attention_mask[row, :lengths[row]] = 1
+                inputs = inputs.to(device)
+                attention_mask = attention_mask.to(device)
+                if min(lengths) == bucket_len:
+                    # No padding; don't bother the model with a mask
+                    token_losses = compute_token_losses(model, inputs, logits_chunk_tokens)
+                else:
+                    token_losses = compute_token_losses(model, inputs, logits_chunk_tokens, attention_mask=attention_mask)
+                # Padding is only at the end of a row; ignore targets beyond the sample
+                for row, i in enumerate(bucket):
+                    losses[i] = token_losses[row, :lengths[row]-1].sum().item()
             except Exception as e:
-                bt.logging.error(f"Exception occurred: {e}")
-                bt.logging.error(traceback.format_exc())
-                if 'CUDA error' in str(e):
-                    cuda_errors += 1
-                    if cuda_errors>=4:
-                        bt.logging.error(f'{cuda_errors} CUDA errors, bailing out of evaluation loop')
-                        break
+                logger.warning(f"Exception evaluating batch of {len(bucket)} samples, will retry per sample: {e}")
+                failed.extend(bucket)
             del inputs
-            del logits
+            del attention_mask
+            del token_losses
+
+    if len(failed):
+        free_memory()
+        failed_oom = []
+        failed_losses = compute_losses_regular(model, [batches[i] for i in failed], device, logits_chunk_tokens, oom_failed=failed_oom)
+        for i, loss in zip(failed, failed_losses):
+            losses[i] = loss
+        if oom_failed is not None:
+            oom_failed.extend(failed[j] for j in failed_oom)
 
-    bt.logging.info(f'computed losses: {losses[:10]}...')
+    logger.info(f'computed batched losses: {losses[:10]}...')
 
     return losses
 
+def gen_packs(
+    batches: typing.List[torch.Tensor], max_pack_tokens: int
+) -> typing.List[typing.List[int]]:
+    """
+    Distribute sample indices over packs of at most max_pack_tokens tokens in
+    total (first fit, longest samples first). Samples that exceed
+    max_pack_tokens by themselves get a pack of their own.
+    Samples that are None are skipped.
+
+    Returns:
+        list: A list of lists of sample indices.
+    """
+    indices = [i for i, batch in enumerate(batches) if batch is not None]
+    indices.sort(key=lambda i: len(batches[i][0]), reverse=True)
+
+    packs = []
+    pack_sizes = []
+    for i in indices:
+        n_tokens = len(batches[i][0])
+        for i_pack, pack_size in enumerate(pack_sizes):
+            if pack_size + n_tokens <= max_pack_tokens:
+                packs[i_pack].append(i)
+                pack_sizes[i_pack] += n_tokens
+                break
+        else:
+            packs.append([i])
+            pack_sizes.append(n_tokens)
+    return packs
+
+def supports_packing(model) -> bool:
+    """
+    Check whether documents can be packed into one sequence for this model,
+    with attention isolated per document based on position_ids.
+    """
+    return getattr(model, '_supports_packed_sequences', False)
+
+def compute_losses_packed(
+    model, batches: typing.List[torch.Tensor], device: str, max_pack_tokens: int, logits_chunk_tokens: int = 0,
+    oom_failed: typing.Optional[typing.List[int]] = None
+) -> typing.List[float]:
+    """
+    Computes the summed loss per sample, packing multiple samples into a single
+    sequence. Each sample gets its own position_ids (restarting at 0), which the
+    model uses to isolate attention per sample (cu_seqlens for flash attention,
+    a block-diagonal causal mask otherwise). Predictions across sample boundaries
+    are not counted, so the losses are identical to compute_losses_regular()
+    (up to floating point differences between kernels for different shapes).
+    If evaluation of a pack fails (e.g. OOM), its samples are evaluated one by one.
+
+    Parameters:
+        model (torch.nn.Module): The model for which losses are to be computed.
+        batches (list): A list of [1, seq_len] token tensors (or None).
+        device (str): The device to use for computation (e.g., 'cpu', 'gpu').
+        max_pack_tokens (int): Maximum number of tokens per packed sequence.
+        logits_chunk_tokens (int): Evaluate lm_head and loss in chunks of this many positions, 0 to disable.
+        oom_failed (list): If specified, indices of samples that ran out of memory are appended.
+
+    Returns:
+        list: A list of summed losses for each batch.
+    """
+    model.to(device)
+    model.eval()
+
+    losses = [math.inf]*len(batches) # Use infinity to indicate failure
+    packs = gen_packs(batches, max_pack_tokens)
+    logger.info(f'evaluating {sum(len(p) for p in packs)} samples in {len(packs)} packs of at most {max_pack_tokens} tokens')
+    failed = []
+    with torch.no_grad():
+        for pack in packs:
+            inputs = None
+            position_ids = None
+            token_losses = None
+            try:
+                lengths = [len(batches[i][0]) for i in pack]
+                inputs = torch.cat([batches[i][0] for i in pack]).unsqueeze(0).to(device)
+                position_ids = torch.cat([torch.arange(n) for n in lengths]).unsqueeze(0).to(device)
+                token_losses = compute_token_losses(model, inputs, logits_chunk_tokens, position_ids=position_ids)[0]
+                # Targets of sample i are at offset+1..offset+n-1, predicted at offset..offset+n-2
+                offset = 0
+                for i, n_tokens in zip(pack, lengths):
+                    losses[i] = token_losses[offset:offset+n_tokens-1].sum().item()
+                    offset += n_tokens
+            except Exception as e:
+                logger.warning(f"Exception evaluating pack of {len(pack)} samples, will retry per sample: {e}")
+                failed.extend(pack)
+            del inputs
+            del position_ids
+            del token_losses
+
+    if len(failed):
+        free_memory()
+        failed_oom = []
+        failed_losses = compute_losses_regular(model, [batches[i] for i in failed], device, logits_chunk_tokens, oom_failed=failed_oom)
+        for i, loss in zip(failed, failed_losses):
+            losses[i] = loss
+        if oom_failed is not None:
+            oom_failed.extend(failed[j] for j in failed_oom)
+
+    logger.info(f'computed packed losses: {losses[:10]}...')
+
+    return losses
+
+def compute_losses_compiled(
+    model, batches: typing.List[torch.Tensor], device: str, logits_chunk_tokens: int = 0,
+    oom_failed: typing.Optional[typing.List[int]] = None, compile_cache_dir: typing.Optional[str] = None,
+    compile_mode: typing.Optional[str] = None
+) -> typing.List[float]:
+    """
+    Computes the summed loss per sample, one sample at a time, using a compiled
+    decoder forward (torch.compile; CUDA graphs on CUDA devices). Samples are
+    right-padded to length buckets, so only a few shapes are compiled; causal
+    attention keeps the padding from affecting the sample positions, which are
+    the only ones counted. The lm_head and loss are evaluated eagerly.
+    Falls back to compute_losses_regular() if the model is not supported, and
+    for the remaining samples when evaluation fails for other reasons than OOM.
+
+    Parameters:
+        model (torch.nn.Module): The model for which losses are to be computed.
+        batches (list): A list of [1, seq_len] token tensors (or None).
+        device (str): The device to use for computation (e.g., 'cpu', 'gpu').
+        logits_chunk_tokens (int): Evaluate lm_head and loss in chunks of this many positions, 0 to disable.
+        oom_failed (list): If specified, indices of samples that ran out of memory are appended.
+        compile_cache_dir (str): If set, compiled artifacts are cached in a subdirectory per model
+            geometry, and reused by later compilations of models with the same geometry.
+        compile_mode (str): torch.compile() mode, None for the default of the device.
+
+    Returns:
+        list: A list of summed losses for each batch.
+    """
+    decoder, lm_head = get_decoder_and_head(model)
+    if lm_head is None:
+        logger.warning(f"Compiled evaluation not supported for {type(model).__name__}")
+        return compute_losses_regular(model, batches, device, logits_chunk_tokens, oom_failed=oom_failed)
+
+    model.to(device)
+    model.eval()
+
+    lengths = [len(batch[0]) for batch in batches if batch is not None]
+    n_buckets = len(set(get_length_bucket(n) for n in lengths))
+    cache_context = contextlib.nullcontext()
+    if compile_cache_dir is not None:
+        cache_context = compile_cache(get_compile_cache_dir(compile_cache_dir, get_model_geometry(model, device)))
+    forward = compile_decoder(decoder, device, n_buckets, mode=compile_mode)
+    logger.info(f'evaluating {len(lengths)} samples with compiled forward, {n_buckets} length buckets')
+
+    losses = [math.inf]*len(batches) # Use infinity to indicate failure
+    failed = []
+    with torch.no_grad(), cache_context:
+        for i, batch in enumerate(batches):
+            if batch is None:
+                continue
+            inputs = None
+            hidden_states = None
+            oom = False
+            try:
+                length = len(batch[0])
+                inputs = torch.zeros((1, get_length_bucket(length)), dtype=batch.dtype)
+                inputs[0, :length] = batch[0]
+                inputs = inputs.to(device)
+                hidden_states = forward(inputs)
+                losses[i] = chunked_cross_entropy(
+                    hidden_states[0, :length-1, :],
+                    lm_head,
+                    inputs[0, 1:length],
+                    logits_chunk_tokens or length
+                ).item()
+            except Exception as e:
+                if is_oom_error(e):
+                    logger.warning(f"Out of memory evaluating sample {i} of length {len(batch[0])}")
+                    oom = True
+                    if oom_failed is not None:
+                        oom_failed.append(i)
+                else:
+                    # Most likely compilation failed; don't retry it for every sample
+                    failed = [j for j in range(i, len(batches)) if batches[j] is not None]
+                    logger.warning(f"Exception in compiled evaluation of sample {i}, evaluating {len(failed)} samples uncompiled: {e}")
+            finally:
+                del inputs
+                del hidden_states
+            if oom:
+                free_memory()
+            if len(failed):
+                break
+    reset_compiled()
+
+    if len(failed):
+        free_memory()
+        failed_oom = []
+        failed_losses = compute_losses_regular(model, [batches[i] for i in failed], device, logits_chunk_tokens, oom_failed=failed_oom)
+        for i, loss in zip(failed, failed_losses):
+            losses[i] = loss
+        if oom_failed is not None:
+            oom_failed.extend(failed[j] for j in failed_oom)
+
+    logger.info(f'computed compiled losses: {losses[:10]}...')
+
+    return losses
+
+def compute_losses_unsliced(
+    model, batches: typing.List[torch.Tensor], device: str,
+    max_batch_tokens: int = 0, max_pack_tokens: int = 0, logits_chunk_tokens: int = 0,
+    oom_failed: typing.Optional[typing.List[int]] = None, compile_eval: bool = False,
+    compile_cache_dir: typing.Optional[str] = None
+) -> typing.List[float]:
+    if compile_eval:
+        return compute_losses_compiled(model,batches,device,logits_chunk_tokens,oom_failed=oom_failed,compile_cache_dir=compile_cache_dir)
+    if max_pack_tokens and supports_packing(model):
+        return compute_losses_packed(model,batches,device,max_pack_tokens,logits_chunk_tokens,oom_failed=oom_failed)
+    if max_batch_tokens:
+        return compute_losses_batched(model,batches,device,max_batch_tokens,logits_chunk_tokens,oom_failed=oom_failed)
+    return compute_losses_regular(model,batches,device,logits_chunk_tokens,oom_failed=oom_failed)
+
+def recover_oom_losses(
+    model, allow_sliced: bool, batches: typing.List[torch.Tensor], losses: typing.List[float],
+    failed: typing.List[int], device: str, config: dict, sliced_kwargs: typing.Optional[dict] = None
+) -> dict:
+    """
+    Re-evaluate samples that ran out of memory, updating losses in place.
+    First retry with chunked logits (if not enabled yet), then sliced,
+    doubling the number of slices until all samples are evaluated or each
+    slice is a single layer.
+
+    Parameters:
+        failed (list): Indices of the samples to re-evaluate.
+        config (dict): Settings used so far: logits_chunk_tokens, n_slices (None if not sliced).
+        sliced_kwargs (dict): Other arguments for compute_losses_sliced().
+
+    Returns:
+        dict: Settings that were needed to evaluate the samples.
+    """
+    sliced_kwargs = sliced_kwargs or {}
+    config = dict(config)
+    logger.info(f'recovering {len(failed)} samples that ran out of memory, settings so far: {config}')
+
+    if not config['logits_chunk_tokens'] and config['n_slices'] is None and get_decoder_and_head(model)[1] is not None:
+        config['logits_chunk_tokens'] = constants.EVAL_OOM_LOGITS_CHUNK_TOKENS
+        free_memory()
+        failed_oom = []
+        retry_losses = compute_losses_regular(model, [batches[i] for i in failed], device, config['logits_chunk_tokens'], oom_failed=failed_oom)
+        for i, loss in zip(failed, retry_losses):
+            losses[i] = loss
+        failed = [failed[j] for j in failed_oom]
+
+    n_layers = getattr(model.config, 'num_hidden_layers', 1)
+    if len(failed) and allow_sliced and hasattr(model, 'sliced'):
+        # Sliced evaluation needs the full model in CPU RAM
+        model.to('cpu')
+        free_memory()
+        # Start at the number of slices that was needed before
+        n_slices = max(config['n_slices'] or 2, 2)
+        while len(failed):
+            n_slices = min(n_slices, n_layers)
+            config['n_slices'] = max(config['n_slices'] or 0, n_slices)
+            logger.info(f'retrying {len(failed)} samples with {n_slices}-sliced eval')
+            failed_oom = []
+            with preserve_weights(model):
+                retry_losses = compute_losses_sliced(model, [batches[i] for i in failed], device, n_slices=n_slices, logits_chunk_tokens=config['logits_chunk_tokens'], oom_failed=failed_oom, **sliced_kwargs)
+            free_memory()
+            for i, loss in zip(failed, retry_losses):
+                losses[i] = loss
+            failed = [failed[j] for j in failed_oom]
+            if n_slices >= n_layers:
+                break
+            n_slices *= 2
+
+    if len(failed):
+        logger.warning(f'failed to recover {len(failed)} samples')
+    return config
+
 def compute_losses(
-    model, allow_sliced: bool, batches: typing.List[torch.Tensor], device: str
+    model, allow_sliced: bool, batches: typing.List[torch.Tensor], device: str,
+    max_batch_tokens: int = 0, max_pack_tokens: int = 0, logits_chunk_tokens: int = 0,
+    early_stop: typing.Optional[typing.Callable] = None, early_stop_groups: int = 0,
+    stream_slices: bool = False, state_store: str = 'device', state_store_path: typing.Optional[str] = None,
+    slice_memory_fraction: float = 0.9, slice_schedule: str = 'slice',
+    compile_eval: bool = False, compile_cache_dir: typing.Optional[str] = None
 ) -> typing.List[float]:
     """
     Computes the losses for a given model on provided batches.
@@ -166,12 +756,38 @@ def compute_losses(
         model (torch.nn.Module): The model for which losses are to be computed.
         batches (dict): A list of batches.
         device (str): The device to use for computation (e.g., 'cpu', 'gpu').
+        max_batch_tokens (int): If non-zero, evaluate length-bucketed batches of
+            at most this many (padded) tokens at once, instead of one by one.
+        max_pack_tokens (int): If non-zero and supported by the model, evaluate
+            samples packed into sequences of at most this many tokens. Takes
+            precedence over max_batch_tokens.
+        logits_chunk_tokens (int): If non-zero, evaluate lm_head and loss in chunks
+            of this many positions, instead of materializing all logits at once.
+        early_stop (callable): If set, evaluate samples in early_stop_groups interleaved
+            groups, calling early_stop(losses, evaluated_indices) after each group.
+            Evaluation stops when it returns True; losses of skipped samples are nan.
+            Not applicable to sliced evaluation.
+        early_stop_groups (int): Number of sample groups for early stopping.
+        stream_slices (bool): In sliced evaluation, copy the next slice to the
+            device while evaluating the current one.
+        state_store (str): In sliced evaluation, keep hidden states between slices
+            on the 'device', 'host' (pinned CPU memory) or 'disk'.
+        state_store_path (str): Directory for hidden states stored on disk.
+        slice_memory_fraction (float): Fraction of the free device memory that the
+            slice planner may use; the model is sliced if it doesn't fit.
+        slice_schedule (str): In sliced evaluation, take all samples through each slice
+            in turn ('slice'), groups of samples through all slices ('group'), or
+            choose the schedule moving fewer bytes ('auto').
+        compile_eval (bool): Evaluate unsliced models with a compiled forward, samples
+            padded to length buckets. Takes precedence over batching and packing.
+        compile_cache_dir (str): Directory for compiled artifacts, shared across models
+            of the same geometry (None to use inductor's default cache).
 
     Returns:
         list: A list of losses for each batch.
     """
-    bt.logging.info(f"Evaluating model type {type(model).__name__}")
-    bt.logging.debug(f"Model: {model}")
+    logger.info(f"Evaluating model type {type(model).__name__}")
+    logger.debug(f"Model: {model}")
 
     # Set to non-zero to compare sliced vs regular loss calculation
     test_sliced_eval = None
@@ -179,29 +795,115 @@ def compute_losses(
     regular_losses = None
     sliced_losses = None
     n_slices = test_sliced_eval
-    if allow_sliced and hasattr(model,'sliced'):
-        model_bytes = model.num_parameters()*model.dtype.itemsize
-        gpu_ram = torch.cuda.get_device_properties(device).total_memory
-        # The fraction below is somewhat arbitrary. The precise amount of ram
-        # needed depends on many factors. TODO.
-        arbitrary_fraction = 0.65
-        use_gpu_ram = int(arbitrary_fraction * gpu_ram)
-        if model_bytes > use_gpu_ram:
-            # This assumes all slices are created equal, which isn't true.
-            n_slices = (model_bytes+use_gpu_ram)//use_gpu_ram
-
-    if n_slices is None or test_sliced_eval:
-        regular_losses = compute_losses_regular(model,batches,device)
+    start_layers = None
+    state_budget = None
+    resident_slices = 1
+    budget = None
+    if allow_sliced and hasattr(model,'sliced') and not test_sliced_eval:
+        free_memory()
+        budget = get_device_budget(device, slice_memory_fraction)
+        if budget is not None:
+            start_layers = plan_slices(
+                    model,
+                    batches,
+                    budget,
+                    logits_chunk_tokens=logits_chunk_tokens,
+                    stream_slices=stream_slices,
+                    state_store=state_store,
+                    batch_tokens=max(max_batch_tokens, max_pack_tokens),
+                    schedule=slice_schedule,
+            )
+            if start_layers is None:
+                # Estimates say even single layers don't fit; try anyway, OOM is handled per sample
+                start_layers = list(range(model.config.num_hidden_layers))
+                logger.warning(f"No slice plan fits in {budget} bytes of device memory, using one layer per slice")
+            if len(start_layers) == 1 and not is_lazy_model(model):
+                # Model fits on the device, no need to slice
+                start_layers = None
+            else:
+                n_slices = len(start_layers)
+                logger.info(f"Planned {n_slices} slices within {budget} bytes of device memory: start layers {start_layers}")
+                if slice_schedule != 'slice':
+                    state_budget = get_state_budget(model, batches, start_layers, budget, logits_chunk_tokens, stream_slices)
+                    # Slices kept on the device between sample groups take from the memory for states
+                    resident_slices, state_budget = plan_resident_slices(model, batches, start_layers, state_budget)
+
+    if is_lazy_model(model):
+        # Weights are only loaded per slice, so evaluation has to be sliced
+        n_slices = n_slices or 1
+
+    # Start with the settings that were needed before for this model geometry
+    geometry = get_model_geometry(model, device)
+    remembered = eval_configs.get(geometry, None)
+    if remembered is not None:
+        logger.info(f"Using evaluation settings remembered for this model geometry: {remembered}")
+        logits_chunk_tokens = logits_chunk_tokens or remembered['logits_chunk_tokens']
+        if remembered['n_slices'] is not None and allow_sliced and hasattr(model,'sliced') and not test_sliced_eval:
+            if remembered['n_slices'] > (n_slices or 0):
+                # The plan was too optimistic before; split evenly into more slices
+                n_slices = remembered['n_slices']
+                start_layers = None
+                state_budget = None
+                resident_slices = 1
+                if budget is not None and slice_schedule != 'slice':
+                    # Plan the memory for states and resident slices for the even split
+                    even_layers = SlicedModelWrapper.gen_start_layers(model.config.num_hidden_layers, n_slices)
+                    state_budget = get_state_budget(model, batches, even_layers, budget, logits_chunk_tokens, stream_slices)
+                    resident_slices, state_budget = plan_resident_slices(model, batches, even_layers, state_budget)
+    config = dict(logits_chunk_tokens=logits_chunk_tokens, n_slices=None)
+    sliced_kwargs = dict(
+            stream_slices=stream_slices,
+            state_store=state_store,
+            state_store_path=state_store_path,
+            schedule=slice_schedule,
+            state_budget=state_budget,
+            resident_slices=resident_slices,
+    )
+
+    if n_slices is None and early_stop is not None and early_stop_groups > 1:
+        # Evaluate in groups of samples, check whether to continue after each group
+        regular_losses = [math.nan]*len(batches)
+        evaluated = []
+        for group in gen_sample_groups(len(batches), early_stop_groups):
+            group_batches = [batches[i] for i in group]
+            group_oom = []
+            group_losses = compute_losses_unsliced(model,group_batches,device,max_batch_tokens,max_pack_tokens,config['logits_chunk_tokens'],oom_failed=group_oom,compile_eval=compile_eval,compile_cache_dir=compile_cache_dir)
+            if len(group_oom):
+                config = recover_oom_losses(model,allow_sliced,group_batches,group_losses,group_oom,device,config,sliced_kwargs)
+            for i, loss in zip(group, group_losses):
+                regular_losses[i] = loss
+            evaluated.extend(group)
+            if len(evaluated) < len(batches) and early_stop(regular_losses, sorted(evaluated)):
+                logger.info(f'stopping evaluation early, skipped {len(batches)-len(evaluated)} of {len(batches)} samples')
+                break
+    elif n_slices is None or test_sliced_eval:
+        oom_failed = []
+        regular_losses = compute_losses_unsliced(model,batches,device,max_batch_tokens,max_pack_tokens,logits_chunk_tokens,oom_failed=oom_failed,compile_eval=compile_eval,compile_cache_dir=compile_cache_dir)
+        if len(oom_failed) and not test_sliced_eval:
+            config = recover_oom_losses(model,allow_sliced,batches,regular_losses,oom_failed,device,config,sliced_kwargs)
 
     if n_slices is not None:
-        bt.logging.info(f"Performing {n_slices}-sliced eval: model ({model_bytes}) > {arbitrary_fraction} * gpu ram ({gpu_ram})")
-        sliced_losses = compute_losses_sliced(model,batches,device,n_slices=n_slices)
+        logger.info(f"Performing {n_slices}-sliced eval, start layers {start_layers}")
+        sliced_oom = []
+        sliced_losses = compute_losses_sliced(model,batches,device,n_slices=n_slices,start_layers=start_layers,logits_chunk_tokens=logits_chunk_tokens,oom_failed=sliced_oom,**sliced_kwargs)
+        n_layers = getattr(model.config, 'num_hidden_layers', 1)
+        if len(sliced_oom) and n_slices < n_layers and not test_sliced_eval:
+            # Slicing strips the model, so samples can't be evaluated again in this
+            # step (keeping the weights would double peak RAM); use more slices next time.
+            # Other failures (e.g. bad weights) don't need more slices.
+            config['n_slices'] = min(2*n_slices, n_layers)
+            logger.warning(f"{len(sliced_oom)} samples ran out of memory in {n_slices}-sliced eval, will use {config['n_slices']} slices next time")
+
+    if config['n_slices'] is not None or config['logits_chunk_tokens'] != logits_chunk_tokens:
+        if remembered != config:
+            logger.info(f"Remembering evaluation settings for this model geometry: {config}")
+            eval_configs[geometry] = config
 
     if regular_losses and sliced_losses:
         equal = sliced_losses==regular_losses
         nanequal = naninf_equal(sliced_losses,regular_losses)
         nanclose = naninf_close(sliced_losses,regular_losses)
-        bt.logging.info(f'sliced losses == regular losses: {equal} / {nanequal} / {nanclose}')
+        logger.info(f'sliced losses == regular losses: {equal} / {nanequal} / {nanclose}')
 
     if regular_losses:
         return regular_losses
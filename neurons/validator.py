@@ -57,11 +57,13 @@ import dataset
 import validation
 from model import model_utils, competitions
 from model.data import ModelId, ModelMetadata
+from model.loader import get_checkpoint_bytes
 from model.model_updater import ModelUpdater
 from model.storage.disk.disk_model_store import DiskModelStore
 from model.storage.hugging_face.hugging_face_model_store import HuggingFaceModelStore
 from model.storage.disk import utils as disk_utils
 from neurons import config
+from neurons.eval_worker import Container, ModelIssue, check_and_compute_losses, describe_remote_eval
 import traceback
 import threading
 import multiprocessing
@@ -70,6 +72,9 @@ from rich.console import Console
 
 import bittensor as bt
 from utilities import utils, btlite
+from utilities.shared_samples import SharedSamples
+from utilities.eval_coordinator import SECRET_ENV_VAR, EvalCoordinator
+from utilities.eval_scheduler import EvalScheduler, EvalTask
 from utilities.perf_monitor import PerfMonitor
 from utilities.mathutils import *
 
@@ -84,16 +89,6 @@ PRIO_REVISIT    = 20
 
 os.environ["TOKENIZERS_PARALLELISM"] = "true"
 
-class Container:
-    '''Empty container object'''
-    pass
-
-class ModelIssue(Exception):
-    '''
-    Exception class to signal issues with models preventing evaluation.
-    '''
-    pass
-
 class Validator:
     STATE_FILENAME = "validator_state.json"
     BENCHMARK_FILENAME = "benchmark.json"
@@ -221,6 +216,35 @@ class Validator:
         # Create a metagraph lock to avoid cross thread access issues in the update and clean loop.
         self.metagraph_lock = threading.RLock()
 
+        # Evaluation on other hosts, if enabled
+        eval_coordinator = None
+        if self.config.eval_coordinator_port is not None:
+            secret = os.environ.get(SECRET_ENV_VAR, None)
+            if not secret:
+                bt.logging.error(f"Please set the evaluation coordinator secret in environment variable {SECRET_ENV_VAR}")
+                sys.exit(-1)
+            eval_coordinator = EvalCoordinator(
+                self.config.eval_coordinator_host,
+                self.config.eval_coordinator_port,
+                secret,
+                exception_types=[ModelIssue],
+            )
+
+        # Long-lived worker processes for model evaluation, one per device, started
+        # early so that start-up overlaps with fetching the initial state from chain.
+        self.eval_scheduler = EvalScheduler(
+            self.config.eval_devices or [self.config.device],
+            mode="spawn",
+            max_tasks=constants.EVAL_WORKER_MAX_TASKS,
+            name="eval",
+            main_module=check_and_compute_losses.__module__,
+            remote=eval_coordinator,
+            n_remote=self.config.eval_remote_slots,
+        )
+
+        # Content hashes of model snapshot directories: path -> (newest mtime, hash)
+        self.content_hashes = {}
+
         # Initialize the update thread
         self.stop_event = threading.Event()
         bt.logging.trace("Starting update thread")
@@ -232,6 +256,8 @@ class Validator:
         if hasattr(self, "stop_event"):
             self.stop_event.set()
             self.update_thread.join()
+        if hasattr(self, "eval_scheduler"):
+            self.eval_scheduler.shutdown()
 
     def new_wandb_run(self):
         """Creates a new wandb run to save information to."""
@@ -530,6 +556,7 @@ class Validator:
         while not self.stop_event.is_set():
             try:
                 self.clean_models()
+                self.clean_content_hashes()
             except Exception as e:
                 bt.logging.error(f"Error cleaning models: {e}, {traceback.format_exc()}")
 
@@ -593,6 +620,12 @@ class Validator:
             gb_to_delete=state['gb_to_delete'],
         )
 
+    def clean_content_hashes(self):
+        """Forget content hashes of model directories that no longer exist."""
+        for path in list(self.content_hashes.keys()):
+            if not os.path.isdir(path):
+                self.content_hashes.pop(path, None)
+
     async def try_set_weights(self, ttl: int):
         """Sets the weights on the chain with ttl, without raising exceptions if it times out."""
         if self.last_weights_set is not None and time.time() - self.last_weights_set < constants.WEIGHT_SET_MIN_INTERVAL:
@@ -831,6 +864,8 @@ class Validator:
             batches_max_token_id = max(
                 [max(b[0]) for b in batches if b is not None]
             )
+        # Written once, so that passing samples to the evaluation worker doesn't copy them
+        shared_batches = None if batches is None else SharedSamples.create(batches)
 
 
         # Compute model losses on batches.
@@ -840,19 +875,141 @@ class Validator:
         model_geometry_per_uid = {uid: {} for uid in uids_pool}
         uid_to_label = {uid: '' for uid in uids_pool}
         uid_to_block = {uid: 1<<31 for uid in uids_pool}
+        n_skipped_per_uid = {uid: 0 for uid in uids_pool}
+        duplicate_of = {uid: None for uid in uids_pool}
+        # Content hash -> uid of the model evaluated for it in this step
+        uid_by_content_hash = {}
+        # uids whose losses are final
+        finished = set()
         n_evaluated = 0
+        n_eval_devices = len(self.eval_scheduler)
+        early_stop_groups = cinfo.get('eval_early_stop_groups', constants.EVAL_EARLY_STOP_GROUPS)
+
+        def make_eval_func(uid, device, next_uid):
+            metadata, samples, max_token_id = eval_inputs[uid]
+            # Let the worker load the next model while evaluating this one
+            next_metadata = None
+            if not self.config.no_model_prefetch and next_uid is not None:
+                next_metadata = eval_inputs[next_uid][0]
+
+            # Models new to the pool (evaluated after the pool models) may stop
+            # early, once it is clear they can not make it into the pool. Only
+            # models evaluated so far count; with several devices these may be
+            # fewer than all preceding models, which makes stopping less likely.
+            early_stop = None
+            if early_stop_groups > 1 and uid not in cur_pool:
+                others = [other for other in uids_pool if other in finished and other != uid]
+                early_stop = dict(
+                    uid=uid,
+                    losses_per_uid={other: losses_per_uid[other] for other in others},
+                    uid_to_block={other: uid_to_block[other] for other in others + [uid]},
+                    pool_size=pool_size,
+                    current_block=self.current_block,
+                    advantage_initial=cinfo.get('advantage_initial', constants.advantage_initial),
+                    advantage_decay_per_epoch=cinfo.get('advantage_decay', constants.advantage_decay_per_epoch),
+                )
+
+            if device is None:
+                # Remote worker: the evaluation is described as data
+                return describe_remote_eval(
+                    metadata,
+                    cname,
+                    cinfo,
+                    batches=samples,
+                    max_token_id=max_token_id,
+                    early_stop=early_stop,
+                )
+            return functools.partial(
+                check_and_compute_losses,
+                local_store=self.local_store,
+                metadata=metadata,
+                competition_info=cinfo,
+                batches=samples,
+                max_token_id=max_token_id,
+                device=device,
+                # Each worker has its own cache
+                model_cache_bytes=int(self.config.model_cache_gb*1e9/n_eval_devices),
+                model_cache_pin=self.config.model_cache_pin,
+                prefetch_metadata=next_metadata,
+                early_stop=early_stop,
+            )
+
+        def on_result(task, eval_results, e):
+            nonlocal n_evaluated
+            uid = task.key
+            if e is None:
+                losses = eval_results['losses']
+                losses_pt = eval_results['losses_pt']
+                n_evaluated += 1
+
+                losses_per_uid[uid] = losses
+                losses_pt_per_uid[uid] = losses_pt
+                avg_sample_len_per_uid[uid] = eval_results['avg_sample_length']
+                model_geometry_per_uid[uid] = eval_results['model_geometry']
+                n_skipped_per_uid[uid] = eval_results['n_skipped']
+                bt.logging.debug(f"Losses for uid:{uid}, per token: {naninf_mean(losses_pt):.03f} +- {naninf_std(losses_pt):.03f}, sum {naninf_mean(losses):.01f} +- {naninf_std(losses):.01f}, avg sample len: {eval_results['avg_sample_length']:.01f}")
+            elif isinstance(e, ModelIssue):
+                bt.logging.info(
+                    f'Model issue for uid {uid}, disqualifying: {e}'
+                )
+            else:
+                bt.logging.error(
+                    f"Error in eval loop: {e}. Setting losses for uid: {uid} to infinity.\n{''.join(traceback.format_exception(type(e), e, e.__traceback__))}"
+                )
+                if transformers.__version__ != TRANSFORMERS_VERSION_OPTIMAL:
+                    bt.logging.error(f'Please run with transformers version {TRANSFORMERS_VERSION_OPTIMAL} (currently running {transformers.__version__}) before reporting issues.')
+            finished.add(uid)
+
+            dup_uids = [dup_uid for dup_uid, orig_uid in duplicate_of.items() if orig_uid == uid]
+            if len(dup_uids) == 0:
+                return None
+            new_uid = validation.duplicate_to_evaluate(
+                n_skipped_per_uid[uid],
+                e is None or isinstance(e, ModelIssue),
+                dup_uids,
+                cur_pool,
+                uid_to_block,
+            )
+            if new_uid is None:
+                # Identical models fail or succeed alike
+                for dup_uid in dup_uids:
+                    losses_per_uid[dup_uid] = losses_per_uid[uid].copy()
+                    losses_pt_per_uid[dup_uid] = losses_pt_per_uid[uid].copy()
+                    avg_sample_len_per_uid[dup_uid] = avg_sample_len_per_uid[uid]
+                    model_geometry_per_uid[dup_uid] = model_geometry_per_uid[uid]
+                    n_skipped_per_uid[dup_uid] = n_skipped_per_uid[uid]
+                    finished.add(dup_uid)
+                return None
+
+            # Stopped early, or not the model's fault (e.g. a timeout or a lost
+            # worker); evaluate a duplicate instead
+            bt.logging.info(f"Evaluating uid {new_uid} instead of identical uid {uid}")
+            duplicate_of[new_uid] = None
+            for dup_uid in dup_uids:
+                if dup_uid != new_uid:
+                    duplicate_of[dup_uid] = new_uid
+            return [dup_tasks.pop(new_uid)]
+
+        # uid -> (metadata, samples, max token id) of models to evaluate
+        eval_inputs = {}
+        # Samples of models with their own tokenizer, to be removed after evaluation
+        mdl_shared_batches = []
+        tasks = []
+        # uid -> task of duplicate models, run only if the original fails for other reasons than the model
+        dup_tasks = {}
         for uid in uids_pool:
             if ts_expire is not None and time.time() > ts_expire:
                 bt.logging.warning("Model eval loop taking too long, stopping loop")
                 break
 
-            bt.logging.trace(f"Computing model losses for uid {uid}.")
+            bt.logging.trace(f"Preparing evaluation of uid {uid}.")
             metadata = self.get_uid_metadata(uid)
 
             losses_per_uid[uid] = [math.inf]*n_batches
             losses_pt_per_uid[uid] = losses_per_uid[uid].copy()
             if metadata is None:
                 bt.logging.debug(f"Unable to load metadata for {uid}. Setting loss to infinity.")
+                finished.add(uid)
                 continue
             try:
                 uid_to_block[uid] = metadata.block if metadata.block is not None else 1<<31
@@ -896,42 +1053,74 @@ class Validator:
                     # We should never arrive here
                     raise Exception("No tokenizer available (no default and not supplied in model)")
 
-
-                eval_results = utils.run_in_subprocess(
-                    functools.partial(
-                        check_and_compute_losses,
-                        local_store=self.local_store,
-                        metadata=metadata,
-                        competition_info=cinfo,
-                        batches=mdl_batches,
-                        max_token_id=max_token_id,
-                        device=self.config.device,
-                    ),
+                # Byte-identical models (including tokenizer) have identical losses; copy them
+                # instead of evaluating again. compute_wins() will treat the copy like any
+                # other model at its own block, i.e. it can only win if the original can't.
+                content_hash = None
+                try:
+                    content_hash = self.get_content_hash(model_path)
+                except Exception as e:
+                    bt.logging.warning(f"Failed to compute content hash of {model_path}: {e}")
+                # Remote workers identify models by their contents
+                metadata.content_hash = content_hash
+                orig_uid = uid_by_content_hash.get(content_hash, None)
+                if orig_uid is not None:
+                    bt.logging.info(f"Model of uid {uid} is identical to model of uid {orig_uid}, using its losses")
+                    duplicate_of[uid] = orig_uid
+                    # Identical tokenizer, so identical samples
+                    _, samples, max_token_id = eval_inputs[orig_uid]
+                else:
+                    if content_hash is not None:
+                        uid_by_content_hash[content_hash] = uid
+                    if mdl_batches is batches:
+                        samples = shared_batches
+                    else:
+                        samples = SharedSamples.create(mdl_batches)
+                        mdl_shared_batches.append(samples)
+                eval_inputs[uid] = (metadata, samples, max_token_id)
+
+                # Evaluation time scales with model size and number of tokens
+                try:
+                    model_bytes = get_checkpoint_bytes(model_path)
+                except Exception:
+                    model_bytes = 0
+                n_tokens = sum(b.shape[-1] for b in mdl_batches if b is not None)
+                task = EvalTask(
+                    key=uid,
+                    make_func=functools.partial(make_eval_func, uid),
+                    cost=model_bytes*n_tokens,
+                    # Pool models first, so that new models can stop early
+                    group=0 if uid in cur_pool else 1,
                     ttl=constants.TTL_MODEL_EVAL,
-                    mode="spawn",
                     expected_errors={"ModelIssue"},
+                    # Remote workers download models from chain metadata
+                    remote=metadata.path is None and content_hash is not None,
                 )
-
-                losses = eval_results['losses']
-                losses_pt = eval_results['losses_pt']
-                n_evaluated += 1
-
-                losses_per_uid[uid] = losses
-                losses_pt_per_uid[uid] = losses_pt
-                avg_sample_len_per_uid[uid] = eval_results['avg_sample_length']
-                model_geometry_per_uid[uid] = eval_results['model_geometry']
-                bt.logging.debug(f"Losses for uid:{uid}, per token: {naninf_mean(losses_pt):.03f} +- {naninf_std(losses_pt):.03f}, sum {naninf_mean(losses):.01f} +- {naninf_std(losses):.01f}, avg sample len: {eval_results['avg_sample_length']:.01f}")
+                if orig_uid is None:
+                    tasks.append(task)
+                else:
+                    dup_tasks[uid] = task
 
             except ModelIssue as e:
                 bt.logging.info(
                     f'Model issue for uid {uid}, disqualifying: {e}'
                 )
+                finished.add(uid)
             except Exception as e:
                 bt.logging.error(
                     f"Error in eval loop: {e}. Setting losses for uid: {uid} to infinity.\n{traceback.format_exc()}"
                 )
-                if transformers.__version__ != TRANSFORMERS_VERSION_OPTIMAL:
-                    bt.logging.error(f'Please run with transformers version {TRANSFORMERS_VERSION_OPTIMAL} (currently running {transformers.__version__}) before reporting issues.')
+                finished.add(uid)
+
+        try:
+            not_started = self.eval_scheduler.run(tasks, on_result, deadline=ts_expire)
+        finally:
+            for samples in mdl_shared_batches:
+                samples.close()
+            if shared_batches is not None:
+                shared_batches.close()
+        if len(not_started):
+            bt.logging.warning(f"Model eval loop taking too long, not evaluated: {[task.key for task in not_started]}")
 
         win_info = validation.compute_wins(
                 losses_per_uid,
@@ -1005,6 +1194,8 @@ class Validator:
                 "losses": losses_per_uid[uid],
                 "n_samples": naninf_count(losses_per_uid[uid]),
                 "n_inf": np.sum(np.isinf(losses_per_uid[uid])),
+                "n_skipped": n_skipped_per_uid[uid],
+                "duplicate_of": duplicate_of[uid],
                 "avg_sample_len": avg_sample_len_per_uid[uid],
                 "loss_pt_avg": naninf_mean(losses_pt_per_uid[uid]),
                 "loss_pt_std": naninf_std(losses_pt_per_uid[uid]),
@@ -1025,6 +1216,20 @@ class Validator:
             else:
                 return None
 
+    def get_content_hash(self, path):
+        """
+        Return hash of the contents of the model directory at path, which is
+        identical for byte-identical models, independent of hotkey. Hashes are
+        cached until files under path are modified.
+        """
+        newest = disk_utils.get_newest_datetime_under_path(path)
+        cached = self.content_hashes.get(path, None)
+        if cached is not None and cached[0] == newest:
+            return cached[1]
+        content_hash = disk_utils.get_hash_of_directory(path)
+        self.content_hashes[path] = (newest, content_hash)
+        return content_hash
+
     def get_uid_metadata(self, uid):
         metadata = None
         if uid in self.benchmark_cfg:
@@ -1193,6 +1398,11 @@ class Validator:
             self.update_thread.join()
         except Exception as e:
             print(f'exception trying to stop update_thread: {e}')
+        try:
+            bt.logging.info("stopping eval workers")
+            self.eval_scheduler.shutdown()
+        except Exception as e:
+            bt.logging.warning(f"exception trying to stop eval workers: {e}")
         sys.exit(-1)
 
     async def run(self):
@@ -1220,54 +1430,6 @@ class Validator:
                     f"Error in validator loop \n {e} \n {traceback.format_exc()}"
                 )
 
-def check_and_compute_losses(
-        local_store=None,
-        metadata=None,
-        competition_info=None,
-        batches=None,
-        max_token_id=None,
-        device=None,
-    ):
-    cinfo = competition_info
-    model_i = local_store.retrieve_model(metadata.hotkey, metadata.id, path=metadata.path)
-    mdl_allowed, reason = competitions.validate_model_constraints(model_i.pt_model, cinfo)
-    if not mdl_allowed:
-        raise ModelIssue(f"Model violates competition {cname} constraints: {reason}")
-    allow_sliced = False
-    model_type = type(model_i.pt_model).__name__
-    if 'Sliced' in model_type:
-        # Test the exact model type name to check whether slicing is allowed by config:
-        allow_sliced = model_type in cinfo['model_types']
-
-    embed_size = None
-    try:
-        embed_size = model_i.pt_model.model.embed_tokens.weight.shape[0]
-    except Exception as e:
-        # Currently supported models should have the queried parameter, but in case they don't, just skip this check.
-        bt.logging.warning(f'could not find embed size, skipping check: {e}')
-
-    if embed_size:
-        if max_token_id>=embed_size:
-            raise ModelIssue(f"Vocabulary size mismatch between tokenizer and model: {max_token_id} >= {embed_size}")
-    else:
-        embed_size = max_token_id
-
-    losses = validation.compute_losses(model_i.pt_model,allow_sliced,batches,device)
-    losses_pt = [loss_sum / len(batch[0]) if batch is not None else math.inf for loss_sum, batch in zip(losses, batches)]
-    sample_lengths = [len(batch[0]) for batch in batches if batch is not None]
-    avg_sample_length = 0 if len(sample_lengths) == 0 else np.mean(sample_lengths)
-
-    return {
-        'losses':losses,
-        'losses_pt':losses_pt,
-        'avg_sample_length':avg_sample_length,
-        'model_geometry':{
-            'n_parameters':model_i.pt_model.num_parameters(),
-            'n_layers':model_i.pt_model.config.num_hidden_layers,
-            'embed_size':embed_size,
-        },
-    }
-
 def assert_cuda():
     if transformers.utils.is_flash_attn_2_available():
         bt.logging.warning('Flash Attention 2 is available, according to transformers.')
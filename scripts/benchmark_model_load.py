@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+Tool to compare model loading using from_pretrained() and fast_load_model().
+Each load is performed in a fresh process, so that peak RSS numbers are meaningful.
+"""
+
+import os
+import sys
+import json
+import importlib
+import time
+import logging
+import argparse
+import subprocess
+
+args = None
+
+def load(method, path, device, dtype, attn=None):
+    """
+    Load model from path using method, return statistics.
+    """
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    # Register the vendored model types with transformers' Auto classes
+    for package in ['transformers_llama', 'transformers_phi', 'transformers_phi3']:
+        importlib.import_module(package)
+    from model.loader import fast_load_model, peak_rss
+
+    torch_dtype = getattr(torch, dtype)
+    rss_before = peak_rss()
+    t0 = time.time()
+    if method == 'fast':
+        model = fast_load_model(path, torch_dtype=torch_dtype, attn_implementation=attn, device=device)
+        if model is None:
+            raise Exception(f"fast_load_model() does not support model at {path}")
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            pretrained_model_name_or_path=path,
+            local_files_only=True,
+            use_safetensors=True,
+            torch_dtype=torch_dtype,
+            **({} if attn is None else dict(attn_implementation=attn)),
+        )
+        model.to(device)
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    t_load = time.time() - t0
+
+    return {
+        'method': method,
+        'model_type': type(model).__name__,
+        'n_parameters': model.num_parameters(),
+        'load_time': t_load,
+        'peak_rss_before': rss_before,
+        'peak_rss': peak_rss(),
+        'peak_gpu': torch.cuda.max_memory_allocated() if device.startswith('cuda') else 0,
+    }
+
+def arg_parser(argv):
+    parser = argparse.ArgumentParser(description='Benchmark model loading')
+    parser.add_argument('model',
+            help='Model directory to load')
+    parser.add_argument('--device', default='cpu',
+            help='Device to load model to')
+    parser.add_argument('--dtype', default='bfloat16', choices=['bfloat16','float16','float32'],
+            help='Select model datatype, bfloat16 is default')
+    parser.add_argument('--attn', default=None, choices=['sdpa','eager','flash_attention_2'],
+            help='Attention implementation to load the model with (the validator uses constants.EVAL_ATTN_IMPLEMENTATION), default of the model if not set')
+    parser.add_argument('--methods', default='from_pretrained,fast',
+            help='Comma separated list of methods to benchmark (from_pretrained, fast)')
+    parser.add_argument('--repeat', metavar='N', default=1, type=int,
+            help='Load model N times with each method')
+    parser.add_argument('--child', default=None,
+            help=argparse.SUPPRESS)
+
+    return parser.parse_args(argv)
+
+def main():
+    global args
+    args = arg_parser(sys.argv[1:])
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)-15s - %(message)s')
+
+    if args.child is not None:
+        # Perform a single load and report to parent
+        print(json.dumps(load(args.child, args.model, args.device, args.dtype, args.attn)))
+        return True
+
+    results = []
+    for i in range(args.repeat):
+        for method in args.methods.split(','):
+            cmd = [sys.executable, __file__, args.model, '--device', args.device, '--dtype', args.dtype, '--child', method]
+            if args.attn is not None:
+                cmd += ['--attn', args.attn]
+            out = subprocess.run(cmd, capture_output=True, text=True)
+            if out.returncode != 0:
+                logging.error(f'{method} failed:\n{out.stderr}')
+                continue
+            stats = json.loads(out.stdout.strip().split('\n')[-1])
+            results.append(stats)
+            logging.info(f"{method}: {stats['model_type']} ({stats['n_parameters']/1e9:.2f}B parameters) loaded in {stats['load_time']:.1f}s, peak RSS {stats['peak_rss']/1e9:.2f} GB (before loading {stats['peak_rss_before']/1e9:.2f} GB), peak GPU {stats['peak_gpu']/1e9:.2f} GB")
+
+    return len(results) > 0
+
+if __name__ == '__main__':
+    try:
+        if not main():
+            sys.exit(-1)
+        sys.exit(0)
+    except KeyboardInterrupt:
+        pass
@@ -133,14 +133,20 @@ def load_model(path, attn_implementation="flash_attention_2"):
     else:
         raise ValueError("Unkown datatype {args.dtype}")
 
-    logging.info(f"Loading model {path}, attn={attn_implementation}, dtype {args.dtype}")
-    model = AutoModelForCausalLM.from_pretrained(
-        pretrained_model_name_or_path=path,
-        local_files_only=True,
-        use_safetensors=True,
-        attn_implementation=attn_implementation,
-        torch_dtype=dtype
-    )
+    logging.info(f"Loading model {path}, attn={attn_implementation}, dtype {args.dtype}, lazy={args.lazy}")
+    if args.lazy:
+        from model.loader import lazy_load_model
+        model = lazy_load_model(path, torch_dtype=dtype, attn_implementation=attn_implementation)
+        if model is None:
+            raise ValueError(f"Lazy loading not supported for model at {path}")
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            pretrained_model_name_or_path=path,
+            local_files_only=True,
+            use_safetensors=True,
+            attn_implementation=attn_implementation,
+            torch_dtype=dtype
+        )
     try:
         tokenizer_obj = AutoTokenizer.from_pretrained(path)
         logging.info('loaded tokenizer from model path')
@@ -174,6 +180,24 @@ def arg_parser(argv):
             help='List of integers specifying layer starts for each slice (e.g. 0,4,8,12)')
     parser.add_argument('--auto-slice', metavar='N', default=None, type=int,
             help='Automatically slice model in N parts.')
+    parser.add_argument('--plan-memory', metavar='GB', default=None, type=float,
+            help='Plan (uneven) slices to fit in GB of device memory, 0 for 90%% of the free memory; overrides --start-layers and --auto-slice')
+    parser.add_argument('--logits-chunk-tokens', metavar='N', default=0, type=int,
+            help='Evaluate lm_head and loss of sliced model in chunks of N positions (0 to disable)')
+    parser.add_argument('--lazy', default=False, action='store_true',
+            help='Load weights of each slice from disk only when it is evaluated (skips regular evaluation)')
+    parser.add_argument('--stream-slices', default=False, action='store_true',
+            help='Copy the next slice to the device while evaluating the current one')
+    parser.add_argument('--state-store', default='device', choices=['device','host','disk'],
+            help='Where to keep hidden states between slices')
+    parser.add_argument('--state-store-path', default=None,
+            help='Directory for hidden states, with --state-store disk')
+    parser.add_argument('--schedule', default='slice', choices=['slice','group','auto'],
+            help='Take all samples through each slice in turn, groups of samples through all slices, or choose automatically')
+    parser.add_argument('--state-budget', metavar='MB', default=None, type=float,
+            help='Device memory for hidden states, bounding the size of sample groups')
+    parser.add_argument('--resident-slices', metavar='N', default=1, type=int,
+            help='Number of slices kept on the device between sample groups')
 
     args = parser.parse_args(argv)
 
@@ -227,15 +251,37 @@ def main():
     samples = load_samples()
     logging.debug(f'loaded {len(samples)} samples')
 
+    if args.plan_memory is not None:
+        from utilities.slice_planner import get_device_budget, plan_slices
+        budget = int(args.plan_memory*1e9) if args.plan_memory > 0 else get_device_budget(args.device, 0.9)
+        eval_samples = [sample[:, :args.max_sample_len] for sample in samples[:args.max_samples]]
+        start_layers = plan_slices(
+                model,
+                eval_samples,
+                budget,
+                logits_chunk_tokens=args.logits_chunk_tokens,
+                stream_slices=args.stream_slices,
+                state_store=args.state_store,
+        )
+        if start_layers is None:
+            logging.error(f'no slice plan fits in {budget} bytes')
+            sys.exit(1)
+        logging.info(f'planned slices within {budget} bytes: start layers {start_layers}')
+        args.auto_slice = None
+        args.start_layers = start_layers
+
     t_slicing = 0
     t_evaluating_sliced = 0
     with torch.no_grad():
-        t0 = time.time()
-        losses_regular = evaluate_losses(model,samples[:args.max_samples])
-        t_evaluating_regular = time.time() - t0
-        logging.debug(f'evaluated regularly in {t_evaluating_regular}s')
+        t_evaluating_regular = 0
+        losses_regular = None
+        if not args.lazy:
+            t0 = time.time()
+            losses_regular = evaluate_losses(model,samples[:args.max_samples])
+            t_evaluating_regular = time.time() - t0
+            logging.debug(f'evaluated regularly in {t_evaluating_regular}s')
 
-        logging.info(f'losses regular: sum={sum(losses_regular)}, {losses_regular[:20]}...')
+            logging.info(f'losses regular: sum={sum(losses_regular)}, {losses_regular[:20]}...')
 
         if hasattr(model,'sliced'):
             t0 = time.time()
@@ -244,6 +290,13 @@ def main():
                     start_layers=args.start_layers if args.auto_slice is None else None,
                     device=args.device,
                     max_sample_len=args.max_sample_len,
+                    logits_chunk_tokens=args.logits_chunk_tokens,
+                    stream_slices=args.stream_slices,
+                    state_store=args.state_store,
+                    state_store_path=args.state_store_path,
+                    schedule=args.schedule,
+                    state_budget=None if args.state_budget is None else int(args.state_budget*1e6),
+                    resident_slices=args.resident_slices,
             )
             t_slicing = time.time() - t0
             logging.info(f'sliced: {sliced}')
@@ -254,7 +307,8 @@ def main():
 
             # show loss sum and a few individual losses; should be identical regardless of slicing
             logging.info(f"losses sliced: sum={sum(losses_sliced)}, {losses_sliced[:20]}...")
-            logging.info(f"identical: {losses_regular==losses_sliced}")
+            if losses_regular is not None:
+                logging.info(f"identical: {losses_regular==losses_sliced}")
         else:
             logging.info(f"model doesn't support slicing!")
 
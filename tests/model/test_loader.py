@@ -0,0 +1,187 @@
+import os
+import tempfile
+import threading
+import unittest
+
+import torch
+from safetensors.torch import load_file, save_file
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from model.loader import ModelPrefetcher, fast_load_model, init_empty_weights, lazy_load_model, needs_lazy_load, readahead_model
+from model.model_cache import ModelCache
+from tests.model.test_model_cache import FakeLocalStore, get_model_id, get_tiny_model
+from tests.pretrain.test_validation import get_samples
+
+
+class TestFastLoadModel(unittest.TestCase):
+    def _check_equal(self, model, loaded):
+        self.assertEqual(type(model), type(loaded))
+        state = model.state_dict()
+        for name, tensor in loaded.state_dict().items():
+            self.assertEqual(tensor.dtype, torch.float32)
+            self.assertTrue(torch.equal(tensor, state[name]), name)
+        inputs = torch.randint(0, 128, (1, 20))
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(model(inputs).logits, loaded(inputs).logits))
+
+    def test_fast_load_model(self):
+        model = get_tiny_model()
+        with tempfile.TemporaryDirectory() as path:
+            model.save_pretrained(path, safe_serialization=True)
+            loaded = fast_load_model(path, torch_dtype=torch.float32, attn_implementation="eager")
+        self.assertFalse(any(p.device.type == 'meta' for p in loaded.parameters()))
+        self._check_equal(model, loaded)
+
+    def test_fast_load_model_tied(self):
+        model = get_tiny_model()
+        model.config.tie_word_embeddings = True
+        model.tie_weights()
+        with tempfile.TemporaryDirectory() as path:
+            model.save_pretrained(path, safe_serialization=True)
+            loaded = fast_load_model(path, torch_dtype=torch.float32, attn_implementation="eager")
+        self.assertIs(loaded.lm_head.weight, loaded.model.embed_tokens.weight)
+        self._check_equal(model, loaded)
+
+    def test_fast_load_model_dtype(self):
+        model = get_tiny_model()
+        with tempfile.TemporaryDirectory() as path:
+            model.save_pretrained(path, safe_serialization=True)
+            loaded = fast_load_model(path, torch_dtype=torch.bfloat16, attn_implementation="eager")
+        for p in loaded.parameters():
+            self.assertEqual(p.dtype, torch.bfloat16)
+
+    def test_fast_load_model_ignores_non_persistent_buffers(self):
+        model = get_tiny_model()
+        buffers = {
+            f'{module_name}.{name}': buffer.clone()
+            for module_name, module in model.named_modules()
+            for name, buffer in module._buffers.items()
+            if name in module._non_persistent_buffers_set and buffer is not None
+        }
+        self.assertGreater(len(buffers), 0)
+        with tempfile.TemporaryDirectory() as path:
+            model.save_pretrained(path, safe_serialization=True)
+            fn = os.path.join(path, 'model.safetensors')
+            tensors = load_file(fn)
+            tensors.update({name: torch.full_like(buffer, 3.0) for name, buffer in buffers.items()})
+            save_file(tensors, fn, metadata={'format': 'pt'})
+            loaded = fast_load_model(path, torch_dtype=torch.bfloat16, attn_implementation="eager")
+        loaded_buffers = dict(loaded.named_buffers())
+        for name, buffer in buffers.items():
+            self.assertEqual(loaded_buffers[name].dtype, buffer.dtype)
+            self.assertTrue(torch.equal(loaded_buffers[name], buffer), name)
+
+    def test_init_empty_weights_other_thread(self):
+        created = {}
+
+        def create():
+            created['linear'] = torch.nn.Linear(4, 4)
+
+        with init_empty_weights():
+            thread = threading.Thread(target=create)
+            thread.start()
+            thread.join()
+            self.assertEqual(torch.nn.Linear(4, 4).weight.device.type, 'meta')
+        self.assertEqual(created['linear'].weight.device.type, 'cpu')
+        self.assertEqual(torch.nn.Linear(4, 4).weight.device.type, 'cpu')
+
+    def test_fast_load_model_unsupported(self):
+        model = GPT2LMHeadModel(GPT2Config(n_layer=1, n_head=2, n_embd=16, vocab_size=128))
+        with tempfile.TemporaryDirectory() as path:
+            model.save_pretrained(path, safe_serialization=True)
+            self.assertIsNone(fast_load_model(path))
+
+
+class TestLazyLoadModel(unittest.TestCase):
+    def test_lazy_load_model(self):
+        model = get_tiny_model()
+        samples = get_samples([17, 40, None, 3])
+        with torch.no_grad():
+            expected = model.sliced(n_slices=2, device='cpu').evaluate_samples(samples, reduction='sum')
+        with tempfile.TemporaryDirectory() as path:
+            model.save_pretrained(path, safe_serialization=True)
+            lazy = lazy_load_model(path, torch_dtype=torch.float32, attn_implementation="eager")
+            self.assertTrue(all(p.device.type == 'meta' for p in lazy.parameters()))
+            with torch.no_grad():
+                losses = lazy.sliced(n_slices=2, device='cpu').evaluate_samples(samples, reduction='sum')
+        self.assertEqual(losses, expected)
+        # Weights are released after evaluation
+        self.assertTrue(all(p.device.type == 'meta' for p in lazy.parameters()))
+
+    def test_needs_lazy_load(self):
+        model = get_tiny_model()
+        with tempfile.TemporaryDirectory() as path:
+            model.save_pretrained(path, safe_serialization=True)
+            self.assertTrue(needs_lazy_load(path, 0))
+            self.assertFalse(needs_lazy_load(path, 1))
+        self.assertFalse(needs_lazy_load("/non/existing/path", 0))
+
+
+class TestModelPrefetcher(unittest.TestCase):
+    def test_prefetch_and_take(self):
+        store = FakeLocalStore()
+        prefetcher = ModelPrefetcher()
+        with tempfile.TemporaryDirectory() as path:
+            prefetcher.prefetch(store, "hk", get_model_id("a"), path=path)
+            model = prefetcher.take("hk", get_model_id("a"))
+        self.assertIsNotNone(model)
+        self.assertEqual(store.n_retrieved, 1)
+        # Taken models are no longer staged
+        self.assertIsNone(prefetcher.take("hk", get_model_id("a")))
+
+    def test_take_other_model(self):
+        store = FakeLocalStore()
+        prefetcher = ModelPrefetcher()
+        with tempfile.TemporaryDirectory() as path:
+            prefetcher.prefetch(store, "hk", get_model_id("a"), path=path)
+            self.assertIsNone(prefetcher.take("hk", get_model_id("b")))
+            self.assertIsNone(prefetcher.take("hk2", get_model_id("a")))
+            prefetcher.discard()
+            self.assertIsNone(prefetcher.take("hk", get_model_id("a")))
+
+    def test_stale_prefetch_not_waited_for(self):
+        release = threading.Event()
+
+        class BlockingStore(FakeLocalStore):
+            def retrieve_model(self, hotkey, model_id, path=None):
+                if hotkey == "slow":
+                    release.wait()
+                return super().retrieve_model(hotkey, model_id, path=path)
+
+        store = BlockingStore()
+        prefetcher = ModelPrefetcher()
+        with tempfile.TemporaryDirectory() as path:
+            prefetcher.prefetch(store, "slow", get_model_id("a"), path=path)
+            stale = prefetcher.job
+            # A new request doesn't wait for the unwanted load
+            prefetcher.prefetch(store, "hk", get_model_id("b"), path=path)
+            model = prefetcher.take("hk", get_model_id("b"))
+            self.assertEqual(model.id, get_model_id("b"))
+            self.assertTrue(stale.thread.is_alive())
+            # The stale load finishes in the background, and its model is dropped
+            release.set()
+            stale.thread.join()
+            self.assertIsNone(stale.model)
+            self.assertIsNone(prefetcher.take("slow", get_model_id("a")))
+
+    def test_cache_uses_prefetched_model(self):
+        store = FakeLocalStore()
+        prefetcher = ModelPrefetcher()
+        cache = ModelCache(max_bytes=1<<30)
+        with tempfile.TemporaryDirectory() as path:
+            prefetcher.prefetch(store, "hk", get_model_id("a"), path=path)
+            model = cache.retrieve_model(store, "hk", get_model_id("a"), prefetcher=prefetcher)
+        self.assertEqual(store.n_retrieved, 1)
+        self.assertIs(model, cache.get("hk", get_model_id("a")))
+
+    def test_readahead_model(self):
+        with tempfile.TemporaryDirectory() as path:
+            with open(f"{path}/model.safetensors", "wb") as f:
+                f.write(b"\0" * 4096)
+            readahead_model(path)
+        # Non-existing paths are ignored
+        readahead_model("/non/existing/path")
+
+
+if __name__ == "__main__":
+    unittest.main()
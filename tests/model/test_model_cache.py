@@ -0,0 +1,95 @@
+import unittest
+
+import torch
+
+from transformers_llama import LlamaConfig, SlicedLlamaForCausalLM
+from model.data import Model, ModelId
+from model.model_cache import ModelCache, model_bytes, preserve_weights
+
+
+def get_tiny_model(hidden_size=32) -> SlicedLlamaForCausalLM:
+    config = LlamaConfig(
+        vocab_size=128,
+        hidden_size=hidden_size,
+        intermediate_size=2*hidden_size,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    return SlicedLlamaForCausalLM(config).eval()
+
+
+def get_model_id(model_hash: str) -> ModelId:
+    return ModelId(namespace="ns", name="name", commit="commit", hash=model_hash)
+
+
+class FakeLocalStore:
+    def __init__(self):
+        self.n_retrieved = 0
+
+    def retrieve_model(self, hotkey, model_id, path=None):
+        self.n_retrieved += 1
+        return Model(id=model_id, pt_model=get_tiny_model())
+
+
+class TestModelCache(unittest.TestCase):
+    def test_retrieve_model_cached(self):
+        store = FakeLocalStore()
+        cache = ModelCache(max_bytes=1<<30)
+        model_a = cache.retrieve_model(store, "hk", get_model_id("a"))
+        model_b = cache.retrieve_model(store, "hk", get_model_id("a"))
+        self.assertIs(model_a, model_b)
+        self.assertEqual(store.n_retrieved, 1)
+
+    def test_new_hash_invalidates(self):
+        store = FakeLocalStore()
+        cache = ModelCache(max_bytes=1<<30)
+        cache.retrieve_model(store, "hk", get_model_id("a"))
+        cache.retrieve_model(store, "hk", get_model_id("b"))
+        self.assertEqual(store.n_retrieved, 2)
+        self.assertIsNone(cache.get("hk", get_model_id("a")))
+        self.assertIsNotNone(cache.get("hk", get_model_id("b")))
+        self.assertEqual(len(cache.entries), 1)
+
+    def test_lru_eviction(self):
+        store = FakeLocalStore()
+        n_bytes = model_bytes(get_tiny_model())
+        cache = ModelCache(max_bytes=2*n_bytes)
+        cache.retrieve_model(store, "hk1", get_model_id("a"))
+        cache.retrieve_model(store, "hk2", get_model_id("a"))
+        # Use hk1, so that hk2 is least recently used
+        cache.retrieve_model(store, "hk1", get_model_id("a"))
+        cache.retrieve_model(store, "hk3", get_model_id("a"))
+        self.assertIsNotNone(cache.get("hk1", get_model_id("a")))
+        self.assertIsNone(cache.get("hk2", get_model_id("a")))
+        self.assertIsNotNone(cache.get("hk3", get_model_id("a")))
+        self.assertLessEqual(cache.n_bytes, cache.max_bytes)
+
+    def test_disabled(self):
+        store = FakeLocalStore()
+        cache = ModelCache(max_bytes=0)
+        cache.retrieve_model(store, "hk", get_model_id("a"))
+        cache.retrieve_model(store, "hk", get_model_id("a"))
+        self.assertEqual(store.n_retrieved, 2)
+
+    def test_preserve_weights(self):
+        model = get_tiny_model()
+        state = {k: v.clone() for k, v in model.state_dict().items()}
+        inputs = torch.randint(0, 128, (1, 20))
+        with torch.no_grad():
+            logits = model(inputs).logits
+
+            with preserve_weights(model):
+                model.to(torch.float64)
+            with preserve_weights(model):
+                sliced = model.sliced(n_slices=2, device="cpu")
+                sliced.evaluate_samples([inputs])
+
+            for k, v in model.state_dict().items():
+                self.assertEqual(v.dtype, state[k].dtype)
+                self.assertTrue(torch.equal(v, state[k]))
+            self.assertTrue(torch.equal(logits, model(inputs).logits))
+
+
+if __name__ == "__main__":
+    unittest.main()
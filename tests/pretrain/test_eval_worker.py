@@ -0,0 +1,69 @@
+import functools
+import os
+import subprocess
+import sys
+import unittest
+
+from utilities.worker_pool import WorkerPool
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Cold start budget (seconds) for importing the worker entry module in a fresh interpreter
+IMPORT_SECONDS_TARGET = 15
+
+# Modules needed by the validator, but not for evaluating models
+FORBIDDEN_MODULES = [
+    'bittensor',
+    'rich',
+    'neurons.validator',
+    'neurons.dataset',
+    'wandb',
+    'matplotlib',
+    'utilities.btlite',
+    'model.model_utils',
+    'model.storage.chain.chain_model_metadata_store',
+    'model.storage.hugging_face.hugging_face_model_store',
+]
+
+IMPORT_SCRIPT = '''
+import sys, time
+t0 = time.perf_counter()
+import neurons.eval_worker
+print(time.perf_counter() - t0)
+print(' '.join(sys.modules))
+'''
+
+
+def get_main_module_and_modules():
+    main = sys.modules['__main__']
+    return getattr(main.__spec__, 'name', None), list(sys.modules)
+
+
+class TestEvalWorker(unittest.TestCase):
+    def test_import_footprint(self):
+        result = subprocess.run(
+            [sys.executable, '-c', IMPORT_SCRIPT],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        seconds, modules = result.stdout.strip().split('\n')[-2:]
+        modules = set(modules.split())
+        for module in FORBIDDEN_MODULES:
+            self.assertNotIn(module, modules)
+        self.assertLess(float(seconds), IMPORT_SECONDS_TARGET)
+
+    def test_spawned_worker_main_module(self):
+        pool = WorkerPool(n_workers=1, mode="spawn", name="test", main_module="neurons.eval_worker")
+        try:
+            main_module, modules = pool.run(functools.partial(get_main_module_and_modules), ttl=120)
+        finally:
+            pool.shutdown()
+        self.assertEqual(main_module, 'neurons.eval_worker')
+        for module in FORBIDDEN_MODULES:
+            self.assertNotIn(module, modules)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import json
+import math
+import os
+import tempfile
+import unittest
+
+from model.data import ModelId
+from model.storage.disk import utils as disk_utils
+from neurons.eval_worker import Container, describe_remote_eval, remote_eval_kwargs
+from neurons.remote_eval_worker import HASH_INDEX_FILENAME, evict_models, use_model
+
+
+def write_model(path: str, content: bytes):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'model.safetensors'), 'wb') as f:
+        f.write(content)
+
+
+def make_metadata(hotkey: str, content_hash: str):
+    metadata = Container()
+    metadata.hotkey = hotkey
+    metadata.id = ModelId(namespace='namespace', name=hotkey, commit='commit', competition='c1')
+    metadata.block = 100
+    metadata.content_hash = content_hash
+    return metadata
+
+
+def get_model_path(base_dir, metadata, download):
+    with use_model(base_dir, metadata, download) as path:
+        return path
+
+
+class TestRemoteEvalWorker(unittest.TestCase):
+    def test_download_once_per_content_hash(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            reference = os.path.join(base_dir, 'reference')
+            write_model(reference, b'weights')
+            content_hash = disk_utils.get_hash_of_directory(reference)
+            downloads = []
+
+            def download(metadata):
+                path = os.path.join(base_dir, metadata.hotkey)
+                write_model(path, b'weights')
+                downloads.append(metadata.hotkey)
+                return path
+
+            paths = []
+            for hotkey in ['hotkey1', 'hotkey2']:
+                metadata = make_metadata(hotkey, content_hash)
+                paths.append(get_model_path(base_dir, metadata, download))
+            self.assertEqual(downloads, ['hotkey1'])
+            self.assertEqual(paths, [os.path.join(base_dir, 'hotkey1')]*2)
+
+            # Downloads with other contents than expected are rejected
+            metadata.content_hash = 'other'
+            with self.assertRaises(Exception):
+                get_model_path(base_dir, metadata, download)
+            self.assertFalse(os.path.exists(os.path.join(base_dir, 'hotkey2')))
+
+    def test_evict_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            def download(metadata):
+                path = os.path.join(base_dir, metadata.hotkey)
+                write_model(path, metadata.hotkey.encode()*1000)
+                return path
+
+            metadata = {}
+            for hotkey in ['old', 'in_use', 'new']:
+                path = download(make_metadata(hotkey, ''))
+                metadata[hotkey] = make_metadata(hotkey, disk_utils.get_hash_of_directory(path))
+                get_model_path(base_dir, metadata[hotkey], download)
+
+            with use_model(base_dir, metadata['in_use'], download) as in_use_path:
+                # Models in use are skipped
+                self.assertGreater(evict_models(base_dir, 1), 0)
+                self.assertFalse(os.path.exists(os.path.join(base_dir, 'old')))
+                self.assertTrue(os.path.isdir(in_use_path))
+                self.assertTrue(os.path.isdir(os.path.join(base_dir, 'new')))
+                evict_models(base_dir, math.inf)
+                self.assertTrue(os.path.isdir(in_use_path))
+                self.assertFalse(os.path.exists(os.path.join(base_dir, 'new')))
+            with open(os.path.join(base_dir, HASH_INDEX_FILENAME)) as f:
+                self.assertEqual(set(json.load(f)), {metadata['in_use'].content_hash})
+
+            # Evicted models are downloaded again
+            self.assertEqual(get_model_path(base_dir, metadata['old'], download), os.path.join(base_dir, 'old'))
+
+    def test_remote_eval_description(self):
+        metadata = make_metadata('hotkey', 'hash')
+        metadata.path = None
+        early_stop = dict(
+            uid=3,
+            losses_per_uid={1: [1.0, math.inf], 2: [2.0, 3.0]},
+            uid_to_block={1: 10, 2: 20, 3: 30},
+            pool_size=2,
+        )
+        description = describe_remote_eval(metadata, 'c1', {'model_size': 1}, 'samples', 5, early_stop)
+        kwargs = remote_eval_kwargs(json.loads(json.dumps(description)))
+        self.assertEqual(vars(kwargs.pop('metadata')), vars(metadata))
+        self.assertEqual(kwargs, dict(
+            competition_info={'model_size': 1},
+            batches='samples',
+            max_token_id=5,
+            early_stop=early_stop,
+        ))
+
+
+if __name__ == "__main__":
+    unittest.main()
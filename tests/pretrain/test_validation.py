@@ -0,0 +1,326 @@
+import math
+import unittest
+
+import torch
+
+import constants
+from transformers_llama import LlamaConfig, SlicedLlamaForCausalLM
+from neurons import validation
+from utilities import losses
+
+
+def get_tiny_llama(attn_implementation="eager"):
+    config = LlamaConfig(
+        vocab_size=128,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+        attn_implementation=attn_implementation,
+    )
+    torch.manual_seed(0)
+    return SlicedLlamaForCausalLM(config).eval()
+
+
+def get_samples(lengths, vocab_size=128):
+    generator = torch.Generator().manual_seed(1)
+    return [
+        None if length is None else torch.randint(0, vocab_size, (1, length), generator=generator)
+            for length in lengths
+    ]
+
+
+class TestValidation(unittest.TestCase):
+    def test_gen_length_buckets(self):
+        samples = get_samples([10, 50, None, 12, 48, 100, 11])
+        buckets = validation.gen_length_buckets(samples, max_batch_tokens=100)
+
+        # All non-None samples are assigned to exactly one bucket
+        self.assertEqual(sorted(sum(buckets, [])), [0, 1, 3, 4, 5, 6])
+        # Longest first, padded size within budget
+        self.assertEqual(buckets, [[5], [1, 4], [3, 6, 0]])
+        for bucket in buckets:
+            padded = len(bucket) * max(len(samples[i][0]) for i in bucket)
+            self.assertLessEqual(padded, 100)
+
+    def test_gen_length_buckets_oversize(self):
+        samples = get_samples([300, 20])
+        buckets = validation.gen_length_buckets(samples, max_batch_tokens=100)
+        self.assertEqual(buckets, [[0], [1]])
+
+    def test_compute_losses_batched(self):
+        model = get_tiny_llama()
+        samples = get_samples([17, 40, None, 3, 64, 39, 2])
+
+        regular = validation.compute_losses_regular(model, samples, "cpu")
+        batched = validation.compute_losses_batched(model, samples, "cpu", max_batch_tokens=128)
+
+        self.assertEqual(len(regular), len(batched))
+        for loss_regular, loss_batched in zip(regular, batched):
+            if loss_regular == float('inf'):
+                self.assertEqual(loss_batched, float('inf'))
+            else:
+                self.assertAlmostEqual(loss_regular, loss_batched, places=3)
+
+    def test_gen_packs(self):
+        samples = get_samples([10, 50, None, 12, 48, 100, 11, 30])
+        packs = validation.gen_packs(samples, max_pack_tokens=100)
+
+        self.assertEqual(sorted(sum(packs, [])), [0, 1, 3, 4, 5, 6, 7])
+        self.assertEqual(packs, [[5], [1, 4], [7, 3, 6, 0]])
+        for pack in packs:
+            self.assertLessEqual(sum(len(samples[i][0]) for i in pack), 100)
+
+    def test_compute_losses_packed(self):
+        samples = get_samples([17, 40, None, 3, 64, 39, 2])
+        for attn_implementation in ["eager", "sdpa"]:
+            model = get_tiny_llama(attn_implementation)
+            self.assertTrue(validation.supports_packing(model))
+
+            regular = validation.compute_losses_regular(model, samples, "cpu")
+            packed = validation.compute_losses_packed(model, samples, "cpu", max_pack_tokens=128)
+
+            self.assertEqual(len(regular), len(packed))
+            for loss_regular, loss_packed in zip(regular, packed):
+                if loss_regular == float('inf'):
+                    self.assertEqual(loss_packed, float('inf'))
+                else:
+                    self.assertAlmostEqual(loss_regular, loss_packed, places=3)
+
+    def test_compute_losses_chunked_logits(self):
+        model = get_tiny_llama()
+        samples = get_samples([17, 40, None, 3, 64, 39, 2])
+
+        regular = validation.compute_losses_regular(model, samples, "cpu")
+        for chunked in [
+                validation.compute_losses_regular(model, samples, "cpu", logits_chunk_tokens=7),
+                validation.compute_losses_batched(model, samples, "cpu", max_batch_tokens=128, logits_chunk_tokens=7),
+                validation.compute_losses_packed(model, samples, "cpu", max_pack_tokens=128, logits_chunk_tokens=7),
+                validation.compute_losses_sliced(model, samples, "cpu", n_slices=2, logits_chunk_tokens=7),
+            ]:
+            self.assertEqual(len(regular), len(chunked))
+            for loss_regular, loss_chunked in zip(regular, chunked):
+                if loss_regular == float('inf'):
+                    self.assertEqual(loss_chunked, float('inf'))
+                else:
+                    self.assertAlmostEqual(loss_regular, loss_chunked, places=3)
+
+    def test_compute_wins_duplicate(self):
+        losses_per_uid = {
+            1: [1.0, 2.0, 3.0, 1.0],
+            2: [2.0, 1.0, 2.0, 2.0],
+        }
+        uid_to_block = {1: 1, 2: 2, 3: 3}
+        wins = validation.compute_wins(losses_per_uid, uid_to_block, 10, 0.01, 1)['wins']
+
+        # A later copy of uid 1 does not affect wins and does not win itself
+        losses_per_uid[3] = losses_per_uid[1].copy()
+        wins_dup = validation.compute_wins(losses_per_uid, uid_to_block, 10, 0.01, 1)['wins']
+        self.assertEqual(wins_dup, {**wins, 3: 0})
+
+        # An earlier copy of uid 2 takes its wins
+        uid_to_block[3] = 0
+        losses_per_uid[3] = losses_per_uid[2].copy()
+        wins_dup = validation.compute_wins(losses_per_uid, uid_to_block, 10, 0.01, 1)['wins']
+        self.assertEqual(wins_dup, {1: wins[1], 2: 0, 3: wins[2]})
+
+    def test_gen_sample_groups(self):
+        groups = validation.gen_sample_groups(10, 4)
+        self.assertEqual(groups, [[0, 4, 8], [1, 5, 9], [2, 6], [3, 7]])
+        self.assertEqual(validation.gen_sample_groups(2, 4), [[0], [1]])
+
+    def test_cannot_enter_pool(self):
+        # uid 1 wins the first 5 samples, uid 2 the last 5
+        losses_per_uid = {
+            1: [1.0]*5 + [2.0]*5,
+            2: [2.0]*5 + [1.0]*5,
+        }
+        uid_to_block = {1: 1, 2: 2, 3: 3}
+        challenger = [3.0]*10
+        kwargs = dict(
+            uid=3,
+            losses_per_uid=losses_per_uid,
+            uid_to_block=uid_to_block,
+            current_block=10,
+            advantage_initial=0,
+            advantage_decay_per_epoch=1,
+        )
+
+        # Could still win the 6 remaining samples
+        self.assertFalse(validation.cannot_enter_pool(challenger, [0, 2, 4, 6], pool_size=2, **kwargs))
+        # At most 2 wins, both pool models have more
+        self.assertTrue(validation.cannot_enter_pool(challenger, list(range(8)), pool_size=2, **kwargs))
+        # Pool not full
+        self.assertFalse(validation.cannot_enter_pool(challenger, list(range(8)), pool_size=3, **kwargs))
+        # Winning samples keeps the challenger going
+        self.assertFalse(validation.cannot_enter_pool([0.5]*10, list(range(8)), pool_size=2, **kwargs))
+
+    def test_duplicate_to_evaluate(self):
+        pool = [2]
+        uid_to_block = {1: 10, 2: 30, 3: 20, 4: 5}
+        # Fully evaluated or disqualified: the result holds for all duplicates
+        self.assertIsNone(validation.duplicate_to_evaluate(0, True, [2, 3], pool, uid_to_block))
+        # Stopped early: evaluate a duplicate, pool members first
+        self.assertEqual(validation.duplicate_to_evaluate(4, True, [2, 3, 4], pool, uid_to_block), 2)
+        # then the earliest block
+        self.assertEqual(validation.duplicate_to_evaluate(4, True, [3, 4], pool, uid_to_block), 4)
+        # Failed for other reasons
+        self.assertEqual(validation.duplicate_to_evaluate(0, False, [3, 4], pool, uid_to_block), 4)
+
+    def test_compute_losses_early_stop(self):
+        model = get_tiny_llama()
+        samples = get_samples([17, 40, None, 3, 64, 39, 2])
+        regular = validation.compute_losses_regular(model, samples, "cpu")
+
+        calls = []
+        def early_stop(losses, evaluated):
+            calls.append(evaluated)
+            return True
+        stopped = validation.compute_losses(model, False, samples, "cpu", early_stop=early_stop, early_stop_groups=3)
+        self.assertEqual(calls, [[0, 3, 6]])
+        for i, loss in enumerate(stopped):
+            if i in calls[0]:
+                self.assertAlmostEqual(loss, regular[i], places=3)
+            else:
+                self.assertTrue(math.isnan(loss))
+
+        full = validation.compute_losses(model, False, samples, "cpu", early_stop=lambda *args: False, early_stop_groups=3)
+        for loss_regular, loss_full in zip(regular, full):
+            if loss_regular == float('inf'):
+                self.assertEqual(loss_full, float('inf'))
+            else:
+                self.assertAlmostEqual(loss_regular, loss_full, places=3)
+
+    def test_early_stop_default_keeps_wins(self):
+        model = get_tiny_llama()
+        samples = get_samples([17, 40, 3, 64, 39, 2])
+        full = validation.compute_losses(model, False, samples, "cpu")
+        # By default, a challenger that would be stopped is evaluated on all samples
+        challenger = validation.compute_losses(
+            model, False, samples, "cpu", early_stop=lambda *args: True,
+            early_stop_groups=constants.EVAL_EARLY_STOP_GROUPS,
+        )
+        self.assertFalse(any(math.isnan(loss) for loss in challenger))
+
+        pool = {
+            1: [loss*0.99 if i % 2 else loss*1.01 for i, loss in enumerate(full)],
+            2: [loss*1.02 if i % 2 else loss*0.98 for i, loss in enumerate(full)],
+        }
+        uid_to_block = {1: 1, 2: 2, 3: 3}
+        with_full = validation.compute_wins({**pool, 3: full}, uid_to_block, 10, 0.01, 1)
+        with_challenger = validation.compute_wins({**pool, 3: challenger}, uid_to_block, 10, 0.01, 1)
+        for uid in pool:
+            self.assertEqual(with_full['wins'][uid], with_challenger['wins'][uid])
+            self.assertEqual(with_full['win_rate'][uid], with_challenger['win_rate'][uid])
+
+    def test_compute_losses_oom_recovery(self):
+        model = get_tiny_llama()
+        samples = get_samples([17, 40, None, 3, 64])
+        regular = validation.compute_losses_regular(model, samples, "cpu")
+
+        # Materializing full logits of long samples runs out of memory
+        forward = model.forward
+        def forward_oom(input_ids, **kwargs):
+            if input_ids.shape[-1] > 32:
+                raise torch.cuda.OutOfMemoryError("CUDA out of memory")
+            return forward(input_ids, **kwargs)
+        model.forward = forward_oom
+
+        oom_failed = []
+        losses_oom = validation.compute_losses_regular(model, samples, "cpu", oom_failed=oom_failed)
+        self.assertEqual(oom_failed, [1, 4])
+        self.assertEqual(losses_oom[1], float('inf'))
+
+        validation.eval_configs.clear()
+        try:
+            recovered = validation.compute_losses(model, False, samples, "cpu")
+            for loss_regular, loss_recovered in zip(regular, recovered):
+                if loss_regular == float('inf'):
+                    self.assertEqual(loss_recovered, float('inf'))
+                else:
+                    self.assertAlmostEqual(loss_regular, loss_recovered, places=3)
+            # Chunked logits are used right away for this geometry from now on
+            configs = list(validation.eval_configs.values())
+            self.assertEqual(configs, [dict(logits_chunk_tokens=constants.EVAL_OOM_LOGITS_CHUNK_TOKENS, n_slices=None)])
+        finally:
+            validation.eval_configs.clear()
+
+    def test_compute_losses_sliced_escalation(self):
+        model = get_tiny_llama()
+        samples = get_samples([17, 40, None, 3, 64])
+        geometry = validation.get_model_geometry(model, "cpu")
+        compute_losses_sliced = validation.compute_losses_sliced
+
+        def sliced_failing(model, batches, device, oom_failed=None, **kwargs):
+            losses = [math.inf]*len(batches)
+            if oom:
+                oom_failed.append(1)
+            return losses
+
+        validation.eval_configs.clear()
+        try:
+            validation.compute_losses_sliced = sliced_failing
+            for oom, expected in [(False, 2), (True, 4)]:
+                # Sliced eval with the remembered number of slices
+                validation.eval_configs[geometry] = dict(logits_chunk_tokens=0, n_slices=2)
+                validation.compute_losses(model, True, samples, "cpu")
+                # Only running out of memory calls for more slices
+                self.assertEqual(validation.eval_configs[geometry]['n_slices'], expected)
+        finally:
+            validation.compute_losses_sliced = compute_losses_sliced
+            validation.eval_configs.clear()
+
+    def test_compute_losses_remembered_slices(self):
+        model = get_tiny_llama()
+        samples = get_samples([17, 40, None, 3, 64])
+        geometry = validation.get_model_geometry(model, "cpu")
+        compute_losses_sliced = validation.compute_losses_sliced
+        get_device_budget = validation.get_device_budget
+        calls = []
+
+        def sliced_recording(model, batches, device, oom_failed=None, **kwargs):
+            calls.append(kwargs)
+            return [math.inf]*len(batches)
+
+        validation.eval_configs.clear()
+        try:
+            validation.compute_losses_sliced = sliced_recording
+            # Enough memory to plan 2 slices, with room for states and resident slices
+            validation.get_device_budget = lambda device, fraction: 600000
+            validation.compute_losses(model, True, samples, "cpu", slice_schedule='group')
+            planned = calls.pop()
+            self.assertEqual(len(planned['start_layers']), 2)
+            # A remembered number of slices overrides the plan, along with what was planned for it
+            validation.eval_configs[geometry] = dict(logits_chunk_tokens=0, n_slices=4)
+            validation.compute_losses(model, True, samples, "cpu", slice_schedule='group')
+            remembered = calls.pop()
+            self.assertIsNone(remembered['start_layers'])
+            self.assertEqual(remembered['n_slices'], 4)
+            expected = validation.get_state_budget(model, samples, [0, 1, 2, 3], 600000)
+            expected = validation.plan_resident_slices(model, samples, [0, 1, 2, 3], expected)
+            self.assertEqual((remembered['resident_slices'], remembered['state_budget']), expected)
+        finally:
+            validation.compute_losses_sliced = compute_losses_sliced
+            validation.get_device_budget = get_device_budget
+            validation.eval_configs.clear()
+
+    def test_chunked_cross_entropy(self):
+        torch.manual_seed(0)
+        lm_head = torch.nn.Linear(16, 50)
+        hidden_states = torch.randn(23, 16)
+        labels = torch.randint(0, 50, (23,))
+        expected = torch.nn.functional.cross_entropy(lm_head(hidden_states), labels, reduction='none')
+
+        for chunk_tokens in [1, 5, 23, 100]:
+            token_losses = losses.chunked_cross_entropy(hidden_states, lm_head, labels, chunk_tokens, reduction='none')
+            self.assertTrue(torch.allclose(token_losses, expected, atol=1e-5))
+            loss_sum = losses.chunked_cross_entropy(hidden_states, lm_head, labels, chunk_tokens)
+            self.assertAlmostEqual(loss_sum.item(), expected.sum().item(), places=3)
+            loss_mean = losses.chunked_cross_entropy(hidden_states, lm_head, labels, chunk_tokens, reduction='mean')
+            self.assertAlmostEqual(loss_mean.item(), expected.mean().item(), places=5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+import torch
+
+from tests.pretrain.test_validation import get_samples, get_tiny_llama
+from transformers_llama.modeling_llama import _prepare_4d_causal_attention_mask_with_cache_position
+from utilities.causal_mask import clear_causal_mask_cache, get_causal_mask
+
+
+def get_reference_mask(sequence_length, target_length, dtype):
+    return _prepare_4d_causal_attention_mask_with_cache_position(
+        None,
+        sequence_length=sequence_length,
+        target_length=target_length,
+        dtype=dtype,
+        device='cpu',
+        min_dtype=torch.finfo(dtype).min,
+        cache_position=torch.arange(sequence_length),
+        batch_size=1,
+    )
+
+
+class TestCausalMask(unittest.TestCase):
+    def test_get_causal_mask(self):
+        clear_causal_mask_cache()
+        for length, dtype in [(5, torch.float32), (300, torch.float32), (7, torch.float32), (9, torch.bfloat16)]:
+            mask = get_causal_mask(length, length + 1, dtype, 'cpu')
+            self.assertEqual(mask.shape, (1, 1, length, length + 1))
+            self.assertEqual(mask.dtype, dtype)
+            self.assertTrue(torch.equal(mask, get_reference_mask(length, length + 1, dtype)))
+        # Shorter masks are views of the cached one
+        long_mask = get_causal_mask(300, 301, torch.float32, 'cpu')
+        short_mask = get_causal_mask(17, 18, torch.float32, 'cpu')
+        self.assertEqual(short_mask.data_ptr(), long_mask.data_ptr())
+
+    def test_update_causal_mask(self):
+        inputs_embeds = torch.zeros(2, 11, 32)
+        cache_position = torch.arange(11)
+        sdpa = get_tiny_llama(attn_implementation="sdpa")
+        self.assertIsNone(sdpa.model._update_causal_mask(None, inputs_embeds, cache_position, None, False))
+        eager = get_tiny_llama(attn_implementation="eager")
+        mask = eager.model._update_causal_mask(None, inputs_embeds, cache_position, None, False)
+        self.assertEqual(mask.shape, (2, 1, 11, 12))
+        self.assertTrue(torch.equal(mask[1:], get_reference_mask(11, 12, torch.float32)))
+
+    def test_eager_equals_sdpa(self):
+        samples = get_samples([17, 40, 3, 64])
+        eager = get_tiny_llama(attn_implementation="eager")
+        sdpa = get_tiny_llama(attn_implementation="sdpa")
+        with torch.no_grad():
+            for sample in samples:
+                self.assertTrue(torch.allclose(eager(sample).logits, sdpa(sample).logits, atol=1e-5))
+
+
+if __name__ == "__main__":
+    unittest.main()
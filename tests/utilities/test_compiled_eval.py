@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+
+from neurons import validation
+from tests.pretrain.test_validation import get_samples, get_tiny_llama
+from tests.utilities.test_sliced_model import get_tiny_phi, get_tiny_phi3
+from utilities.compiled_eval import get_compile_cache_dir, get_length_bucket
+
+
+class TestCompiledEval(unittest.TestCase):
+    def test_get_length_bucket(self):
+        self.assertEqual(get_length_bucket(1), 128)
+        self.assertEqual(get_length_bucket(128), 128)
+        self.assertEqual(get_length_bucket(129), 256)
+        self.assertEqual(get_length_bucket(1000), 1024)
+        self.assertEqual(get_length_bucket(5, min_bucket=4), 8)
+
+    def test_get_compile_cache_dir(self):
+        model = get_tiny_llama()
+        geometry = validation.get_model_geometry(model, 'cpu')
+        cache_dir = get_compile_cache_dir('/cache', geometry)
+        self.assertTrue(os.path.basename(cache_dir).startswith('SlicedLlamaForCausalLM-'))
+        self.assertEqual(cache_dir, get_compile_cache_dir('/cache', validation.get_model_geometry(get_tiny_llama(), 'cpu')))
+        self.assertNotEqual(cache_dir, get_compile_cache_dir('/cache', validation.get_model_geometry(get_tiny_phi(), 'cpu')))
+
+    def test_compiled_equals_regular(self):
+        samples = get_samples([17, 40, None, 3, 200])
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for get_model in [get_tiny_llama, get_tiny_phi, get_tiny_phi3]:
+                model = get_model()
+                regular = validation.compute_losses_regular(model, samples, "cpu")
+                compiled = validation.compute_losses_compiled(model, samples, "cpu", compile_cache_dir=cache_dir)
+                for loss_regular, loss_compiled in zip(regular, compiled):
+                    if loss_regular == float('inf'):
+                        self.assertEqual(loss_compiled, float('inf'))
+                    else:
+                        self.assertAlmostEqual(loss_regular, loss_compiled, places=3)
+            # One cache directory per geometry
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
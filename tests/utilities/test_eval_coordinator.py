@@ -0,0 +1,217 @@
+import functools
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+from tests.pretrain.test_validation import get_samples
+from utilities.eval_coordinator import CoordinatorClient, EvalCoordinator, sign
+from utilities.eval_scheduler import EvalScheduler, EvalTask
+from utilities.shared_samples import SharedSamples, get_sample_tensors
+from utilities.worker_pool import TaskLost
+
+SECRET = 'test-secret'
+
+
+class CustomError(Exception):
+    pass
+
+
+def get_pid(seconds: float = 0, device: str = None):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def sum_tokens(batches):
+    return [None if batch is None else int(batch.sum()) for batch in get_sample_tensors(batches)]
+
+
+def execute(task, ttl, expected_errors, started):
+    # Preparation, e.g. a slow model download, doesn't count against ttl
+    time.sleep(task.get('prepare_seconds', 0))
+    started()
+    if task['op'] == 'pid':
+        return get_pid(task.get('seconds', 0))
+    if task['op'] == 'exit':
+        os._exit(1)
+    if task['op'] == 'divide':
+        return task['a'] / task['b']
+    if task['op'] == 'custom':
+        raise CustomError(task['message'])
+    if task['op'] == 'sum_tokens':
+        return sum_tokens(task['batches'])
+
+
+def serve(url):
+    CoordinatorClient(url, SECRET).serve(execute, heartbeat_interval=0.5)
+
+
+def make_task(op, **kwargs):
+    """make_func for EvalTask: the same task on a local worker or described for a remote one."""
+    def make_func(device, next_key):
+        if device is not None:
+            return functools.partial(get_pid, kwargs.get('seconds', 0), device)
+        return dict(op=op, **kwargs)
+    return make_func
+
+
+class TestEvalCoordinator(unittest.TestCase):
+    def setUp(self):
+        self.coordinator = EvalCoordinator('127.0.0.1', 0, SECRET, lease_seconds=2, exception_types=[CustomError])
+        self.url = f'http://127.0.0.1:{self.coordinator.port}'
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.kill()
+            worker.join()
+        self.coordinator.shutdown()
+
+    def start_workers(self, n):
+        ctx = multiprocessing.get_context('fork')
+        for _ in range(n):
+            worker = ctx.Process(target=serve, args=(self.url,), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        deadline = time.monotonic() + 30
+        while self.coordinator.n_idle_workers() < n:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.1)
+
+    def request(self, path, secret=SECRET, timestamp=None, data=b''):
+        timestamp = repr(time.time() if timestamp is None else timestamp)
+        headers = {
+            'X-Worker-Id': 'worker',
+            'X-Timestamp': timestamp,
+            'X-Signature': sign(secret, timestamp, 'POST', path, 'worker', data),
+        }
+        req = urllib.request.Request(f'{self.url}{path}', data=data, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=10) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_signature(self):
+        self.assertEqual(self.request('/lease'), 204)
+        self.assertEqual(self.request('/lease', secret='wrong'), 403)
+        self.assertEqual(self.request('/lease', timestamp=time.time() - 600), 403)
+        # Replayed requests are rejected
+        timestamp = time.time()
+        self.assertEqual(self.request('/lease', timestamp=timestamp), 204)
+        self.assertEqual(self.request('/lease', timestamp=timestamp), 403)
+
+    def test_sign_file(self):
+        data = os.urandom(3 << 20)
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            # Files are signed from the start, like their contents
+            self.assertEqual(sign('secret', 'part', f), sign('secret', 'part', data))
+
+    def test_wrong_secret(self):
+        client = CoordinatorClient(self.url, 'wrong')
+        self.assertIsNone(client.lease())
+
+    def test_run(self):
+        self.start_workers(1)
+        pid = self.coordinator.run(dict(op='pid'), ttl=10)
+        self.assertEqual(pid, self.workers[0].pid)
+        with self.assertRaises(ZeroDivisionError):
+            self.coordinator.run(dict(op='divide', a=1, b=0), ttl=10, expected_errors={"ZeroDivisionError"})
+        with self.assertRaisesRegex(CustomError, 'expected'):
+            self.coordinator.run(dict(op='custom', message='expected'), ttl=10, expected_errors={"CustomError"})
+        # Task descriptions must be JSON data
+        with self.assertRaises(TypeError):
+            self.coordinator.run(dict(op='pid', seconds=object()), ttl=10)
+
+    def test_samples(self):
+        self.start_workers(1)
+        samples = get_samples([10, None, 20])
+        shared = SharedSamples.create(samples)
+        try:
+            self.assertEqual(sum_tokens(samples), self.coordinator.run(dict(op='sum_tokens', batches=shared), ttl=10))
+        finally:
+            shared.close()
+        # Only published while in use
+        self.assertEqual(self.coordinator.samples, {})
+
+    def test_try_reserve(self):
+        self.start_workers(1)
+        self.assertTrue(self.coordinator.try_reserve())
+        # The only worker is promised to one task already
+        self.assertFalse(self.coordinator.try_reserve())
+        self.coordinator.cancel_reservation()
+        self.assertTrue(self.coordinator.try_reserve())
+        self.assertEqual(self.coordinator.run(dict(op='pid'), ttl=10), self.workers[0].pid)
+        self.assertEqual(self.coordinator.n_reserved, 0)
+
+    def test_no_workers(self):
+        with self.assertRaises(TaskLost):
+            self.coordinator.run(dict(op='pid'), ttl=10)
+
+    def test_slow_prepare(self):
+        # One worker for each task, as timed out tasks keep their worker busy
+        self.start_workers(2)
+        # A slow download doesn't use up the ttl of the evaluation
+        pid = self.coordinator.run(dict(op='pid', prepare_seconds=3), ttl=1)
+        self.assertIn(pid, [worker.pid for worker in self.workers])
+        with self.assertRaises(TimeoutError):
+            self.coordinator.run(dict(op='pid', seconds=3), ttl=1)
+        # Preparation has a budget of its own
+        self.coordinator.prepare_seconds = 1
+        with self.assertRaisesRegex(TaskLost, 'did not start'):
+            self.coordinator.run(dict(op='pid', prepare_seconds=3), ttl=10)
+
+    def test_lost_worker(self):
+        self.start_workers(1)
+        with self.assertRaises(TaskLost):
+            self.coordinator.run(dict(op='exit'), ttl=10)
+
+    def test_scheduler(self):
+        self.start_workers(2)
+        scheduler = EvalScheduler(['cpu'], mode='fork', name='test', remote=self.coordinator, n_remote=2)
+        results = {}
+
+        def on_result(task, result, e):
+            results[task.key] = e if e is not None else result
+
+        tasks = [EvalTask(key=i, make_func=make_task('pid', seconds=1), ttl=10) for i in range(6)]
+        tasks.append(EvalTask(key='local', make_func=make_task('pid'), remote=False))
+        try:
+            t0 = time.monotonic()
+            scheduler.run(tasks, on_result)
+            self.assertLess(time.monotonic() - t0, 6)
+        finally:
+            scheduler.pools[0].shutdown()
+        self.assertEqual(set(results), set(range(6)) | {'local'})
+        self.assertTrue(all(isinstance(pid, int) for pid in results.values()))
+        pids = set(results.values())
+        for worker in self.workers:
+            self.assertIn(worker.pid, pids)
+
+    def test_scheduler_reassigns_lost_task(self):
+        self.start_workers(1)
+        scheduler = EvalScheduler(['cpu'], mode='fork', name='test', remote=self.coordinator, n_remote=1)
+        results = {}
+
+        def on_result(task, result, e):
+            results[task.key] = e if e is not None else result
+
+        tasks = [
+            EvalTask(key='slow', make_func=make_task('pid', seconds=3), cost=2),
+            # Takes down the remote worker
+            EvalTask(key='crash', make_func=make_task('exit'), cost=1),
+        ]
+        try:
+            scheduler.run(tasks, on_result)
+        finally:
+            scheduler.pools[0].shutdown()
+        self.assertIsInstance(results['slow'], int)
+        self.assertIsInstance(results['crash'], int)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import functools
+import os
+import time
+import unittest
+
+from utilities.eval_scheduler import EvalScheduler, EvalTask
+
+
+def sleep_and_get_pid(seconds: float, device: str):
+    time.sleep(seconds)
+    return os.getpid(), device
+
+
+def make_sleep(seconds, device, next_key):
+    return functools.partial(sleep_and_get_pid, seconds, device)
+
+
+class TestEvalScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = EvalScheduler(["cpu", "cpu"], mode="fork", name="test")
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def run_tasks(self, tasks, **kwargs):
+        results = {}
+
+        def on_result(task, result, e):
+            results[task.key] = e if e is not None else result
+
+        not_started = self.scheduler.run(tasks, on_result, **kwargs)
+        return results, not_started
+
+    def test_concurrent(self):
+        # Warm up the workers
+        self.run_tasks([EvalTask(key=i, make_func=functools.partial(make_sleep, 0)) for i in range(2)])
+
+        tasks = [EvalTask(key=i, make_func=functools.partial(make_sleep, 1), ttl=10) for i in range(4)]
+        t0 = time.monotonic()
+        results, not_started = self.run_tasks(tasks)
+        self.assertLess(time.monotonic() - t0, 3.5)
+        self.assertEqual(not_started, [])
+        self.assertEqual(set(results), {0, 1, 2, 3})
+        self.assertEqual(len({pid for pid, device in results.values()}), 2)
+        self.assertEqual({device for pid, device in results.values()}, {"cpu"})
+
+    def test_cost_order(self):
+        started = []
+
+        def make_func(key, device, next_key):
+            started.append(key)
+            return functools.partial(sleep_and_get_pid, 0, device)
+
+        tasks = [
+            EvalTask(key=key, make_func=functools.partial(make_func, key), cost=cost, group=group)
+            for key, cost, group in [('a', 1, 0), ('b', 5, 0), ('c', 3, 0), ('d', 9, 1)]
+        ]
+        self.run_tasks(tasks)
+        self.assertEqual(started[:2], ['b', 'c'])
+        self.assertEqual(started[-1], 'd')
+
+    def test_affinity(self):
+        tasks = [EvalTask(key=i, make_func=functools.partial(make_sleep, 0.5)) for i in range(2)]
+        results, _ = self.run_tasks(tasks)
+        again, _ = self.run_tasks(tasks)
+        for key in results:
+            self.assertEqual(results[key][0], again[key][0])
+
+    def test_ttl_per_task(self):
+        tasks = [
+            EvalTask(key='slow', make_func=functools.partial(make_sleep, 5), cost=2, ttl=1),
+            EvalTask(key='fast', make_func=functools.partial(make_sleep, 0), cost=1, ttl=10),
+        ]
+        results, _ = self.run_tasks(tasks)
+        self.assertIsInstance(results['slow'], TimeoutError)
+        self.assertIsInstance(results['fast'], tuple)
+
+    def test_make_func_error(self):
+        def make_func(device, next_key):
+            raise ValueError("expected")
+
+        results, _ = self.run_tasks([EvalTask(key=0, make_func=make_func)])
+        self.assertIsInstance(results[0], ValueError)
+
+    def test_new_tasks_from_on_result(self):
+        results = {}
+
+        def on_result(task, result, e):
+            results[task.key] = e if e is not None else result
+            if isinstance(e, TimeoutError):
+                return [EvalTask(key='replacement', make_func=functools.partial(make_sleep, 0))]
+
+        tasks = [EvalTask(key='slow', make_func=functools.partial(make_sleep, 5), ttl=1)]
+        not_started = self.scheduler.run(tasks, on_result)
+        self.assertEqual(not_started, [])
+        self.assertIsInstance(results['slow'], TimeoutError)
+        self.assertIsInstance(results['replacement'], tuple)
+
+    def test_deadline(self):
+        tasks = [EvalTask(key=i, make_func=functools.partial(make_sleep, 0)) for i in range(3)]
+        results, not_started = self.run_tasks(tasks, deadline=time.time() - 1)
+        self.assertEqual(results, {})
+        self.assertEqual(len(not_started), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import copy
+import unittest
+
+import torch
+
+from neurons import validation
+from tests.pretrain.test_validation import get_samples
+from transformers_llama import LlamaConfig, SlicedLlamaForCausalLM
+from transformers_llama.modeling_llama import repeat_kv
+from transformers_phi import PhiConfig, SlicedPhiForCausalLM
+from transformers_phi3 import Phi3Config, SlicedPhi3ForCausalLM
+from utilities.grouped_attention import grouped_matmul_av, grouped_matmul_qk, grouped_scaled_dot_product_attention
+
+CONFIG_KWARGS = dict(
+    vocab_size=128,
+    hidden_size=32,
+    intermediate_size=64,
+    num_hidden_layers=2,
+    num_attention_heads=4,
+    num_key_value_heads=2,
+    max_position_embeddings=256,
+)
+
+
+def get_tiny_gqa_models(attn_implementation):
+    torch.manual_seed(0)
+    return [
+        SlicedLlamaForCausalLM(LlamaConfig(attn_implementation=attn_implementation, **CONFIG_KWARGS)).eval(),
+        SlicedPhiForCausalLM(PhiConfig(attn_implementation=attn_implementation, **CONFIG_KWARGS)).eval(),
+        SlicedPhi3ForCausalLM(Phi3Config(attn_implementation=attn_implementation, pad_token_id=0, **CONFIG_KWARGS)).eval(),
+    ]
+
+
+def expand_kv_heads(model):
+    """
+    Return an equivalent model with one key/value head per query head, which
+    doesn't take the grouped code paths.
+    """
+    config = copy.deepcopy(model.config)
+    n_kv_heads = config.num_key_value_heads
+    n_rep = config.num_attention_heads // n_kv_heads
+    head_dim = config.hidden_size // config.num_attention_heads
+    config.num_key_value_heads = config.num_attention_heads
+
+    def expand(t):
+        return t.view(n_kv_heads, head_dim, *t.shape[1:]).repeat_interleave(n_rep, dim=0).reshape(-1, *t.shape[1:])
+
+    state = {}
+    for name, t in model.state_dict().items():
+        if name.split('.')[-2] in ('k_proj', 'v_proj'):
+            t = expand(t)
+        elif name.endswith('qkv_proj.weight'):
+            q, k, v = t.split([config.hidden_size, n_kv_heads*head_dim, n_kv_heads*head_dim])
+            t = torch.cat([q, expand(k), expand(v)])
+        state[name] = t
+    expanded = type(model)(config).eval()
+    expanded.load_state_dict(state)
+    return expanded
+
+
+class TestGroupedAttention(unittest.TestCase):
+    def test_grouped_matmul(self):
+        torch.manual_seed(0)
+        # Query transposed from [batch, q_len, n_heads, head_dim], as in the models
+        query = torch.randn(2, 7, 8, 16).transpose(1, 2)
+        key = torch.randn(2, 2, 9, 16)
+        value = torch.randn(2, 2, 9, 16)
+        expected = torch.matmul(query, repeat_kv(key, 4).transpose(2, 3))
+        scores = grouped_matmul_qk(query, key)
+        self.assertEqual(scores.shape, (2, 8, 7, 9))
+        self.assertTrue(torch.allclose(scores, expected, atol=1e-5))
+
+        weights = torch.softmax(scores, dim=-1)
+        expected = torch.matmul(weights, repeat_kv(value, 4))
+        output = grouped_matmul_av(weights, value)
+        self.assertEqual(output.shape, (2, 8, 7, 16))
+        self.assertTrue(torch.allclose(output, expected, atol=1e-5))
+
+    def test_grouped_sdpa(self):
+        torch.manual_seed(0)
+        query = torch.randn(2, 8, 7, 16)
+        key = torch.randn(2, 2, 7, 16)
+        value = torch.randn(2, 2, 7, 16)
+        for kwargs in [dict(is_causal=True), dict(attn_mask=torch.randn(2, 1, 7, 7))]:
+            expected = torch.nn.functional.scaled_dot_product_attention(query, repeat_kv(key, 4), repeat_kv(value, 4), **kwargs)
+            output = grouped_scaled_dot_product_attention(query, key, value, **kwargs)
+            self.assertTrue(torch.allclose(output, expected, atol=1e-5))
+
+    def test_loss_parity(self):
+        samples = get_samples([17, 40, None, 3, 64])
+        for attn_implementation in ["eager", "sdpa"]:
+            for model in get_tiny_gqa_models(attn_implementation):
+                expanded = expand_kv_heads(model)
+                grouped_losses = validation.compute_losses_regular(model, samples, "cpu")
+                expanded_losses = validation.compute_losses_regular(expanded, samples, "cpu")
+                for loss, expected in zip(grouped_losses, expanded_losses):
+                    if expected == float('inf'):
+                        self.assertEqual(loss, float('inf'))
+                    else:
+                        self.assertAlmostEqual(loss, expected, places=3, msg=f'{type(model).__name__} {attn_implementation}')
+
+
+if __name__ == "__main__":
+    unittest.main()
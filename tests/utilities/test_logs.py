@@ -0,0 +1,85 @@
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import time
+import unittest
+
+from bittensor.btlogging.defines import BITTENSOR_LOGGER_NAME
+
+from utilities import logs
+
+
+def log_forever(log_queue, level):
+    logs.forward_logging_to_queue(log_queue, level)
+    while True:
+        logs.logger.info("x"*1000)
+
+
+def log_once(log_queue, level, msg):
+    logs.forward_logging_to_queue(log_queue, level)
+    logs.logger.info(msg)
+
+
+class TestLogs(unittest.TestCase):
+    def test_logger_name(self):
+        # Records of modules that don't import bittensor go to the bt.logging handlers
+        self.assertEqual(logs.logger.name, BITTENSOR_LOGGER_NAME)
+
+    def test_get_log_queue(self):
+        self.assertIsNone(logs.get_log_queue("fork"))
+        log_queue = logs.get_log_queue("spawn")
+        self.assertIsNotNone(log_queue)
+        # One channel for all children
+        self.assertIs(log_queue, logs.get_log_queue("spawn"))
+
+    def test_child_queue_handler(self):
+        def record(level, msg):
+            return logging.makeLogRecord(dict(name="test", levelno=level, levelname=logging.getLevelName(level), msg=msg))
+
+        log_queue = queue.Queue(maxsize=4)
+        handler = logs._ChildQueueHandler(log_queue, debug_rate=2)
+        for i in range(5):
+            handler.handle(record(logging.DEBUG, f"debug {i}"))
+        # Debug records beyond the rate are dropped
+        self.assertEqual(log_queue.qsize(), 2)
+        self.assertEqual(handler.n_dropped, 3)
+        # Drops are reported with the next forwarded record
+        handler.handle(record(logging.INFO, "info"))
+        self.assertEqual(log_queue.qsize(), 4)
+        self.assertEqual(handler.n_dropped, 0)
+        # A full queue drops records instead of blocking
+        handler.handle(record(logging.INFO, "info"))
+        self.assertEqual(log_queue.qsize(), 4)
+        self.assertEqual(handler.n_dropped, 1)
+
+
+    def test_child_killed_while_logging(self):
+        ctx = multiprocessing.get_context("spawn")
+        log_queue = logs.get_log_queue("spawn")
+        received = queue.Queue()
+        handler = logging.handlers.QueueHandler(received)
+        level = logs.logger.level
+        logs.logger.addHandler(handler)
+        logs.logger.setLevel(logging.INFO)
+        try:
+            process = ctx.Process(target=log_forever, args=(log_queue, logging.INFO))
+            process.start()
+            received.get(timeout=60)
+            process.kill()
+            process.join()
+
+            # Other children can still log
+            process = ctx.Process(target=log_once, args=(log_queue, logging.INFO, "after kill"))
+            process.start()
+            process.join(timeout=60)
+            deadline = time.monotonic() + 60
+            while received.get(timeout=max(deadline - time.monotonic(), 0)).getMessage() != "after kill":
+                pass
+        finally:
+            logs.logger.removeHandler(handler)
+            logs.logger.setLevel(level)
+
+
+if __name__ == "__main__":
+    unittest.main()
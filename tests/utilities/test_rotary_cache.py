@@ -0,0 +1,62 @@
+import unittest
+
+import torch
+
+from tests.pretrain.test_validation import get_tiny_llama
+from tests.utilities.test_sliced_model import get_tiny_phi
+from utilities.rotary_cache import clear_rotary_cache, get_rope_key, get_rotary_cos_sin, get_rotary_table
+
+
+def get_reference_cos_sin(inv_freq, position_ids, dtype, attention_scaling=1.0):
+    """cos/sin as computed by LlamaRotaryEmbedding.forward()."""
+    inv_freq_expanded = inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1)
+    freqs = (inv_freq_expanded @ position_ids[:, None, :].float()).transpose(1, 2)
+    emb = torch.cat((freqs, freqs), dim=-1)
+    return (emb.cos() * attention_scaling).to(dtype), (emb.sin() * attention_scaling).to(dtype)
+
+
+class TestRotaryCache(unittest.TestCase):
+    def test_get_rotary_cos_sin(self):
+        clear_rotary_cache()
+        inv_freq = 1.0 / (10000 ** (torch.arange(0, 16, 2, dtype=torch.int64).float() / 16))
+        rope_key = get_rope_key(inv_freq)
+        for position_ids, dtype in [
+            (torch.arange(7)[None], torch.float32),
+            (torch.arange(300)[None], torch.float32),
+            (torch.tensor([[3, 4, 5], [0, 1, 2]]), torch.float32),
+            (torch.arange(9)[None], torch.bfloat16),
+        ]:
+            cos, sin = get_rotary_cos_sin(rope_key, position_ids, dtype)
+            expected_cos, expected_sin = get_reference_cos_sin(inv_freq, position_ids, dtype)
+            self.assertEqual(cos.dtype, dtype)
+            self.assertTrue(torch.equal(cos, expected_cos))
+            self.assertTrue(torch.equal(sin, expected_sin))
+        # Shorter tables are views of the cached one
+        long_cos, _ = get_rotary_table(rope_key, 300, torch.float32, 'cpu')
+        short_cos, _ = get_rotary_table(rope_key, 17, torch.float32, 'cpu')
+        self.assertEqual(short_cos.data_ptr(), long_cos.data_ptr())
+
+    def test_shared_between_models(self):
+        clear_rotary_cache()
+        position_ids = torch.arange(11)[None]
+        x = torch.zeros(1, 11, 32)
+        tables = []
+        for model in [get_tiny_llama(), get_tiny_llama()]:
+            cos, _ = model.model.rotary_emb(x, position_ids)
+            tables.append(get_rotary_table(get_rope_key(model.model.rotary_emb.inv_freq), 11, torch.float32, 'cpu')[0])
+            expected_cos, _ = get_reference_cos_sin(model.model.rotary_emb.inv_freq, position_ids, torch.float32)
+            self.assertTrue(torch.equal(cos, expected_cos))
+        self.assertEqual(tables[0].data_ptr(), tables[1].data_ptr())
+
+    def test_phi_tables(self):
+        clear_rotary_cache()
+        phi = get_tiny_phi()
+        rotary_emb = phi.model.layers[0].self_attn.rotary_emb
+        x = torch.zeros(1, 4, 11, 8)
+        cos, sin = rotary_emb(x, seq_len=11)
+        self.assertTrue(torch.allclose(cos, rotary_emb.cos_cached[:11], atol=1e-6))
+        self.assertTrue(torch.allclose(sin, rotary_emb.sin_cached[:11], atol=1e-6))
+
+
+if __name__ == "__main__":
+    unittest.main()
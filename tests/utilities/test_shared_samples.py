@@ -0,0 +1,59 @@
+import functools
+import os
+import pickle
+import unittest
+
+import torch
+
+from tests.pretrain.test_validation import get_samples
+from utilities.shared_samples import SharedSamples, get_sample_tensors
+from utilities.worker_pool import WorkerPool
+
+
+def sum_tokens(batches):
+    return [None if batch is None else int(batch.sum()) for batch in get_sample_tensors(batches)]
+
+
+class TestSharedSamples(unittest.TestCase):
+    def test_round_trip(self):
+        samples = get_samples([10, None, 1, 300])
+        shared = SharedSamples.create(samples)
+        try:
+            self.assertEqual(len(shared), 4)
+            tensors = pickle.loads(pickle.dumps(shared)).tensors()
+            self.assertIsNone(tensors[1])
+            for sample, tensor in zip(samples, tensors):
+                if sample is not None:
+                    self.assertEqual(tensor.dtype, torch.int64)
+                    self.assertTrue(torch.equal(sample, tensor))
+            # Converted once per process
+            self.assertIs(tensors, shared.tensors())
+        finally:
+            shared.close()
+        self.assertFalse(os.path.exists(shared.path))
+
+    def test_pickle_size(self):
+        small = SharedSamples.create(get_samples([10]))
+        large = SharedSamples.create(get_samples([1000]*100))
+        try:
+            self.assertEqual(len(pickle.dumps(small)), len(pickle.dumps(large)))
+            # Copies don't own the file
+            pickle.loads(pickle.dumps(large)).close()
+            self.assertTrue(os.path.exists(large.path))
+        finally:
+            small.close()
+            large.close()
+
+    def test_worker(self):
+        samples = get_samples([10, None, 20])
+        shared = SharedSamples.create(samples)
+        pool = WorkerPool(n_workers=1, mode="spawn", name="test")
+        try:
+            self.assertEqual(sum_tokens(samples), pool.run(functools.partial(sum_tokens, shared), ttl=60))
+        finally:
+            pool.shutdown()
+            shared.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+import torch
+
+from tests.pretrain.test_validation import get_samples, get_tiny_llama
+from utilities.slice_loader import SliceLoader
+
+
+@unittest.skipUnless(torch.cuda.is_available(), "requires CUDA")
+class TestSliceLoader(unittest.TestCase):
+    def test_load_unload(self):
+        model = get_tiny_llama()
+        state = {k: v.clone() for k, v in model.state_dict().items()}
+        loader = SliceLoader("cuda")
+        loader.load(model)
+        loader.wait(model)
+        for p in model.parameters():
+            self.assertEqual(p.device.type, "cuda")
+        loader.unload(model)
+        for k, v in model.state_dict().items():
+            self.assertEqual(v.device.type, "cpu")
+            self.assertTrue(torch.equal(v, state[k]))
+
+    def test_evaluate_samples_streamed(self):
+        samples = get_samples([17, 40, None, 3, 64])
+        losses = {}
+        for stream_slices in [False, True]:
+            model = get_tiny_llama()
+            sliced = model.sliced(n_slices=3, device="cuda", stream_slices=stream_slices)
+            with torch.no_grad():
+                losses[stream_slices] = sliced.evaluate_samples(samples, reduction='sum')
+        for loss, loss_streamed in zip(losses[False], losses[True]):
+            if loss == float('inf'):
+                self.assertEqual(loss_streamed, float('inf'))
+            else:
+                self.assertAlmostEqual(loss, loss_streamed, places=3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+
+import torch
+
+from tests.pretrain.test_validation import get_samples, get_tiny_llama
+from utilities.slice_planner import get_param_bytes, plan_resident_slices, plan_slices, plan_start_layers
+
+
+def get_param_bytes_heavy_ends(n_layers=8):
+    # Embeddings and lm_head are much heavier than a decoder layer
+    return {'embed': 10, 'layers': [1]*n_layers, 'tail': 10, 'shared': 0}
+
+
+class TestSlicePlanner(unittest.TestCase):
+    def test_plan_single_slice(self):
+        self.assertEqual(plan_start_layers(get_param_bytes_heavy_ends(), 28), [0])
+
+    def test_plan_uneven(self):
+        # An even split in 3 slices ([0, 2, 5]) would need 13 bytes for the last slice
+        self.assertEqual(plan_start_layers(get_param_bytes_heavy_ends(), 11), [0, 1, 7])
+        # Overhead applies to all slices, last_overhead only to the last one
+        self.assertEqual(plan_start_layers(get_param_bytes_heavy_ends(), 12, layer_overhead=1), [0, 1, 7])
+        self.assertIsNone(plan_start_layers(get_param_bytes_heavy_ends(), 11, last_overhead=1))
+
+    def test_plan_streamed(self):
+        param_bytes = get_param_bytes_heavy_ends()
+        self.assertEqual(plan_start_layers(param_bytes, 26), [0, 4])
+        # Consecutive slices need to fit at the same time
+        self.assertEqual(plan_start_layers(param_bytes, 26, stream_slices=True), [0, 1, 7])
+
+    def test_plan_allow_single(self):
+        self.assertEqual(plan_start_layers(get_param_bytes_heavy_ends(), 28, allow_single=False), [0, 4])
+
+    def test_plan_impossible(self):
+        self.assertIsNone(plan_start_layers(get_param_bytes_heavy_ends(), 10))
+
+    def test_get_param_bytes(self):
+        model = get_tiny_llama()
+        param_bytes = get_param_bytes(model)
+        self.assertEqual(len(param_bytes['layers']), model.config.num_hidden_layers)
+        self.assertEqual(len(set(param_bytes['layers'])), 1)
+        total = param_bytes['embed'] + sum(param_bytes['layers']) + param_bytes['tail'] + param_bytes['shared']
+        self.assertEqual(total, sum(p.numel()*p.element_size() for p in model.parameters()))
+        self.assertEqual(param_bytes['embed'], model.model.embed_tokens.weight.numel()*4)
+
+    def test_plan_slices(self):
+        model = get_tiny_llama()
+        samples = get_samples([17, 40, None, 3, 64])
+        self.assertEqual(plan_slices(model, samples, 10**9), [0])
+        budgets = range(100000, 2000000, 20000)
+        plans = [plan_slices(model, samples, budget) for budget in budgets]
+        n_slices = [len(plan) for plan in plans if plan is not None]
+        # More memory never needs more slices
+        self.assertEqual(n_slices, sorted(n_slices, reverse=True))
+        self.assertGreater(n_slices[0], 1)
+        self.assertEqual(n_slices[-1], 1)
+        # Batched unsliced evaluation needs more memory than evaluating samples one by one
+        budget = budgets[plans.index([0])]
+        self.assertNotEqual(plan_slices(model, samples, budget, batch_tokens=4096), [0])
+
+    def test_plan_resident_slices(self):
+        model = get_tiny_llama()
+        samples = get_samples([17, 40, 3, 64]*8)
+        start_layers = [0, 1, 2, 3]
+        param_bytes = get_param_bytes(model)
+        first_slice_bytes = param_bytes['embed'] + param_bytes['layers'][0] + param_bytes['shared']
+        # Plenty of memory for all states: nothing to gain from pinning slices
+        self.assertEqual(plan_resident_slices(model, samples, start_layers, 10**6), (1, 10**6))
+        # Two groups either way; pinning the first slice saves loading it twice
+        resident_slices, state_budget = plan_resident_slices(model, samples, start_layers, 120000)
+        self.assertEqual((resident_slices, state_budget), (2, 120000 - first_slice_bytes))
+
+        losses = {}
+        for schedule, resident_slices in [('slice', 1), ('group', resident_slices)]:
+            sliced = get_tiny_llama().sliced(
+                start_layers=list(start_layers), device='cpu', schedule=schedule,
+                state_budget=state_budget, resident_slices=resident_slices
+            )
+            schedule, groups = sliced.choose_schedule(samples)
+            if schedule == 'group':
+                self.assertEqual(len(groups), 2)
+            with torch.no_grad():
+                losses[schedule] = sliced.evaluate_samples(samples, reduction='sum')
+        self.assertEqual(losses['group'], losses['slice'])
+
+
+if __name__ == "__main__":
+    unittest.main()
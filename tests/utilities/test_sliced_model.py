@@ -0,0 +1,145 @@
+import unittest
+
+import torch
+
+from neurons import validation
+from tests.pretrain.test_validation import get_samples, get_tiny_llama
+from transformers_phi import PhiConfig, SlicedPhiForCausalLM
+from transformers_phi3 import Phi3Config, SlicedPhi3ForCausalLM
+from utilities.sliced_model import SliceAdapter, SlicedModelWrapper, get_slice_adapter
+
+
+def get_tiny_phi():
+    config = PhiConfig(
+        vocab_size=128,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        max_position_embeddings=256,
+        attn_implementation="eager",
+    )
+    torch.manual_seed(0)
+    return SlicedPhiForCausalLM(config).eval()
+
+
+def get_tiny_phi3():
+    config = Phi3Config(
+        vocab_size=128,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        max_position_embeddings=256,
+        pad_token_id=0,
+        attn_implementation="eager",
+    )
+    torch.manual_seed(0)
+    return SlicedPhi3ForCausalLM(config).eval()
+
+
+class TestSlicedModel(unittest.TestCase):
+    def test_classify(self):
+        adapter = SliceAdapter(final_norm=('model.final_layernorm',))
+        self.assertEqual(adapter.classify('model.embed_tokens.weight'), ('embed', None))
+        self.assertEqual(adapter.classify('model.layers.11.mlp.fc1.weight'), ('layer', 11))
+        self.assertEqual(adapter.classify('model.final_layernorm.bias'), ('tail', None))
+        self.assertEqual(adapter.classify('lm_head.weight'), ('tail', None))
+        self.assertEqual(adapter.classify('model.rotary_emb.inv_freq'), ('shared', None))
+
+    def test_filter_params(self):
+        for model in [get_tiny_llama(), get_tiny_phi(), get_tiny_phi3()]:
+            sliced = model.sliced(n_slices=2, device='cpu')
+            self.assertIsInstance(sliced, SlicedModelWrapper)
+            first = sliced.filter_params(layer_from=0, layer_to=2)['param_names_kept']
+            last = sliced.filter_params(layer_from=2, layer_to=4)['param_names_kept']
+            self.assertIn('model.embed_tokens.weight', first)
+            self.assertNotIn('model.embed_tokens.weight', last)
+            self.assertIn('lm_head.weight', last)
+            self.assertNotIn('lm_head.weight', first)
+            self.assertTrue(any('layers.1.' in name for name in first))
+            self.assertFalse(any('layers.2.' in name for name in first))
+            # Every parameter is in exactly one slice
+            n_params = len(list(model.named_parameters()))
+            self.assertEqual(len(first) + len(last), n_params)
+
+    def test_sliced_equals_regular(self):
+        samples = get_samples([17, 40, None, 3, 64])
+        for get_model in [get_tiny_llama, get_tiny_phi, get_tiny_phi3]:
+            model = get_model()
+            self.assertIsNotNone(get_slice_adapter(model))
+            regular = validation.compute_losses_regular(model, samples, "cpu")
+            sliced = validation.compute_losses_sliced(model, samples, "cpu", n_slices=3)
+            for loss_regular, loss_sliced in zip(regular, sliced):
+                if loss_regular == float('inf'):
+                    self.assertEqual(loss_sliced, float('inf'))
+                else:
+                    self.assertAlmostEqual(loss_regular, loss_sliced, places=3)
+
+    def test_grouped_schedule(self):
+        samples = get_samples([17, 40, None, 3, 64])
+        losses = {}
+        for schedule, resident_slices in [('slice', 1), ('group', 1), ('group', 2), ('group', 3)]:
+            model = get_tiny_llama()
+            # Room for the states of about two samples per group
+            sliced = model.sliced(n_slices=3, device='cpu', schedule=schedule, state_budget=60*32*4, resident_slices=resident_slices)
+            self.assertEqual(sliced.choose_schedule(samples)[0], schedule)
+            with torch.no_grad():
+                losses[(schedule, resident_slices)] = sliced.evaluate_samples(samples, reduction='sum')
+        for key, key_losses in losses.items():
+            self.assertEqual(key_losses, losses[('slice', 1)], key)
+
+    def test_unload_keeps_host_tensors(self):
+        model = get_tiny_llama()
+        sliced = model.sliced(n_slices=2, device='meta')
+        model_slice = sliced.slices[0]
+        data_ptrs = [p.data_ptr() for p in model_slice.parameters()]
+        sliced.load_slice(model_slice)
+        self.assertTrue(all(p.device.type == 'meta' for p in model_slice.parameters()))
+        # Releasing a slice puts back its host tensors, without copying the weights back
+        sliced.unload_slice(model_slice)
+        self.assertEqual([p.data_ptr() for p in model_slice.parameters()], data_ptrs)
+        self.assertTrue(all(p.device.type == 'cpu' for p in model_slice.parameters()))
+
+    def test_oom_failed(self):
+        samples = get_samples([17, 40, None, 3, 64])
+        for schedule in ['slice', 'group']:
+            model = get_tiny_llama()
+            sliced = model.sliced(n_slices=2, device='cpu', schedule=schedule, state_budget=60*32*4)
+            layer = sliced.slices[1].model.layers[2]
+            forward = layer.forward
+
+            # Long samples run out of memory, sample 0 fails otherwise
+            def forward_failing(hidden_states, *args, **kwargs):
+                if hidden_states.shape[1] > 32:
+                    raise torch.cuda.OutOfMemoryError("CUDA out of memory")
+                if hidden_states.shape[1] == 17:
+                    raise ValueError("expected")
+                return forward(hidden_states, *args, **kwargs)
+            layer.forward = forward_failing
+
+            oom_failed = []
+            with torch.no_grad():
+                losses = sliced.evaluate_samples(samples, reduction='sum', oom_failed=oom_failed)
+            self.assertEqual(sorted(oom_failed), [1, 4], schedule)
+            self.assertEqual([i for i, loss in enumerate(losses) if loss == float('inf')], [0, 1, 2, 4], schedule)
+
+    def test_choose_schedule(self):
+        samples = get_samples([17, 40, None, 3, 64])
+        state_bytes = sum(sample.shape[-1] for sample in samples if sample is not None)*32*4
+        model = get_tiny_llama()
+        # All states fit: slice-major moves every slice once
+        sliced = model.sliced(n_slices=3, device='cpu', schedule='auto', state_budget=state_bytes)
+        self.assertEqual(sliced.choose_schedule(samples), ('slice', None))
+        # States don't fit on the device
+        sliced.state_budget = state_bytes - 1
+        schedule, groups = sliced.choose_schedule(samples)
+        self.assertEqual(schedule, 'group')
+        self.assertEqual(sorted(sum(groups, [])), [0, 1, 3, 4])
+        # No budget known
+        sliced.state_budget = None
+        self.assertEqual(sliced.choose_schedule(samples), ('slice', None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import tempfile
+import unittest
+
+import torch
+
+from tests.pretrain.test_validation import get_samples, get_tiny_llama
+from utilities.state_store import STATE_STORE_TYPES, make_state_store
+
+
+class TestStateStore(unittest.TestCase):
+    def test_store_and_fetch(self):
+        states = [torch.randn(1, 5, 8), None, torch.randn(1, 7, 8).to(torch.bfloat16)]
+        with tempfile.TemporaryDirectory() as path:
+            for store_type in STATE_STORE_TYPES:
+                store = make_state_store(store_type, 'cpu', path)
+                store.extend([None]*len(states))
+                for i, state in enumerate(states):
+                    store[i] = state
+                self.assertEqual(store.numel(), 5*8 + 7*8)
+                self.assertEqual(store.nbytes(), 5*8*4 + 7*8*2)
+                self.assertIn(store.location, store.describe())
+                for i, state in enumerate(states):
+                    if state is None:
+                        self.assertIsNone(store[i])
+                    else:
+                        self.assertEqual(store[i].dtype, state.dtype)
+                        self.assertTrue(torch.equal(store[i], state))
+
+                # Overwrite with a larger and a smaller state
+                store[0] = torch.ones(1, 9, 8)
+                store[2] = torch.zeros(1, 2, 8)
+                self.assertTrue(torch.equal(store[0], torch.ones(1, 9, 8)))
+                self.assertTrue(torch.equal(store[2], torch.zeros(1, 2, 8)))
+                store[0] = None
+                self.assertIsNone(store[0])
+                store.close()
+
+    def test_sliced_eval(self):
+        samples = get_samples([17, 40, None, 3, 64])
+        losses = {}
+        with tempfile.TemporaryDirectory() as path:
+            for store_type in STATE_STORE_TYPES:
+                model = get_tiny_llama()
+                sliced = model.sliced(n_slices=3, device='cpu', state_store=store_type, state_store_path=path)
+                with torch.no_grad():
+                    losses[store_type] = sliced.evaluate_samples(samples, reduction='sum')
+        for store_type in STATE_STORE_TYPES:
+            self.assertEqual(losses[store_type], losses['device'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import functools
+import os
+import sys
+import threading
+import time
+import unittest
+
+from utilities.worker_pool import WorkerPool, _main_module
+
+
+def add(a: int, b: int):
+    return a + b
+
+
+def get_pid():
+    return os.getpid()
+
+
+def get_main_module():
+    return getattr(sys.modules['__main__'].__spec__, 'name', None)
+
+
+def sleep_and_add(a: int, b: int):
+    time.sleep(3)
+    return a + b
+
+
+def raise_value_error():
+    raise ValueError("expected")
+
+
+def exit_process():
+    os._exit(1)
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = WorkerPool(n_workers=1, mode="fork", name="test")
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_run(self):
+        self.assertEqual(3, self.pool.run(functools.partial(add, 1, 2), ttl=5))
+
+    def test_worker_is_reused(self):
+        pid = self.pool.run(functools.partial(get_pid), ttl=5)
+        self.assertNotEqual(os.getpid(), pid)
+        self.assertEqual(pid, self.pool.run(functools.partial(get_pid), ttl=5))
+
+    def test_exception(self):
+        pid = self.pool.run(functools.partial(get_pid), ttl=5)
+        with self.assertRaises(ValueError):
+            self.pool.run(functools.partial(raise_value_error), ttl=5, expected_errors={"ValueError"})
+        # Regular exceptions don't require a new worker
+        self.assertEqual(pid, self.pool.run(functools.partial(get_pid), ttl=5))
+
+    def test_timeout_replaces_worker(self):
+        pid = self.pool.run(functools.partial(get_pid), ttl=5)
+        with self.assertRaises(TimeoutError):
+            self.pool.run(functools.partial(sleep_and_add, 1, 2), ttl=1)
+        self.assertNotEqual(pid, self.pool.run(functools.partial(get_pid), ttl=5))
+        self.assertEqual(3, self.pool.run(functools.partial(add, 1, 2), ttl=5))
+
+    def test_worker_death_replaces_worker(self):
+        pid = self.pool.run(functools.partial(get_pid), ttl=5)
+        with self.assertRaises(Exception):
+            self.pool.run(functools.partial(exit_process), ttl=5)
+        self.assertNotEqual(pid, self.pool.run(functools.partial(get_pid), ttl=5))
+
+    def test_failed_replacement_is_retried(self):
+        start_worker = self.pool._start_worker
+
+        def start_worker_failing():
+            raise OSError("expected")
+
+        self.pool._start_worker = start_worker_failing
+        with self.assertRaises(TimeoutError):
+            self.pool.run(functools.partial(sleep_and_add, 1, 2), ttl=1)
+        # The stopped worker is dropped, not handed the next task
+        self.assertEqual(self.pool.workers, [])
+        self.pool._start_worker = start_worker
+        self.assertEqual(3, self.pool.run(functools.partial(add, 1, 2), ttl=5))
+        self.assertEqual(len(self.pool.workers), 1)
+
+    def test_max_tasks(self):
+        self.pool.shutdown()
+        self.pool = WorkerPool(n_workers=1, mode="fork", max_tasks=2, name="test")
+        pid_a = self.pool.run(functools.partial(get_pid), ttl=5)
+        pid_b = self.pool.run(functools.partial(get_pid), ttl=5)
+        pid_c = self.pool.run(functools.partial(get_pid), ttl=5)
+        self.assertEqual(pid_a, pid_b)
+        self.assertNotEqual(pid_b, pid_c)
+
+    def test_main_module(self):
+        main = sys.modules['__main__']
+        with _main_module('utilities.logs'):
+            self.assertEqual(sys.modules['__main__'].__name__, 'utilities.logs')
+        self.assertIs(sys.modules['__main__'], main)
+        # Concurrent worker starts restore the original __main__
+        errors = []
+
+        def enter_main_module(name):
+            try:
+                with _main_module(name):
+                    time.sleep(0.01)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=enter_main_module, args=(name,)) for name in ['utilities.logs', 'utilities.worker_pool']*4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertIs(sys.modules['__main__'], main)
+
+    def test_spawned_main_module(self):
+        pool = WorkerPool(n_workers=1, mode="spawn", name="test", main_module="utilities.logs")
+        try:
+            self.assertEqual(pool.run(functools.partial(get_main_module), ttl=60), 'utilities.logs')
+        finally:
+            pool.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -20,9 +20,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import math
-import copy
-import numpy as np
-import warnings
 from typing import List, Optional, Tuple, Union
 
 import torch
@@ -50,10 +47,15 @@ from transformers.utils import (
     add_start_docstrings,
     add_start_docstrings_to_model_forward,
     is_flash_attn_greater_or_equal_2_10,
+    is_torchdynamo_compiling,
     logging,
     replace_return_docstrings,
 )
 from .configuration_llama import LlamaConfig
+from utilities.causal_mask import get_causal_mask
+from utilities.grouped_attention import grouped_matmul_av, grouped_matmul_qk, grouped_scaled_dot_product_attention
+from utilities.rotary_cache import get_module_rope_key, get_rotary_cos_sin
+from utilities.sliced_model import SliceAdapter, SlicedModelWrapper
 
 
 logger = logging.get_logger(__name__)
@@ -114,6 +116,44 @@ def _prepare_4d_causal_attention_mask_with_cache_position(
     return causal_mask
 
 
+def _prepare_4d_packed_causal_mask(
+    position_ids: torch.Tensor,
+    dtype: torch.dtype,
+    device: torch.device,
+    min_dtype: float,
+):
+    """
+    Creates a block-diagonal causal 4D mask of shape `(batch_size, 1, sequence_length, sequence_length)` for
+    sequences containing several packed documents. Each document restarts its `position_ids` at 0, and tokens
+    only attend to earlier tokens of the same document.
+
+    Args:
+        position_ids (`torch.Tensor`):
+            Position ids of shape `(batch_size, sequence_length)`, restarting at 0 for every document.
+        dtype (`torch.dtype`):
+            The dtype to use for the 4D attention mask.
+        device (`torch.device`):
+            The device to place the 4D attention mask on.
+        min_dtype (`float`):
+            The minimum value representable with the dtype `dtype`.
+    """
+    sequence_length = position_ids.shape[-1]
+    document_ids = torch.cumsum(position_ids == 0, dim=-1).to(device)
+    causal = torch.ones((sequence_length, sequence_length), dtype=torch.bool, device=device).tril()
+    allowed = causal[None, :, :] & (document_ids[:, :, None] == document_ids[:, None, :])
+    causal_mask = torch.zeros(allowed.shape, dtype=dtype, device=device).masked_fill_(~allowed, min_dtype)
+    return causal_mask[:, None, :, :]
+
+
+def _is_packed_sequence(position_ids: Optional[torch.Tensor]) -> bool:
+    """
+    Returns True if `position_ids` restart at 0 within the sequence, i.e. multiple documents are packed together.
+    """
+    if position_ids is None or position_ids.shape[-1] <= 1:
+        return False
+    return bool((position_ids[:, 1:] == 0).any())
+
+
 class LlamaRMSNorm(nn.Module):
     def __init__(self, hidden_size, eps=1e-6):
         """
@@ -204,6 +244,11 @@ class LlamaRotaryEmbedding(nn.Module):
     def forward(self, x, position_ids):
         if "dynamic" in self.rope_type:
             self._dynamic_frequency_update(position_ids, device=x.device)
+        elif not is_torchdynamo_compiling():
+            # Static frequencies: look up positions in the table shared by all slices and models with this rope config
+            # (compiled graphs compute them inline)
+            rope_key = get_module_rope_key(self, self.attention_scaling)
+            return get_rotary_cos_sin(rope_key, position_ids, x.dtype)
 
         # Core RoPE block
         inv_freq_expanded = self.inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1)
@@ -424,10 +469,9 @@ class LlamaAttention(nn.Module):
             cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
+        # Key/value heads are shared by groups of query heads, see grouped_matmul_qk()
 
-        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+        attn_weights = grouped_matmul_qk(query_states, key_states) / math.sqrt(self.head_dim)
 
         if attention_mask is not None:  # no matter the length, we just slice it
             causal_mask = attention_mask[:, :, :, : key_states.shape[-2]]
@@ -436,7 +480,7 @@ class LlamaAttention(nn.Module):
         # upcast attention to fp32
         attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
         attn_weights = nn.functional.dropout(attn_weights, p=self.attention_dropout, training=self.training)
-        attn_output = torch.matmul(attn_weights, value_states)
+        attn_output = grouped_matmul_av(attn_weights, value_states)
 
         if attn_output.size() != (bsz, self.num_heads, q_len, self.head_dim):
             raise ValueError(
@@ -645,8 +689,7 @@ class LlamaSdpaAttention(LlamaAttention):
             cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
+        # Key/value heads are shared by groups of query heads, see grouped_scaled_dot_product_attention()
 
         causal_mask = attention_mask
         if attention_mask is not None:
@@ -663,7 +706,7 @@ class LlamaSdpaAttention(LlamaAttention):
         # in SDPA to support both torch.compile's dynamic shapes and full graph options. An inline conditional prevents dynamic shapes from compiling.
         is_causal = True if causal_mask is None and q_len > 1 else False
 
-        attn_output = torch.nn.functional.scaled_dot_product_attention(
+        attn_output = grouped_scaled_dot_product_attention(
             query_states,
             key_states,
             value_states,
@@ -799,6 +842,8 @@ class LlamaPreTrainedModel(PreTrainedModel):
     _supports_cache_class = True
     _supports_quantized_cache = True
     _supports_static_cache = True
+    # Multiple documents can be packed in one sequence, using position_ids restarting at 0 per document
+    _supports_packed_sequences = True
 
     def _init_weights(self, module):
         std = self.config.initializer_range
@@ -976,7 +1021,7 @@ class LlamaModel(LlamaPreTrainedModel):
             position_ids = cache_position.unsqueeze(0)
 
         causal_mask = self._update_causal_mask(
-            attention_mask, inputs_embeds, cache_position, past_key_values, output_attentions
+            attention_mask, inputs_embeds, cache_position, past_key_values, output_attentions, position_ids
         )
         hidden_states = inputs_embeds
 
@@ -1061,6 +1106,7 @@ class LlamaModel(LlamaPreTrainedModel):
         cache_position: torch.Tensor,
         past_key_values: Cache,
         output_attentions: bool,
+        position_ids: Optional[torch.Tensor] = None,
     ):
         # TODO: As of torch==2.2.0, the `attention_mask` passed to the model in `generate` is 2D and of dynamic length even when the static
         # KV cache is used. This is an issue for torch.compile which then recaptures cudagraphs at each decode steps due to the dynamic shapes.
@@ -1070,14 +1116,35 @@ class LlamaModel(LlamaPreTrainedModel):
         if self.config._attn_implementation == "flash_attention_2":
             if attention_mask is not None and 0.0 in attention_mask:
                 return attention_mask
+            # Packed sequences are handled by _flash_attention_forward(), using cu_seqlens derived from position_ids
             return None
 
+        past_seen_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
+
+        # Packed documents: isolate attention per document with a block-diagonal causal mask
+        if attention_mask is None and past_seen_tokens == 0 and _is_packed_sequence(position_ids):
+            return _prepare_4d_packed_causal_mask(
+                position_ids,
+                dtype=input_tensor.dtype,
+                device=input_tensor.device,
+                min_dtype=torch.finfo(input_tensor.dtype).min,
+            )
+
         # For SDPA, when possible, we will rely on its `is_causal` argument instead of its `attn_mask` argument, in
         # order to dispatch on Flash Attention 2. This feature is not compatible with static cache, as SDPA will fail
         # to infer the attention mask.
-        past_seen_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
         using_static_cache = isinstance(past_key_values, StaticCache)
 
+        # Without padding and cached tokens, attention is plain causal: SDPA then uses its `is_causal`
+        # argument (also when tracing, unlike `_ignore_causal_mask_sdpa()`), while other implementations
+        # get a view of a cached mask, instead of a new [batch, 1, seq, seq] mask in every forward.
+        if attention_mask is None and past_seen_tokens == 0 and not using_static_cache:
+            if self.config._attn_implementation == "sdpa" and not output_attentions:
+                return None
+            sequence_length = input_tensor.shape[1]
+            causal_mask = get_causal_mask(sequence_length, sequence_length + 1, input_tensor.dtype, input_tensor.device)
+            return causal_mask.expand(input_tensor.shape[0], -1, -1, -1)
+
         # When output attentions is True, sdpa implementation's forward method calls the eager implementation's forward
         if self.config._attn_implementation == "sdpa" and not using_static_cache and not output_attentions:
             if AttentionMaskConverter._ignore_causal_mask_sdpa(
@@ -1125,166 +1192,10 @@ class LlamaModel(LlamaPreTrainedModel):
 
         return causal_mask
 
-class SlicedLlamaForCausalLMWrapper:
-    def __init__(self, model=None, n_slices=2, start_layers=None, device=None):
-        self.model = model
-        self.device = device
-        if start_layers is None:
-            start_layers = self.gen_start_layers(model.config.num_hidden_layers,n_slices)
-        start_layers.append(model.config.num_hidden_layers)
-        self.start_layers = start_layers
-        self.gen_slices()
-
-    def __repr__(self):
-        return f'SlicedLlamaForCausalLMWrapper(n_slices={len(self.slices)},device={self.device},start_layers={self.start_layers[:-1]},model={self.model})'
-
-    def __call__(self,*args,**kwargs):
-        raise Exception("cannot call SlicedLlamaForCausalLMWrapper(), use .evaluate_samples() to batch evaluate samples instead")
-
-    def to(self,*args,**kwargs):
-        warnings.warn('No need to .to() on SlicedLlamaForCausalLMWrapper; set the .device property instead')
-
-    def evaluate_samples(self,samples,reduction='mean'):
-        """
-        Evaluate losses of samples on sliced model.
-        """
-        output_states = []
-        for slice_idx,model_slice in enumerate(self.slices):
-            model_slice = model_slice.to(self.device)
-            model_params = model_slice.num_parameters()
-            state_size = sum([s.numel() for s in output_states if s is not None])
-            logger.info(f'evaluating slice {slice_idx}, n_params={model_params}, state_size={state_size}...')
-            losses = self.evaluate_losses_slice(model_slice,samples=samples,output_states=output_states,reduction=reduction)
-            model_slice = model_slice.to('cpu')
-            torch.cuda.empty_cache()
-        return losses
-
-    def evaluate_losses_slice(self,model_slice,samples=None,output_states=[],reduction='mean'):
-        is_first_slice = model_slice.config.start_at_layer == 0
-        is_last_slice = model_slice.config.return_states_at_layer == model_slice.config.num_hidden_layers
-        if len(output_states)==0:
-            output_states.extend([None]*len(samples))
-        losses = None
-        if is_last_slice:
-            losses = [np.inf]*len(samples)
-
-        for i,sample in enumerate(samples):
-            if sample is None:
-                continue
-            ids = None
-            if is_first_slice or is_last_slice:
-                ids = sample.to(self.device)
-            sample_state = None
-            try:
-                if is_first_slice:
-                    # inject token ids
-                    logger.debug(f'evaluating sample {i} of length {len(ids[0])}/{len(sample[0])} in first slice...')
-                    outputs = model_slice.model(input_ids=ids)
-                    sample_state = outputs.last_hidden_state
-                else:
-                    # resume with hidden states
-                    logger.debug(f'evaluating sample {i} in later slice...')
-                    outputs = model_slice.model(inputs_embeds=output_states[i])
-                    sample_state = outputs.last_hidden_state
-            except Exception as e:
-                logger.warning(f'Exception evaluating sample {i}, length {len(sample[0])}: {e}')
-
-            output_states[i] = sample_state
-
-            if not is_last_slice:
-                continue
-            if output_states[i] is None:
-                continue
-
-            # calculate losses
-            logits = model_slice.lm_head(output_states[i][0])
-            logits = logits.float()
-            labels = ids
-            shift_logits = logits[..., :-1, :].contiguous()
-            shift_labels = labels[..., 1:].contiguous()
-            # Flatten the tokens
-            loss_fct = torch.nn.CrossEntropyLoss(reduction=reduction)
-            shift_logits = shift_logits.view(-1, model_slice.config.vocab_size)
-            shift_labels = shift_labels.view(-1)
-            loss = loss_fct(shift_logits, shift_labels)
-            loss_value = loss.detach().item()
-            logger.debug(f'loss: {loss_value}')
-            losses[i] = loss_value
-
-        return losses
-
-    def gen_slices(self):
-        model_data = {}
-        # strip model, restore later
-        for pname, p in self.model.named_parameters():
-            model_data[pname] = p.data
-            p.data = torch.zeros(0)
-
-        self.slices = []
-        for i,layer_from in enumerate(self.start_layers[:-1]):
-            layer_to = self.start_layers[i+1]
-            logger.info(f'Generating slice #{i}: {layer_from}..{layer_to}')
-            params = self.filter_params(layer_from=layer_from,layer_to=layer_to)
-            model_slice = copy.deepcopy(self.model) # copy of empty model
-            for pname,p in model_slice.named_parameters():
-                if pname in params['param_names_kept']:
-                    p.data = model_data[pname]
-            model_slice.config.start_at_layer = layer_from
-            model_slice.config.return_states_at_layer = layer_to
-            self.slices.append(model_slice)
-
-    @staticmethod
-    def gen_start_layers(n_layers,n_slices):
-        """
-        Generate a list of starting indices for each slice, equally distributing layers over n slices.
-        """
-        n_slices = min(n_slices,n_layers)
-        start_layers = [0]
-        while len(start_layers)<n_slices:
-            last_start = start_layers[-1]
-            remaining_slices = n_slices-len(start_layers)
-            remaining_layers = n_layers-last_start
-            next_start = last_start + remaining_layers//(remaining_slices+1)
-            start_layers.append(next_start)
-        return start_layers
-
-    def filter_params(self,layer_from=None,layer_to=None):
-        """
-        Filter parameters to use for a particular range of layers.
-        embed tokens is considered part of the first layer.
-        lm_head and model.norm are considered part of the last layer.
-        rotary_emb is needed for all layers.
-        """
-        params = []
-        param_names_kept = set()
-        param_idx_to_name = {}
-        for pname, p in self.model.named_parameters():
-            if 'embed_tokens' in pname:
-                if layer_from > 0: continue
-            elif 'lm_head' in pname or 'model.norm' in pname:
-                if layer_to < self.model.config.num_hidden_layers: continue
-            elif 'rotary_emb' in pname:
-                pass # keep in all slices (used to be part of layer, now of model, used by all layers)
-            else:
-                keep = False
-                for i in range(layer_from,layer_to):
-                    if f'layers.{i}.' in pname:
-                        keep = True
-                        break
-                if not keep:
-                    continue
-            param_idx_to_name[len(params)] = pname
-            param_names_kept.add(pname)
-            params.append(p)
-        return {
-                'param_idx_to_name':param_idx_to_name,
-                'param_names_kept':param_names_kept,
-                'params':params,
-        }
-
-
 class SlicedLlamaForCausalLM(LlamaPreTrainedModel):
     _tied_weights_keys = ["lm_head.weight"]
+    # Parts of the model for sliced evaluation, see SlicedModelWrapper
+    slice_adapter = SliceAdapter()
 
     def __init__(self, config):
         super().__init__(config)
@@ -1299,7 +1210,7 @@ class SlicedLlamaForCausalLM(LlamaPreTrainedModel):
         """
         Generate a container object with this model sliced into pieces.
         """
-        return SlicedLlamaForCausalLMWrapper(model=self,**kwargs)
+        return SlicedModelWrapper(model=self,**kwargs)
 
     def get_input_embeddings(self):
         return self.model.embed_tokens
@@ -18,9 +18,6 @@
 """PyTorch Phi model."""
 
 import math
-import copy
-import numpy as np
-import warnings
 from typing import List, Optional, Tuple, Union
 
 import torch
@@ -47,10 +44,15 @@ from transformers.utils import (
     get_torch_version,
     is_flash_attn_2_available,
     is_flash_attn_greater_or_equal_2_10,
+    is_torchdynamo_compiling,
     logging,
     replace_return_docstrings,
 )
 from .configuration_phi import PhiConfig
+from utilities.causal_mask import get_causal_mask
+from utilities.grouped_attention import grouped_matmul_av, grouped_matmul_qk, grouped_scaled_dot_product_attention
+from utilities.rotary_cache import get_module_rope_key, get_rotary_table
+from utilities.sliced_model import SliceAdapter, SlicedModelWrapper
 
 
 if is_flash_attn_2_available():
@@ -117,8 +119,49 @@ def _prepare_4d_causal_attention_mask_with_cache_position(
     return causal_mask
 
 
+def _prepare_4d_packed_causal_mask(
+    position_ids: torch.Tensor,
+    dtype: torch.dtype,
+    device: torch.device,
+    min_dtype: float,
+):
+    """
+    Creates a block-diagonal causal 4D mask of shape `(batch_size, 1, sequence_length, sequence_length)` for
+    sequences containing several packed documents. Each document restarts its `position_ids` at 0, and tokens
+    only attend to earlier tokens of the same document.
+
+    Args:
+        position_ids (`torch.Tensor`):
+            Position ids of shape `(batch_size, sequence_length)`, restarting at 0 for every document.
+        dtype (`torch.dtype`):
+            The dtype to use for the 4D attention mask.
+        device (`torch.device`):
+            The device to place the 4D attention mask on.
+        min_dtype (`float`):
+            The minimum value representable with the dtype `dtype`.
+    """
+    sequence_length = position_ids.shape[-1]
+    document_ids = torch.cumsum(position_ids == 0, dim=-1).to(device)
+    causal = torch.ones((sequence_length, sequence_length), dtype=torch.bool, device=device).tril()
+    allowed = causal[None, :, :] & (document_ids[:, :, None] == document_ids[:, None, :])
+    causal_mask = torch.zeros(allowed.shape, dtype=dtype, device=device).masked_fill_(~allowed, min_dtype)
+    return causal_mask[:, None, :, :]
+
+
+def _is_packed_sequence(position_ids: Optional[torch.Tensor]) -> bool:
+    """
+    Returns True if `position_ids` restart at 0 within the sequence, i.e. multiple documents are packed together.
+    """
+    if position_ids is None or position_ids.shape[-1] <= 1:
+        return False
+    return bool((position_ids[:, 1:] == 0).any())
+
+
 # Copied from transformers.models.mixtral.modeling_mixtral.MixtralRotaryEmbedding with Mixtral->Phi
 class PhiRotaryEmbedding(nn.Module):
+    # Subclasses that scale positions or frequencies use their own cache
+    shared_table = True
+
     def __init__(self, dim, max_position_embeddings=2048, base=10000, device=None):
         super().__init__()
 
@@ -127,6 +170,8 @@ class PhiRotaryEmbedding(nn.Module):
         self.base = base
         inv_freq = 1.0 / (self.base ** (torch.arange(0, self.dim, 2, dtype=torch.int64).float().to(device) / self.dim))
         self.register_buffer("inv_freq", inv_freq, persistent=False)
+        # The cos/sin tables are computed from the float32 frequencies, even if the model is cast later
+        self.original_inv_freq = self.inv_freq
 
         # Build here to make `torch.jit.trace` work.
         self._set_cos_sin_cache(
@@ -145,6 +190,12 @@ class PhiRotaryEmbedding(nn.Module):
 
     def forward(self, x, seq_len=None):
         # x: [bs, num_attention_heads, seq_len, head_size]
+        if self.shared_table and not is_torchdynamo_compiling():
+            # Unscaled frequencies: use the table shared by all slices and models with this rope config
+            # (compiled graphs use the module's own cache)
+            rope_key = get_module_rope_key(self, inv_freq=self.original_inv_freq)
+            return get_rotary_table(rope_key, seq_len, x.dtype, x.device)
+
         if seq_len > self.max_seq_len_cached:
             self._set_cos_sin_cache(seq_len=seq_len, device=x.device, dtype=x.dtype)
 
@@ -158,6 +209,8 @@ class PhiRotaryEmbedding(nn.Module):
 class PhiLinearScalingRotaryEmbedding(PhiRotaryEmbedding):
     """PhiRotaryEmbedding extended with linear scaling. Credits to the Reddit user /u/kaiokendev"""
 
+    shared_table = False
+
     def __init__(self, dim, max_position_embeddings=2048, base=10000, device=None, scaling_factor=1.0):
         self.scaling_factor = scaling_factor
         super().__init__(dim, max_position_embeddings, base, device)
@@ -178,6 +231,8 @@ class PhiLinearScalingRotaryEmbedding(PhiRotaryEmbedding):
 class PhiDynamicNTKScalingRotaryEmbedding(PhiRotaryEmbedding):
     """PhiRotaryEmbedding extended with Dynamic NTK scaling. Credits to the Reddit users /u/bloc97 and /u/emozilla"""
 
+    shared_table = False
+
     def __init__(self, dim, max_position_embeddings=2048, base=10000, device=None, scaling_factor=1.0):
         self.scaling_factor = scaling_factor
         super().__init__(dim, max_position_embeddings, base, device)
@@ -401,12 +456,11 @@ class PhiAttention(nn.Module):
             }
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
+        # Key/value heads are shared by groups of query heads, see grouped_matmul_qk()
 
         # Queries and keys upcast to fp32 is required by Phi-2 to avoid overflow
-        attn_weights = torch.matmul(
-            query_states.to(torch.float32), key_states.to(torch.float32).transpose(2, 3)
+        attn_weights = grouped_matmul_qk(
+            query_states.to(torch.float32), key_states.to(torch.float32)
         ) / math.sqrt(self.head_dim)
 
         if attn_weights.size() != (bsz, self.num_heads, q_len, kv_seq_len):
@@ -423,7 +477,7 @@ class PhiAttention(nn.Module):
         attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(value_states.dtype)
         attn_weights = nn.functional.dropout(attn_weights, p=self.attention_dropout, training=self.training)
 
-        attn_output = torch.matmul(attn_weights, value_states)
+        attn_output = grouped_matmul_av(attn_weights, value_states)
 
         if attn_output.size() != (bsz, self.num_heads, q_len, self.head_dim):
             raise ValueError(
@@ -664,8 +718,7 @@ class PhiSdpaAttention(PhiAttention):
             }
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
+        # Key/value heads are shared by groups of query heads, see grouped_scaled_dot_product_attention()
 
         causal_mask = attention_mask
         if attention_mask is not None:
@@ -683,7 +736,7 @@ class PhiSdpaAttention(PhiAttention):
         # in SDPA to support both torch.compile's dynamic shapes and full graph options. An inline conditional prevents dynamic shapes from compiling.
         is_causal = True if causal_mask is None and q_len > 1 else False
 
-        attn_output = torch.nn.functional.scaled_dot_product_attention(
+        attn_output = grouped_scaled_dot_product_attention(
             query_states,
             key_states,
             value_states,
@@ -808,6 +861,8 @@ class PhiPreTrainedModel(PreTrainedModel):
     _supports_flash_attn_2 = True
     _supports_sdpa = True
     _supports_cache_class = True
+    # Multiple documents can be packed in one sequence, using position_ids restarting at 0 per document
+    _supports_packed_sequences = True
 
     def _init_weights(self, module):
         std = self.config.initializer_range
@@ -988,7 +1043,7 @@ class PhiModel(PhiPreTrainedModel):
             position_ids = cache_position.unsqueeze(0)
 
         causal_mask = self._update_causal_mask(
-            attention_mask, inputs_embeds, cache_position, past_key_values, output_attentions
+            attention_mask, inputs_embeds, cache_position, past_key_values, output_attentions, position_ids
         )
 
         inputs_embeds = self.embed_dropout(inputs_embeds)
@@ -1070,6 +1125,7 @@ class PhiModel(PhiPreTrainedModel):
         cache_position: torch.Tensor,
         past_key_values: Cache,
         output_attentions: bool,
+        position_ids: Optional[torch.Tensor] = None,
     ):
         # TODO: As of torch==2.2.0, the `attention_mask` passed to the model in `generate` is 2D and of dynamic length even when the static
         # KV cache is used. This is an issue for torch.compile which then recaptures cudagraphs at each decode steps due to the dynamic shapes.
@@ -1079,14 +1135,35 @@ class PhiModel(PhiPreTrainedModel):
         if self.config._attn_implementation == "flash_attention_2":
             if attention_mask is not None and 0.0 in attention_mask:
                 return attention_mask
+            # Packed sequences are handled by _flash_attention_forward(), using cu_seqlens derived from position_ids
             return None
 
+        past_seen_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
+
+        # Packed documents: isolate attention per document with a block-diagonal causal mask
+        if attention_mask is None and past_seen_tokens == 0 and _is_packed_sequence(position_ids):
+            return _prepare_4d_packed_causal_mask(
+                position_ids,
+                dtype=input_tensor.dtype,
+                device=input_tensor.device,
+                min_dtype=torch.finfo(input_tensor.dtype).min,
+            )
+
         # For SDPA, when possible, we will rely on its `is_causal` argument instead of its `attn_mask` argument, in
         # order to dispatch on Flash Attention 2. This feature is not compatible with static cache, as SDPA will fail
         # to infer the attention mask.
-        past_seen_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
         using_static_cache = isinstance(past_key_values, StaticCache)
 
+        # Without padding and cached tokens, attention is plain causal: SDPA then uses its `is_causal`
+        # argument (also when tracing, unlike `_ignore_causal_mask_sdpa()`), while other implementations
+        # get a view of a cached mask, instead of a new [batch, 1, seq, seq] mask in every forward.
+        if attention_mask is None and past_seen_tokens == 0 and not using_static_cache:
+            if self.config._attn_implementation == "sdpa" and not output_attentions:
+                return None
+            sequence_length = input_tensor.shape[1]
+            causal_mask = get_causal_mask(sequence_length, sequence_length + 1, input_tensor.dtype, input_tensor.device)
+            return causal_mask.expand(input_tensor.shape[0], -1, -1, -1)
+
         # When output attentions is True, sdpa implementation's forward method calls the eager implementation's forward
         if self.config._attn_implementation == "sdpa" and not using_static_cache and not output_attentions:
             if AttentionMaskConverter._ignore_causal_mask_sdpa(
@@ -1135,163 +1212,10 @@ class PhiModel(PhiPreTrainedModel):
         return causal_mask
 
 
-class SlicedPhiForCausalLMWrapper:
-    def __init__(self, model=None, n_slices=2, start_layers=None, device=None):
-        self.model = model
-        self.device = device
-        if start_layers is None:
-            start_layers = self.gen_start_layers(model.config.num_hidden_layers,n_slices)
-        start_layers.append(model.config.num_hidden_layers)
-        self.start_layers = start_layers
-        self.gen_slices()
-
-    def __repr__(self):
-        return f'SlicedPhiForCausalLMWrapper(n_slices={len(self.slices)},device={self.device},start_layers={self.start_layers[:-1]},model={self.model})'
-
-    def __call__(self,*args,**kwargs):
-        raise Exception("cannot call SlicedPhiForCausalLMWrapper(), use .evaluate_samples() to batch evaluate samples instead")
-
-    def to(self,*args,**kwargs):
-        warnings.warn('No need to .to() on SlicedPhiForCausalLMWrapper; set the .device property instead')
-
-    def evaluate_samples(self,samples,reduction='mean'):
-        """
-        Evaluate losses of samples on sliced model.
-        """
-        output_states = []
-        for slice_idx,model_slice in enumerate(self.slices):
-            model_slice = model_slice.to(self.device)
-            model_params = model_slice.num_parameters()
-            state_size = sum([s.numel() for s in output_states if s is not None])
-            logger.info(f'evaluating slice {slice_idx}, n_params={model_params}, state_size={state_size}...')
-            losses = self.evaluate_losses_slice(model_slice,samples=samples,output_states=output_states,reduction=reduction)
-            model_slice = model_slice.to('cpu')
-            torch.cuda.empty_cache()
-        return losses
-
-    def evaluate_losses_slice(self,model_slice,samples=None,output_states=[],reduction='mean'):
-        is_first_slice = model_slice.config.start_at_layer == 0
-        is_last_slice = model_slice.config.return_states_at_layer == model_slice.config.num_hidden_layers
-        if len(output_states)==0:
-            output_states.extend([None]*len(samples))
-        losses = None
-        if is_last_slice:
-            losses = [np.inf]*len(samples)
-
-        for i,sample in enumerate(samples):
-            if sample is None:
-                continue
-            ids = None
-            if is_first_slice or is_last_slice:
-                ids = sample.to(self.device)
-            sample_state = None
-            try:
-                if is_first_slice:
-                    # inject token ids
-                    logger.debug(f'evaluating sample {i} of length {len(ids[0])}/{len(sample[0])} in first slice...')
-                    outputs = model_slice.model(input_ids=ids)
-                    sample_state = outputs.last_hidden_state
-                else:
-                    # resume with hidden states
-                    logger.debug(f'evaluating sample {i} in later slice...')
-                    outputs = model_slice.model(inputs_embeds=output_states[i])
-                    sample_state = outputs.last_hidden_state
-            except Exception as e:
-                logger.warning(f'Exception evaluating sample {i}, length {len(sample[0])}: {e}')
-
-            output_states[i] = sample_state
-
-            if not is_last_slice:
-                continue
-            if output_states[i] is None:
-                continue
-
-            # calculate losses
-            logits = model_slice.lm_head(output_states[i][0])
-            logits = logits.float()
-            labels = ids
-            shift_logits = logits[..., :-1, :].contiguous()
-            shift_labels = labels[..., 1:].contiguous()
-            # Flatten the tokens
-            loss_fct = torch.nn.CrossEntropyLoss(reduction=reduction)
-            shift_logits = shift_logits.view(-1, model_slice.config.vocab_size)
-            shift_labels = shift_labels.view(-1)
-            loss = loss_fct(shift_logits, shift_labels)
-            loss_value = loss.detach().item()
-            logger.debug(f'loss: {loss_value}')
-            losses[i] = loss_value
-
-        return losses
-
-    def gen_slices(self):
-        model_data = {}
-        # strip model, restore later
-        for pname, p in self.model.named_parameters():
-            model_data[pname] = p.data
-            p.data = torch.zeros(0)
-
-        self.slices = []
-        for i,layer_from in enumerate(self.start_layers[:-1]):
-            layer_to = self.start_layers[i+1]
-            logger.info(f'Generating slice #{i}: {layer_from}..{layer_to}')
-            params = self.filter_params(layer_from=layer_from,layer_to=layer_to)
-            model_slice = copy.deepcopy(self.model) # copy of empty model
-            for pname,p in model_slice.named_parameters():
-                if pname in params['param_names_kept']:
-                    p.data = model_data[pname]
-            model_slice.config.start_at_layer = layer_from
-            model_slice.config.return_states_at_layer = layer_to
-            self.slices.append(model_slice)
-
-    @staticmethod
-    def gen_start_layers(n_layers,n_slices):
-        """
-        Generate a list of starting indices for each slice, equally distributing layers over n slices.
-        """
-        n_slices = min(n_slices,n_layers)
-        start_layers = [0]
-        while len(start_layers)<n_slices:
-            last_start = start_layers[-1]
-            remaining_slices = n_slices-len(start_layers)
-            remaining_layers = n_layers-last_start
-            next_start = last_start + remaining_layers//(remaining_slices+1)
-            start_layers.append(next_start)
-        return start_layers
-
-    def filter_params(self,layer_from=None,layer_to=None):
-        """
-        Filter parameters to use for a particular range of layers.
-        embed tokens is considered part of the first layer.
-        lm_head and model.norm are considered part of the last layer.
-        """
-        params = []
-        param_names_kept = set()
-        param_idx_to_name = {}
-        for pname, p in self.model.named_parameters():
-            if 'embed_tokens' in pname or 'embed_dropout' in pname:
-                if layer_from > 0: continue
-            elif 'lm_head' in pname or 'final_layernorm' in pname:
-                if layer_to < self.model.config.num_hidden_layers: continue
-            else:
-                keep = False
-                for i in range(layer_from,layer_to):
-                    if f'layers.{i}.' in pname:
-                        keep = True
-                        break
-                if not keep:
-                    continue
-            param_idx_to_name[len(params)] = pname
-            param_names_kept.add(pname)
-            params.append(p)
-        return {
-                'param_idx_to_name':param_idx_to_name,
-                'param_names_kept':param_names_kept,
-                'params':params,
-        }
-
-
 class SlicedPhiForCausalLM(PhiPreTrainedModel):
     _tied_weights_keys = ["lm_head.weight"]
+    # Parts of the model for sliced evaluation, see SlicedModelWrapper
+    slice_adapter = SliceAdapter(final_norm=('model.final_layernorm',))
 
     # Copied from transformers.models.llama.modeling_llama.LlamaForCausalLM.__init__ with Llama->Phi,bias=False->bias=True
     def __init__(self, config):
@@ -1307,7 +1231,7 @@ class SlicedPhiForCausalLM(PhiPreTrainedModel):
         """
         Generate a container object with this model sliced into pieces.
         """
-        return SlicedPhiForCausalLMWrapper(model=self,**kwargs)
+        return SlicedModelWrapper(model=self,**kwargs)
 
     # Copied from transformers.models.llama.modeling_llama.LlamaForCausalLM.get_input_embeddings
     def get_input_embeddings(self):
@@ -18,8 +18,6 @@
 """PyTorch Phi-3 model."""
 
 import math
-import copy
-import numpy as np
 import warnings
 from typing import List, Optional, Tuple, Union
 
@@ -45,10 +43,15 @@ from transformers.utils import (
     add_start_docstrings_to_model_forward,
     is_flash_attn_2_available,
     is_flash_attn_greater_or_equal_2_10,
+    is_torchdynamo_compiling,
     logging,
     replace_return_docstrings,
 )
 from .configuration_phi3 import Phi3Config
+from utilities.causal_mask import get_causal_mask
+from utilities.grouped_attention import grouped_matmul_av, grouped_matmul_qk, grouped_scaled_dot_product_attention
+from utilities.rotary_cache import get_module_rope_key, get_rotary_cos_sin
+from utilities.sliced_model import SliceAdapter, SlicedModelWrapper
 
 
 if is_flash_attn_2_available():
@@ -114,6 +117,44 @@ def _prepare_4d_causal_attention_mask_with_cache_position(
     return causal_mask
 
 
+def _prepare_4d_packed_causal_mask(
+    position_ids: torch.Tensor,
+    dtype: torch.dtype,
+    device: torch.device,
+    min_dtype: float,
+):
+    """
+    Creates a block-diagonal causal 4D mask of shape `(batch_size, 1, sequence_length, sequence_length)` for
+    sequences containing several packed documents. Each document restarts its `position_ids` at 0, and tokens
+    only attend to earlier tokens of the same document.
+
+    Args:
+        position_ids (`torch.Tensor`):
+            Position ids of shape `(batch_size, sequence_length)`, restarting at 0 for every document.
+        dtype (`torch.dtype`):
+            The dtype to use for the 4D attention mask.
+        device (`torch.device`):
+            The device to place the 4D attention mask on.
+        min_dtype (`float`):
+            The minimum value representable with the dtype `dtype`.
+    """
+    sequence_length = position_ids.shape[-1]
+    document_ids = torch.cumsum(position_ids == 0, dim=-1).to(device)
+    causal = torch.ones((sequence_length, sequence_length), dtype=torch.bool, device=device).tril()
+    allowed = causal[None, :, :] & (document_ids[:, :, None] == document_ids[:, None, :])
+    causal_mask = torch.zeros(allowed.shape, dtype=dtype, device=device).masked_fill_(~allowed, min_dtype)
+    return causal_mask[:, None, :, :]
+
+
+def _is_packed_sequence(position_ids: Optional[torch.Tensor]) -> bool:
+    """
+    Returns True if `position_ids` restart at 0 within the sequence, i.e. multiple documents are packed together.
+    """
+    if position_ids is None or position_ids.shape[-1] <= 1:
+        return False
+    return bool((position_ids[:, 1:] == 0).any())
+
+
 # Copied from transformers.models.llama.modeling_llama.LlamaRMSNorm with Llama->Phi3
 class Phi3RMSNorm(nn.Module):
     def __init__(self, hidden_size, eps=1e-6):
@@ -150,7 +191,11 @@ class Phi3RotaryEmbedding(nn.Module):
     @torch.no_grad()
     def forward(self, x, position_ids, seq_len=None):
         # x: [bs, num_attention_heads, seq_len, head_size]
-        self.inv_freq.to(x.device)
+        if not is_torchdynamo_compiling():
+            # Look up positions in the table shared by all slices and models with this rope config
+            # (the scaled subclasses recompute their frequencies per call; compiled graphs compute them inline)
+            return get_rotary_cos_sin(get_module_rope_key(self), position_ids, x.dtype)
+
         inv_freq_expanded = self.inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1)
         position_ids_expanded = position_ids[:, None, :].float()
         # Force float32 since bfloat16 loses precision on long contexts
@@ -452,11 +497,9 @@ class Phi3Attention(nn.Module):
             cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}  # Specific to RoPE models
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
-        # repeat k/v heads if n_kv_heads < n_heads
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
+        # Key/value heads are shared by groups of query heads, see grouped_matmul_qk()
 
-        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+        attn_weights = grouped_matmul_qk(query_states, key_states) / math.sqrt(self.head_dim)
 
         if attention_mask is not None:
             causal_mask = attention_mask[:, :, :, : key_states.shape[-2]]
@@ -466,7 +509,7 @@ class Phi3Attention(nn.Module):
         attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(value_states.dtype)
         attn_weights = nn.functional.dropout(attn_weights, p=self.attention_dropout, training=self.training)
 
-        attn_output = torch.matmul(attn_weights, value_states)
+        attn_output = grouped_matmul_av(attn_weights, value_states)
 
         if attn_output.size() != (bsz, self.num_heads, q_len, self.head_dim):
             raise ValueError(
@@ -578,9 +621,7 @@ class Phi3FlashAttention2(Phi3Attention):
             cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}  # Specific to RoPE models
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
-        # repeat k/v heads if n_kv_heads < n_heads
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
+        # Flash attention supports fewer key/value heads than query heads, no need to repeat them
 
         attn_dropout = self.attention_dropout if self.training else 0.0
 
@@ -694,8 +735,7 @@ class Phi3SdpaAttention(Phi3Attention):
             cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}  # Specific to RoPE models
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
+        # Key/value heads are shared by groups of query heads, see grouped_scaled_dot_product_attention()
 
         causal_mask = attention_mask
         if attention_mask is not None:
@@ -713,7 +753,7 @@ class Phi3SdpaAttention(Phi3Attention):
         # The q_len > 1 is necessary to match with AttentionMaskConverter.to_causal_4d that does not create a causal mask in case q_len == 1.
         is_causal = True if causal_mask is None and q_len > 1 else False
 
-        attn_output = torch.nn.functional.scaled_dot_product_attention(
+        attn_output = grouped_scaled_dot_product_attention(
             query_states,
             key_states,
             value_states,
@@ -848,6 +888,8 @@ class Phi3PreTrainedModel(PreTrainedModel):
     _supports_flash_attn_2 = True
     _supports_sdpa = False
     _supports_cache_class = True
+    # Multiple documents can be packed in one sequence, using position_ids restarting at 0 per document
+    _supports_packed_sequences = True
 
     _version = "0.0.5"
 
@@ -1028,7 +1070,7 @@ class Phi3Model(Phi3PreTrainedModel):
             position_ids = cache_position.unsqueeze(0)
 
         causal_mask = self._update_causal_mask(
-            attention_mask, inputs_embeds, cache_position, past_key_values, output_attentions
+            attention_mask, inputs_embeds, cache_position, past_key_values, output_attentions, position_ids
         )
 
         hidden_states = inputs_embeds
@@ -1109,6 +1151,7 @@ class Phi3Model(Phi3PreTrainedModel):
         cache_position: torch.Tensor,
         past_key_values: Cache,
         output_attentions: bool,
+        position_ids: Optional[torch.Tensor] = None,
     ):
         # TODO: As of torch==2.2.0, the `attention_mask` passed to the model in `generate` is 2D and of dynamic length even when the static
         # KV cache is used. This is an issue for torch.compile which then recaptures cudagraphs at each decode steps due to the dynamic shapes.
@@ -1118,14 +1161,35 @@ class Phi3Model(Phi3PreTrainedModel):
         if self.config._attn_implementation == "flash_attention_2":
             if attention_mask is not None and 0.0 in attention_mask:
                 return attention_mask
+            # Packed sequences are handled by _flash_attention_forward(), using cu_seqlens derived from position_ids
             return None
 
+        past_seen_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
+
+        # Packed documents: isolate attention per document with a block-diagonal causal mask
+        if attention_mask is None and past_seen_tokens == 0 and _is_packed_sequence(position_ids):
+            return _prepare_4d_packed_causal_mask(
+                position_ids,
+                dtype=input_tensor.dtype,
+                device=input_tensor.device,
+                min_dtype=torch.finfo(input_tensor.dtype).min,
+            )
+
         # For SDPA, when possible, we will rely on its `is_causal` argument instead of its `attn_mask` argument, in
         # order to dispatch on Flash Attention 2. This feature is not compatible with static cache, as SDPA will fail
         # to infer the attention mask.
-        past_seen_tokens = past_key_values.get_seq_length() if past_key_values is not None else 0
         using_static_cache = isinstance(past_key_values, StaticCache)
 
+        # Without padding and cached tokens, attention is plain causal: SDPA then uses its `is_causal`
+        # argument (also when tracing, unlike `_ignore_causal_mask_sdpa()`), while other implementations
+        # get a view of a cached mask, instead of a new [batch, 1, seq, seq] mask in every forward.
+        if attention_mask is None and past_seen_tokens == 0 and not using_static_cache:
+            if self.config._attn_implementation == "sdpa" and not output_attentions:
+                return None
+            sequence_length = input_tensor.shape[1]
+            causal_mask = get_causal_mask(sequence_length, sequence_length + 1, input_tensor.dtype, input_tensor.device)
+            return causal_mask.expand(input_tensor.shape[0], -1, -1, -1)
+
         # When output attentions is True, sdpa implementation's forward method calls the eager implementation's forward
         if self.config._attn_implementation == "sdpa" and not using_static_cache and not output_attentions:
             if AttentionMaskConverter._ignore_causal_mask_sdpa(
@@ -1174,163 +1238,10 @@ class Phi3Model(Phi3PreTrainedModel):
         return causal_mask
 
 
-class SlicedPhi3ForCausalLMWrapper:
-    def __init__(self, model=None, n_slices=2, start_layers=None, device=None):
-        self.model = model
-        self.device = device
-        if start_layers is None:
-            start_layers = self.gen_start_layers(model.config.num_hidden_layers,n_slices)
-        start_layers.append(model.config.num_hidden_layers)
-        self.start_layers = start_layers
-        self.gen_slices()
-
-    def __repr__(self):
-        return f'SlicedPhi3ForCausalLMWrapper(n_slices={len(self.slices)},device={self.device},start_layers={self.start_layers[:-1]},model={self.model})'
-
-    def __call__(self,*args,**kwargs):
-        raise Exception("cannot call SlicedPhi3ForCausalLMWrapper(), use .evaluate_samples() to batch evaluate samples instead")
-
-    def to(self,*args,**kwargs):
-        warnings.warn('No need to .to() on SlicedPhi3ForCausalLMWrapper; set the .device property instead')
-
-    def evaluate_samples(self,samples,reduction='mean'):
-        """
-        Evaluate losses of samples on sliced model.
-        """
-        output_states = []
-        for slice_idx,model_slice in enumerate(self.slices):
-            model_slice = model_slice.to(self.device)
-            model_params = model_slice.num_parameters()
-            state_size = sum([s.numel() for s in output_states if s is not None])
-            logger.info(f'evaluating slice {slice_idx}, n_params={model_params}, state_size={state_size}...')
-            losses = self.evaluate_losses_slice(model_slice,samples=samples,output_states=output_states,reduction=reduction)
-            model_slice = model_slice.to('cpu')
-            torch.cuda.empty_cache()
-        return losses
-
-    def evaluate_losses_slice(self,model_slice,samples=None,output_states=[],reduction='mean'):
-        is_first_slice = model_slice.config.start_at_layer == 0
-        is_last_slice = model_slice.config.return_states_at_layer == model_slice.config.num_hidden_layers
-        if len(output_states)==0:
-            output_states.extend([None]*len(samples))
-        losses = None
-        if is_last_slice:
-            losses = [np.inf]*len(samples)
-
-        for i,sample in enumerate(samples):
-            if sample is None:
-                continue
-            ids = None
-            if is_first_slice or is_last_slice:
-                ids = sample.to(self.device)
-            sample_state = None
-            try:
-                if is_first_slice:
-                    # inject token ids
-                    logger.debug(f'evaluating sample {i} of length {len(ids[0])}/{len(sample[0])} in first slice...')
-                    outputs = model_slice.model(input_ids=ids)
-                    sample_state = outputs.last_hidden_state
-                else:
-                    # resume with hidden states
-                    logger.debug(f'evaluating sample {i} in later slice...')
-                    outputs = model_slice.model(inputs_embeds=output_states[i])
-                    sample_state = outputs.last_hidden_state
-            except Exception as e:
-                logger.warning(f'Exception evaluating sample {i}, length {len(sample[0])}: {e}')
-
-            output_states[i] = sample_state
-
-            if not is_last_slice:
-                continue
-            if output_states[i] is None:
-                continue
-
-            # calculate losses
-            logits = model_slice.lm_head(output_states[i][0])
-            logits = logits.float()
-            labels = ids
-            shift_logits = logits[..., :-1, :].contiguous()
-            shift_labels = labels[..., 1:].contiguous()
-            # Flatten the tokens
-            loss_fct = torch.nn.CrossEntropyLoss(reduction=reduction)
-            shift_logits = shift_logits.view(-1, model_slice.config.vocab_size)
-            shift_labels = shift_labels.view(-1)
-            loss = loss_fct(shift_logits, shift_labels)
-            loss_value = loss.detach().item()
-            logger.debug(f'loss: {loss_value}')
-            losses[i] = loss_value
-
-        return losses
-
-    def gen_slices(self):
-        model_data = {}
-        # strip model, restore later
-        for pname, p in self.model.named_parameters():
-            model_data[pname] = p.data
-            p.data = torch.zeros(0)
-
-        self.slices = []
-        for i,layer_from in enumerate(self.start_layers[:-1]):
-            layer_to = self.start_layers[i+1]
-            logger.info(f'Generating slice #{i}: {layer_from}..{layer_to}')
-            params = self.filter_params(layer_from=layer_from,layer_to=layer_to)
-            model_slice = copy.deepcopy(self.model) # copy of empty model
-            for pname,p in model_slice.named_parameters():
-                if pname in params['param_names_kept']:
-                    p.data = model_data[pname]
-            model_slice.config.start_at_layer = layer_from
-            model_slice.config.return_states_at_layer = layer_to
-            self.slices.append(model_slice)
-
-    @staticmethod
-    def gen_start_layers(n_layers,n_slices):
-        """
-        Generate a list of starting indices for each slice, equally distributing layers over n slices.
-        """
-        n_slices = min(n_slices,n_layers)
-        start_layers = [0]
-        while len(start_layers)<n_slices:
-            last_start = start_layers[-1]
-            remaining_slices = n_slices-len(start_layers)
-            remaining_layers = n_layers-last_start
-            next_start = last_start + remaining_layers//(remaining_slices+1)
-            start_layers.append(next_start)
-        return start_layers
-
-    def filter_params(self,layer_from=None,layer_to=None):
-        """
-        Filter parameters to use for a particular range of layers.
-        embed tokens is considered part of the first layer.
-        lm_head and model.norm are considered part of the last layer.
-        """
-        params = []
-        param_names_kept = set()
-        param_idx_to_name = {}
-        for pname, p in self.model.named_parameters():
-            if 'embed_tokens' in pname or 'embed_dropout' in pname:
-                if layer_from > 0: continue
-            elif 'lm_head' in pname or 'model.norm' in pname:
-                if layer_to < self.model.config.num_hidden_layers: continue
-            else:
-                keep = False
-                for i in range(layer_from,layer_to):
-                    if f'layers.{i}.' in pname:
-                        keep = True
-                        break
-                if not keep:
-                    continue
-            param_idx_to_name[len(params)] = pname
-            param_names_kept.add(pname)
-            params.append(p)
-        return {
-                'param_idx_to_name':param_idx_to_name,
-                'param_names_kept':param_names_kept,
-                'params':params,
-        }
-
-
 class SlicedPhi3ForCausalLM(Phi3PreTrainedModel):
     _tied_weights_keys = ["lm_head.weight"]
+    # Parts of the model for sliced evaluation, see SlicedModelWrapper
+    slice_adapter = SliceAdapter()
 
     # Copied from transformers.models.llama.modeling_llama.LlamaForCausalLM.__init__ with Llama->Phi3
     def __init__(self, config):
@@ -1346,7 +1257,7 @@ class SlicedPhi3ForCausalLM(Phi3PreTrainedModel):
         """
         Generate a container object with this model sliced into pieces.
         """
-        return SlicedPhi3ForCausalLMWrapper(model=self,**kwargs)
+        return SlicedModelWrapper(model=self,**kwargs)
 
     # Copied from transformers.models.llama.modeling_llama.LlamaForCausalLM.get_input_embeddings
     def get_input_embeddings(self):
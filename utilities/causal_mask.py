@@ -0,0 +1,44 @@
+import threading
+
+import torch
+from transformers.utils import is_torchdynamo_compiling
+
+# Masks are built in multiples of this many positions, so that samples of similar lengths share one mask
+CAUSAL_MASK_GRANULARITY = 256
+
+_lock = threading.Lock()
+# (dtype, device) -> [n, n] causal mask
+_masks = {}
+
+
+def get_causal_mask(sequence_length: int, target_length: int, dtype: torch.dtype, device) -> torch.Tensor:
+    """
+    Return a [1, 1, sequence_length, target_length] additive causal mask for
+    inputs without padding and without cached tokens: 0 where position j may
+    attend to position i (j <= i), the minimum of dtype elsewhere.
+
+    The result is a view of a single cached mask per dtype and device, which
+    only grows when longer inputs come along. It must not be modified in place.
+    When compiling, a new mask is built in the graph instead.
+    """
+    if is_torchdynamo_compiling():
+        mask = torch.full((sequence_length, target_length), torch.finfo(dtype).min, dtype=dtype, device=device)
+        return mask.triu_(diagonal=1)[None, None]
+    key = (dtype, str(device))
+    size = max(sequence_length, target_length)
+    with _lock:
+        mask = _masks.get(key, None)
+        if mask is None or mask.shape[0] < size:
+            size = -(-size // CAUSAL_MASK_GRANULARITY) * CAUSAL_MASK_GRANULARITY
+            # Drop the old mask before allocating the new one
+            _masks.pop(key, None)
+            del mask
+            mask = torch.full((size, size), torch.finfo(dtype).min, dtype=dtype, device=device).triu_(diagonal=1)
+            _masks[key] = mask
+    return mask[None, None, :sequence_length, :target_length]
+
+
+def clear_causal_mask_cache():
+    """Release all cached masks."""
+    with _lock:
+        _masks.clear()
@@ -0,0 +1,83 @@
+import contextlib
+import hashlib
+import os
+
+import torch
+import torch._dynamo
+import torch._inductor.config
+
+from utilities.slice_loader import is_cuda_device
+
+# Samples are right-padded to the smallest power-of-two multiple of this many tokens that holds
+# them, so a maximum sequence length L needs at most log2(L/COMPILE_MIN_BUCKET)+1 compiled graphs
+COMPILE_MIN_BUCKET = 128
+
+
+def get_length_bucket(length: int, min_bucket: int = COMPILE_MIN_BUCKET) -> int:
+    """Return the padded sequence length for a sample of length tokens."""
+    bucket = min_bucket
+    while bucket < length:
+        bucket *= 2
+    return bucket
+
+
+def get_compile_cache_dir(cache_dir: str, geometry: tuple) -> str:
+    """
+    Return the directory for compiled artifacts of models with the given
+    geometry (see validation.get_model_geometry(), which starts with the
+    architecture name).
+    """
+    digest = hashlib.sha1(repr(geometry).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f'{geometry[0]}-{digest}')
+
+
+@contextlib.contextmanager
+def compile_cache(cache_dir: str):
+    """
+    Make inductor read and write compiled artifacts in cache_dir while in
+    this context. Within the directory, artifacts are keyed on the traced
+    graph, i.e. on the length bucket, so later compilations of the same
+    geometry and bucket (other models, steps or processes) skip code
+    generation and kernel compilation.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    saved = {name: os.environ.get(name, None) for name in ('TORCHINDUCTOR_CACHE_DIR', 'TRITON_CACHE_DIR')}
+    saved_fx_graph_cache = torch._inductor.config.fx_graph_cache
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+    os.environ['TRITON_CACHE_DIR'] = os.path.join(cache_dir, 'triton')
+    torch._inductor.config.fx_graph_cache = True
+    try:
+        yield
+    finally:
+        torch._inductor.config.fx_graph_cache = saved_fx_graph_cache
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def compile_decoder(decoder: torch.nn.Module, device, n_buckets: int, mode: str = None):
+    """
+    Return a compiled function mapping [batch, seq_len] input_ids to the final
+    hidden states of decoder. Shapes are static: each length bucket gets its own
+    graph. The default mode uses CUDA graphs on CUDA devices ('reduce-overhead'),
+    so outputs are only valid until the next call.
+    """
+    if mode is None:
+        mode = 'reduce-overhead' if is_cuda_device(device) else 'default'
+    # Each bucket is a recompilation of the same code; don't fall back to eager before all buckets are compiled
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, n_buckets + 1)
+
+    def forward(input_ids):
+        return decoder(input_ids, use_cache=False)[0]
+
+    return torch.compile(forward, mode=mode, dynamic=False)
+
+
+def reset_compiled():
+    """
+    Drop compiled code and its guards, which refer to the parameters of the
+    evaluated model. Artifacts in the compile cache are kept.
+    """
+    torch._dynamo.reset()
@@ -0,0 +1,529 @@
+import builtins
+import collections
+import functools
+import hashlib
+import hmac
+import http.server
+import io
+import json
+import os
+import shutil
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.request
+import uuid
+from typing import Callable, List, Optional
+
+from utilities.logs import TRACE, logger
+from utilities.shared_samples import SAMPLES_CACHE_SIZE, SharedSamples
+from utilities.worker_pool import TaskLost
+
+# A task is given to another worker when its worker doesn't report for this many seconds
+LEASE_SECONDS = 60
+# A worker may take this many seconds to prepare a task (e.g. download the
+# model) before the task counts as lost; the ttl of a task starts after that
+PREPARE_SECONDS = 3600
+# Interval (seconds) at which idle workers ask for tasks, and at which waiting is checked
+POLL_INTERVAL = 1
+# Workers that asked for a task this many seconds ago or less are considered available
+IDLE_SECONDS = 5
+# Timeout (seconds) of requests by workers
+REQUEST_TIMEOUT = 60
+# Requests signed more than this many seconds before or after the coordinator's
+# clock are rejected, so the clocks of the hosts must be in sync within this margin
+MAX_CLOCK_SKEW = 60
+# Environment variable holding the secret shared by the coordinator and its workers
+SECRET_ENV_VAR = 'EVAL_COORDINATOR_SECRET'
+# Key marking references to SharedSamples in task descriptions
+SAMPLES_REF_KEY = '__samples__'
+
+
+def sign(secret: str, *parts) -> str:
+    """
+    Return the HMAC-SHA256 of parts (str, bytes or a binary file, which is
+    read from start to end in chunks) with secret, as hex.
+    """
+    mac = hmac.new(secret.encode(), digestmod=hashlib.sha256)
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        if isinstance(part, (bytes, bytearray)):
+            # Length-prefixed, so that parts can't be shifted into each other
+            mac.update(len(part).to_bytes(8, 'big'))
+            mac.update(part)
+            continue
+        part.seek(0)
+        mac.update(os.fstat(part.fileno()).st_size.to_bytes(8, 'big'))
+        for chunk in iter(functools.partial(part.read, 1<<20), b''):
+            mac.update(chunk)
+    return mac.hexdigest()
+
+
+class _Task:
+    def __init__(self, payload: bytes, samples: list):
+        self.id = uuid.uuid4().hex
+        self.payload = payload
+        self.samples = samples
+        self.worker = None
+        self.ts_queued = time.monotonic()
+        self.ts_leased = None
+        self.ts_started = None
+        self.lease_expiry = None
+        self.result = None
+        self.done = threading.Event()
+
+
+class EvalCoordinator:
+    """
+    Hands out tasks to evaluation workers on other hosts (see
+    neurons/remote_eval_worker.py) over HTTP, and collects their results.
+
+    Workers pull tasks: they POST /lease until they get one, POST
+    /heartbeat/<task_id> while running it and POST /result/<task_id> when
+    done. Once a worker is ready to run a task, e.g. has downloaded the model,
+    it POSTs /started/<task_id>; the ttl of the task runs from there. Tasks
+    are described as JSON data, which the worker interprets, and results
+    come back as JSON; nothing is unpickled on either side. Samples
+    (SharedSamples) in a task description are published at /samples/<key>
+    while the task runs.
+
+    Requests and responses are signed with an HMAC of the shared secret, which
+    itself is never sent. Signed requests can't be replayed, but they are not
+    encrypted: task descriptions, samples and results can be read on the way.
+
+    run() has the interface of WorkerPool.run(), so that the coordinator can
+    serve as a slot of an EvalScheduler. A task fails with TaskLost when no
+    worker takes it or when its worker stops reporting, to be run elsewhere.
+    """
+    def __init__(
+        self, host: str, port: int, secret: str, lease_seconds: float = LEASE_SECONDS,
+        prepare_seconds: float = PREPARE_SECONDS, exception_types: List[type] = []
+    ):
+        """
+        Args:
+            host, port: Address to listen on.
+            secret (str): Secret shared with the workers.
+            lease_seconds (float): See LEASE_SECONDS.
+            prepare_seconds (float): See PREPARE_SECONDS.
+            exception_types (list): Exception classes, other than builtin
+                ones, that are raised again by run() when tasks raise them
+                (by name) on a worker. Other exceptions become Exception.
+        """
+        if not secret:
+            raise ValueError("The evaluation coordinator requires a secret")
+        self.secret = secret
+        self.lease_seconds = lease_seconds
+        self.prepare_seconds = prepare_seconds
+        self.exception_types = {cls.__name__: cls for cls in exception_types}
+        self.lock = threading.Lock()
+        self.queue = collections.deque()
+        # task id -> task, for tasks that are queued or running
+        self.tasks = {}
+        # samples key -> path of published samples
+        self.samples = {}
+        # worker id -> time of the last request for a task that was not granted
+        self.idle_workers = {}
+        # Number of idle workers promised to tasks that are about to be run
+        self.n_reserved = 0
+        # Signature -> timestamp of recent requests, to reject replays
+        self.signatures = {}
+        self.server = http.server.ThreadingHTTPServer((host, port), functools.partial(_Handler, self))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='eval-coordinator', daemon=True)
+        self.thread.start()
+        logger.info(f"Evaluation coordinator listening on {host}:{self.port}")
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def _n_available(self) -> int:
+        now = time.monotonic()
+        n_idle = sum(now - ts <= IDLE_SECONDS for ts in self.idle_workers.values())
+        return n_idle - len(self.queue) - self.n_reserved
+
+    def n_idle_workers(self) -> int:
+        """Return the number of available workers, minus the number of queued and reserved tasks."""
+        with self.lock:
+            return self._n_available()
+
+    def try_reserve(self) -> bool:
+        """
+        Reserve an available worker for the next task passed to run(), if there
+        is one. A reservation that is not followed by run() has to be released
+        with cancel_reservation().
+        """
+        with self.lock:
+            if self._n_available() <= 0:
+                return False
+            self.n_reserved += 1
+            return True
+
+    def cancel_reservation(self):
+        with self.lock:
+            self.n_reserved = max(self.n_reserved - 1, 0)
+
+    def verify(self, signature: str, timestamp: str, *parts) -> bool:
+        """
+        Check the signature of a request made at timestamp (time.time() of
+        the worker), over timestamp and parts; each signature is accepted once.
+        """
+        try:
+            ts = float(timestamp)
+        except ValueError:
+            return False
+        now = time.time()
+        if abs(now - ts) > MAX_CLOCK_SKEW:
+            return False
+        if not hmac.compare_digest(signature, sign(self.secret, timestamp, *parts)):
+            return False
+        with self.lock:
+            for seen, seen_ts in list(self.signatures.items()):
+                if now - seen_ts > MAX_CLOCK_SKEW:
+                    del self.signatures[seen]
+            if signature in self.signatures:
+                return False
+            self.signatures[signature] = ts
+        return True
+
+    def run(self, task: dict, ttl: int, expected_errors={}):
+        """
+        Run the task described by task, a JSON-able dict whose values may
+        also be SharedSamples, on a worker, with ttl seconds to complete once
+        the worker started it. A worker that takes more than prepare_seconds
+        to start the task is considered lost. Returns the result of the
+        worker, or raises the exception it reported. The task takes up a
+        reservation made by try_reserve(), if any.
+        """
+        samples = [value for value in task.values() if isinstance(value, SharedSamples)]
+        try:
+            description = {
+                name: {SAMPLES_REF_KEY: value.key, 'n_samples': len(value)} if isinstance(value, SharedSamples) else value
+                for name, value in task.items()
+            }
+            payload = json.dumps(dict(task=description, ttl=ttl, expected_errors=sorted(expected_errors))).encode()
+        except Exception:
+            self.cancel_reservation()
+            raise
+        pending = _Task(payload, samples)
+        with self.lock:
+            for shared in samples:
+                self.samples[shared.key] = shared.path
+            self.tasks[pending.id] = pending
+            self.queue.append(pending)
+            # The queued task now counts against the available workers instead
+            self.n_reserved = max(self.n_reserved - 1, 0)
+
+        try:
+            while not pending.done.wait(POLL_INTERVAL):
+                now = time.monotonic()
+                with self.lock:
+                    if pending.done.is_set():
+                        break
+                    if pending.worker is None:
+                        if now - pending.ts_queued > self.lease_seconds:
+                            raise TaskLost(f"No worker took task {pending.id} in {self.lease_seconds} seconds")
+                    elif now > pending.lease_expiry:
+                        raise TaskLost(f"Lost worker {pending.worker} while running task {pending.id}")
+                    elif pending.ts_started is None:
+                        if now - pending.ts_leased > self.prepare_seconds:
+                            raise TaskLost(f"Worker {pending.worker} did not start task {pending.id} in {self.prepare_seconds} seconds")
+                    elif now - pending.ts_started > ttl:
+                        raise TimeoutError(f"Failed to run task {pending.id} after {ttl} seconds")
+        finally:
+            with self.lock:
+                self.tasks.pop(pending.id, None)
+                if pending in self.queue:
+                    self.queue.remove(pending)
+                in_use = set(shared.key for other in self.tasks.values() for shared in other.samples)
+                for shared in samples:
+                    if shared.key not in in_use:
+                        self.samples.pop(shared.key, None)
+
+        return self.unpack_result(pending.result, expected_errors)
+
+    def unpack_result(self, data: bytes, expected_errors={}):
+        """
+        Return the result sent by a worker, or raise the exception it
+        reported. Exceptions with type names not in expected_errors are
+        logged with their stack trace on the worker.
+        """
+        result = json.loads(data)
+        if 'error' not in result:
+            return result['result']
+        error = result['error']
+        name, message = str(error.get('type')), str(error.get('message'))
+        if name not in expected_errors:
+            logger.error(f"Exception in remote worker:\n{error.get('traceback')}")
+        cls = self.exception_types.get(name, getattr(builtins, name, None))
+        exception = None
+        if isinstance(cls, type) and issubclass(cls, Exception):
+            try:
+                exception = cls(message)
+            except Exception:
+                # Takes other arguments than a message
+                pass
+        if exception is None:
+            exception = Exception(f"{name} in remote worker: {message}")
+        raise exception
+
+    def lease(self, worker: str) -> Optional[_Task]:
+        with self.lock:
+            if len(self.queue) == 0:
+                self.idle_workers[worker] = time.monotonic()
+                return None
+            self.idle_workers.pop(worker, None)
+            task = self.queue.popleft()
+            task.worker = worker
+            task.ts_leased = time.monotonic()
+            task.lease_expiry = task.ts_leased + self.lease_seconds
+            logger.debug(f"Worker {worker} took task {task.id}")
+            return task
+
+    def heartbeat(self, worker: str, task_id: str) -> bool:
+        with self.lock:
+            task = self.tasks.get(task_id, None)
+            if task is None or task.worker != worker:
+                return False
+            task.lease_expiry = time.monotonic() + self.lease_seconds
+            return True
+
+    def start(self, worker: str, task_id: str) -> bool:
+        """Start the ttl of task_id, and extend its lease."""
+        with self.lock:
+            task = self.tasks.get(task_id, None)
+            if task is None or task.worker != worker:
+                return False
+            now = time.monotonic()
+            if task.ts_started is None:
+                task.ts_started = now
+            task.lease_expiry = now + self.lease_seconds
+            return True
+
+    def complete(self, worker: str, task_id: str, result: bytes) -> bool:
+        with self.lock:
+            task = self.tasks.get(task_id, None)
+            if task is None or task.worker != worker or task.done.is_set():
+                return False
+            task.result = result
+            task.done.set()
+            return True
+
+    def check_health(self):
+        """Forget workers that stopped asking for tasks."""
+        now = time.monotonic()
+        with self.lock:
+            for worker, ts in list(self.idle_workers.items()):
+                if now - ts > self.lease_seconds:
+                    del self.idle_workers[worker]
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def __init__(self, coordinator: EvalCoordinator, *args, **kwargs):
+        self.coordinator = coordinator
+        self.signature = None
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        logger.log(TRACE, f"Evaluation coordinator: {format % args}")
+
+    def reply(self, code: int, body: bytes = b'', task_id: str = ''):
+        """Send a response, signed over the request's signature, task_id and body."""
+        self.send_response(code)
+        if task_id:
+            self.send_header('X-Task-Id', task_id)
+        if self.signature is not None:
+            self.send_header('X-Signature', sign(self.coordinator.secret, self.signature, task_id, body))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_file(self, path: str):
+        """Send the file at path as a successful response, in chunks rather than all at once."""
+        with open(path, 'rb') as f:
+            self.send_response(200)
+            if self.signature is not None:
+                self.send_header('X-Signature', sign(self.coordinator.secret, self.signature, '', f))
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            f.seek(0)
+            shutil.copyfileobj(f, self.wfile)
+
+    def authorized(self, body: bytes) -> bool:
+        signature = self.headers.get('X-Signature', '')
+        if self.coordinator.verify(
+            signature, self.headers.get('X-Timestamp', ''),
+            self.command, self.path, self.headers.get('X-Worker-Id', ''), body
+        ):
+            self.signature = signature
+            return True
+        self.reply(403)
+        return False
+
+    def do_GET(self):
+        if not self.authorized(b''):
+            return
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'samples':
+            with self.coordinator.lock:
+                path = self.coordinator.samples.get(parts[1], None)
+            if path is not None:
+                self.reply_file(path)
+                return
+        self.reply(404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.authorized(body):
+            return
+        worker = self.headers.get('X-Worker-Id', '')
+        parts = self.path.strip('/').split('/')
+        if parts == ['lease']:
+            task = self.coordinator.lease(worker)
+            if task is None:
+                self.reply(204)
+            else:
+                self.reply(200, task.payload, task.id)
+        elif len(parts) == 2 and parts[0] == 'heartbeat':
+            self.reply(200 if self.coordinator.heartbeat(worker, parts[1]) else 410)
+        elif len(parts) == 2 and parts[0] == 'started':
+            self.reply(200 if self.coordinator.start(worker, parts[1]) else 410)
+        elif len(parts) == 2 and parts[0] == 'result':
+            self.reply(200 if self.coordinator.complete(worker, parts[1], body) else 410)
+        else:
+            self.reply(404)
+
+
+class CoordinatorClient:
+    """Worker side of the protocol of EvalCoordinator."""
+    def __init__(self, url: str, secret: str, worker: Optional[str] = None):
+        self.url = url.rstrip('/')
+        self.secret = secret
+        self.worker = worker or uuid.uuid4().hex
+        # samples key -> local copy
+        self.samples = collections.OrderedDict()
+
+    def request(self, path: str, data: Optional[bytes] = None):
+        """
+        Return (status, headers, body) of a signed request; POST if data is
+        not None. Raises an exception if a successful response is not signed
+        by the coordinator.
+        """
+        method = 'GET' if data is None else 'POST'
+        timestamp = repr(time.time())
+        signature = sign(self.secret, timestamp, method, path, self.worker, data or b'')
+        req = urllib.request.Request(
+            f'{self.url}{path}',
+            data=data,
+            method=method,
+            headers={'X-Worker-Id': self.worker, 'X-Timestamp': timestamp, 'X-Signature': signature},
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+                status, headers, body = response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, b''
+        expected = sign(self.secret, signature, headers.get('X-Task-Id', ''), body)
+        if not hmac.compare_digest(headers.get('X-Signature', ''), expected):
+            raise Exception(f"Invalid signature of the response to {path}")
+        return status, headers, body
+
+    def lease(self):
+        """Return (task_id, task, ttl, expected_errors) of a task, or None if there is none."""
+        status, headers, body = self.request('/lease', b'')
+        if status != 200:
+            return None
+        leased = json.loads(body)
+        return headers['X-Task-Id'], leased['task'], leased['ttl'], set(leased['expected_errors'])
+
+    def heartbeat(self, task_id: str) -> bool:
+        """Extend the lease of task_id; False if the task is no longer ours."""
+        return self.request(f'/heartbeat/{task_id}', b'')[0] == 200
+
+    def start(self, task_id: str) -> bool:
+        """Report that task_id is ready to run, which starts its ttl."""
+        return self.request(f'/started/{task_id}', b'')[0] == 200
+
+    def complete(self, task_id: str, result: bytes) -> bool:
+        return self.request(f'/result/{task_id}', result)[0] == 200
+
+    def get_samples(self, key: str, n_samples: int) -> SharedSamples:
+        """Return a local copy of the samples published as key, downloading them once per key."""
+        local = self.samples.get(key, None)
+        if local is not None:
+            self.samples.move_to_end(key)
+            return local
+        status, _, body = self.request(f'/samples/{key}')
+        if status != 200:
+            raise Exception(f"Samples {key} not available (status {status})")
+        local = SharedSamples.copy_from(io.BytesIO(body), key, n_samples)
+        self.samples[key] = local
+        while len(self.samples) > SAMPLES_CACHE_SIZE:
+            self.samples.popitem(last=False)[1].close()
+        return local
+
+    def serve(self, execute: Callable, stop_event: Optional[threading.Event] = None, heartbeat_interval: float = LEASE_SECONDS/4):
+        """
+        Run tasks until stop_event is set: execute(task, ttl, expected_errors, started)
+        returns the JSON-able result of the task described by task, or raises
+        an exception. execute calls started() once it is done preparing the
+        task (e.g. downloading the model), to start the ttl of the task.
+        References to samples in task are replaced by local copies
+        (SharedSamples).
+        """
+        while stop_event is None or not stop_event.is_set():
+            try:
+                leased = self.lease()
+            except Exception as e:
+                logger.warning(f"Failed to get a task from {self.url}: {e}")
+                leased = None
+            if leased is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+            task_id, task, ttl, expected_errors = leased
+
+            done = threading.Event()
+
+            def send_heartbeats():
+                while not done.wait(heartbeat_interval):
+                    try:
+                        if not self.heartbeat(task_id):
+                            logger.warning(f"Task {task_id} was given to another worker")
+                            return
+                    except Exception as e:
+                        logger.warning(f"Heartbeat for task {task_id} failed: {e}")
+
+            def started():
+                try:
+                    if not self.start(task_id):
+                        logger.warning(f"Task {task_id} was given to another worker")
+                except Exception as e:
+                    logger.warning(f"Failed to report start of task {task_id}: {e}")
+
+            heartbeat_thread = threading.Thread(target=send_heartbeats, daemon=True)
+            heartbeat_thread.start()
+            try:
+                try:
+                    for name, value in task.items():
+                        if isinstance(value, dict) and SAMPLES_REF_KEY in value:
+                            task[name] = self.get_samples(value[SAMPLES_REF_KEY], value['n_samples'])
+                    data = json.dumps({'result': execute(task, ttl, expected_errors, started)})
+                except Exception as e:
+                    data = json.dumps({'error': {
+                        'type': type(e).__name__,
+                        'message': str(e),
+                        'traceback': traceback.format_exc(),
+                    }})
+            finally:
+                done.set()
+                heartbeat_thread.join()
+            try:
+                self.complete(task_id, data.encode())
+            except Exception as e:
+                logger.warning(f"Failed to send result of task {task_id}: {e}")
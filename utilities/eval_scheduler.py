@@ -0,0 +1,209 @@
+import dataclasses
+import threading
+import time
+import traceback
+from typing import Any, Callable, Hashable, List, Optional
+
+from utilities.logs import TRACE, logger
+from utilities.worker_pool import TaskLost, WorkerPool
+
+# Number of times a task is started before giving up on it when its workers get lost
+MAX_TASK_ATTEMPTS = 3
+# Interval (seconds) for checking whether remote workers are available
+REMOTE_POLL_INTERVAL = 1
+
+
+@dataclasses.dataclass
+class EvalTask:
+    """
+    A task for EvalScheduler.run(). make_func(device, next_key) is called when
+    the task is dispatched, and returns the functools.partial to run on a
+    worker for device; next_key is the key of the task that is expected to run
+    next on the same worker (e.g. for prefetching), or None. For remote workers,
+    device is None: they evaluate on their own device, and make_func returns
+    the task description that EvalCoordinator.run() takes instead.
+    """
+    key: Hashable
+    make_func: Callable
+    # Estimated run time, in arbitrary units
+    cost: float = 1.0
+    # Tasks are dispatched group by group (lowest first)
+    group: int = 0
+    ttl: float = 600
+    expected_errors: set = dataclasses.field(default_factory=set)
+    # Whether the task may run on a remote worker
+    remote: bool = True
+
+
+class EvalScheduler:
+    """
+    Runs evaluation tasks concurrently on a list of devices, with one worker
+    process per entry (a device may be listed more than once, e.g. to run
+    several CPU workers).
+
+    Within a group, tasks are dispatched in order of decreasing cost (longest
+    processing time first), so that the largest models don't end up running
+    alone at the end of a step. A task goes back to the worker that ran the
+    task with the same key before, if that worker is free, to make use of the
+    models cached and prefetched in that worker.
+
+    With a remote pool (an EvalCoordinator), up to n_remote tasks at a time
+    run on remote workers, as long as these are available. Tasks whose
+    remote worker got lost are started again, on any worker.
+    """
+    def __init__(
+        self, devices: List[str], mode: str = "spawn", max_tasks: int = 0, name: str = "eval",
+        main_module: Optional[str] = None, remote=None, n_remote: int = 0
+    ):
+        """
+        Args:
+            devices (list): Device per worker process.
+            mode, max_tasks, main_module: see WorkerPool.
+            name (str): Prefix for worker process names.
+            remote (EvalCoordinator): Pool of remote workers, or None.
+            n_remote (int): Maximum number of tasks running on remote workers.
+        """
+        self.devices = list(devices)
+        if len(self.devices) == 0:
+            raise ValueError("No devices to evaluate on")
+        self.pools = [
+            WorkerPool(
+                mode=mode,
+                max_tasks=max_tasks,
+                name=name if len(self.devices) == 1 else f'{name}{slot}',
+                main_module=main_module,
+            ) for slot in range(len(self.devices))
+        ]
+        self.remote = remote
+        self.n_remote = n_remote if remote is not None else 0
+        # Task key -> slot that ran it last
+        self.affinity = {}
+
+    def __len__(self):
+        """Number of local worker processes."""
+        return len(self.devices)
+
+    def is_remote(self, slot: int) -> bool:
+        return slot >= len(self.devices)
+
+    def _take(self, pending: List[EvalTask], slot: int, pop: bool = True) -> Optional[EvalTask]:
+        """Select the next task for slot from pending, which is sorted in dispatch order."""
+        candidates = [i for i, task in enumerate(pending) if task.remote or not self.is_remote(slot)]
+        if len(candidates) == 0:
+            return None
+        idx = candidates[0]
+        for i in candidates:
+            if pending[i].group != pending[candidates[0]].group:
+                break
+            if self.affinity.get(pending[i].key, slot) == slot:
+                idx = i
+                break
+        return pending.pop(idx) if pop else pending[idx]
+
+    def run(
+        self, tasks: List[EvalTask], on_result: Callable[[EvalTask, Any, Optional[Exception]], Optional[List[EvalTask]]],
+        deadline: Optional[float] = None
+    ) -> List[EvalTask]:
+        """
+        Run tasks on the workers and call on_result(task, result, exception)
+        for each of them as it completes, with exception None on success. Each
+        task has its own ttl; a task that exceeds it fails with TimeoutError
+        without affecting the others. on_result may return a list of tasks to
+        run in addition, e.g. to replace a failed task.
+
+        Calls to make_func and on_result are serialized, so they can use shared
+        state (e.g. results of earlier tasks) without locking.
+
+        No tasks are started after deadline (time.time()); returns the tasks
+        that were not started.
+        """
+        order = lambda task: (task.group, -task.cost)
+        pending = sorted(tasks, key=order)
+        attempts = {}
+        n_running_remote = 0
+        lock = threading.Lock()
+
+        def report(task, result, exception):
+            try:
+                new_tasks = on_result(task, result, exception)
+                if new_tasks:
+                    pending.extend(new_tasks)
+                    pending.sort(key=order)
+            except Exception as e:
+                logger.error(f"Failed to process result of task {task.key}: {e}\n{traceback.format_exc()}")
+
+        def work(slot):
+            nonlocal n_running_remote
+            remote = self.is_remote(slot)
+            device = None if remote else self.devices[slot]
+            pool = self.remote if remote else self.pools[slot]
+            while True:
+                with lock:
+                    if deadline is not None and time.time() > deadline:
+                        return
+                    if self._take(pending, slot, pop=False) is None:
+                        # Tasks of lost remote workers may still come back
+                        if remote or n_running_remote == 0:
+                            return
+                        ready = False
+                    else:
+                        ready = not remote or self.remote.try_reserve()
+                    if ready:
+                        task = self._take(pending, slot)
+                        next_task = self._take(pending, slot, pop=False)
+                        try:
+                            func = task.make_func(device, None if next_task is None else next_task.key)
+                        except Exception as e:
+                            if remote:
+                                self.remote.cancel_reservation()
+                            report(task, None, e)
+                            continue
+                        self.affinity[task.key] = slot
+                        n_running_remote += remote
+                if not ready:
+                    time.sleep(REMOTE_POLL_INTERVAL)
+                    continue
+
+                logger.log(TRACE, f"Running task {task.key} on {'remote worker' if remote else device}")
+                result, exception = None, None
+                try:
+                    result = pool.run(func, ttl=task.ttl, expected_errors=task.expected_errors)
+                except Exception as e:
+                    exception = e
+                with lock:
+                    n_running_remote -= remote
+                    if isinstance(exception, TaskLost):
+                        attempts[task.key] = attempts.get(task.key, 0) + 1
+                        if attempts[task.key] < MAX_TASK_ATTEMPTS:
+                            logger.warning(f"Task {task.key} is started again: {exception}")
+                            self.affinity.pop(task.key, None)
+                            pending.append(task)
+                            pending.sort(key=order)
+                            continue
+                    report(task, result, exception)
+
+        n_slots = len(self.devices) + self.n_remote
+        if n_slots == 1:
+            work(0)
+        else:
+            threads = [
+                threading.Thread(target=work, args=(slot,), name=f'eval-slot-{slot}', daemon=True)
+                for slot in range(n_slots)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return pending
+
+    def check_health(self):
+        for pool in self.pools:
+            pool.check_health()
+        if self.remote is not None:
+            self.remote.check_health()
+
+    def shutdown(self):
+        for pool in self.pools:
+            pool.shutdown()
+        if self.remote is not None:
+            self.remote.shutdown()
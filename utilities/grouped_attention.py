@@ -0,0 +1,63 @@
+import torch
+from packaging import version
+
+# scaled_dot_product_attention() supports grouped-query attention natively as of torch 2.5
+SDPA_SUPPORTS_GQA = version.parse(torch.__version__).release >= (2, 5)
+
+
+def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
+    """
+    Expand [batch, n_kv_heads, seq_len, head_dim] to [batch, n_kv_heads*n_rep, seq_len, head_dim].
+    """
+    batch, num_key_value_heads, slen, head_dim = hidden_states.shape
+    if n_rep == 1:
+        return hidden_states
+    hidden_states = hidden_states[:, :, None, :, :].expand(batch, num_key_value_heads, n_rep, slen, head_dim)
+    return hidden_states.reshape(batch, num_key_value_heads * n_rep, slen, head_dim)
+
+
+def grouped_matmul_qk(query: torch.Tensor, key: torch.Tensor) -> torch.Tensor:
+    """
+    Compute query @ key^T for query [batch, n_heads, q_len, head_dim] and key
+    [batch, n_kv_heads, kv_len, head_dim], where each group of n_heads/n_kv_heads
+    consecutive query heads shares one key head, without expanding key.
+    Returns [batch, n_heads, q_len, kv_len].
+    """
+    bsz, n_heads, q_len, head_dim = query.shape
+    n_kv_heads = key.shape[1]
+    if n_kv_heads == n_heads:
+        return torch.matmul(query, key.transpose(2, 3))
+    # Queries of a group are stacked along the sequence dimension
+    grouped = query.reshape(bsz, n_kv_heads, (n_heads // n_kv_heads) * q_len, head_dim)
+    return torch.matmul(grouped, key.transpose(2, 3)).view(bsz, n_heads, q_len, -1)
+
+
+def grouped_matmul_av(attn_weights: torch.Tensor, value: torch.Tensor) -> torch.Tensor:
+    """
+    Compute attn_weights @ value for attn_weights [batch, n_heads, q_len, kv_len]
+    and value [batch, n_kv_heads, kv_len, head_dim], without expanding value.
+    Returns [batch, n_heads, q_len, head_dim].
+    """
+    bsz, n_heads, q_len, kv_len = attn_weights.shape
+    n_kv_heads = value.shape[1]
+    if n_kv_heads == n_heads:
+        return torch.matmul(attn_weights, value)
+    grouped = attn_weights.reshape(bsz, n_kv_heads, (n_heads // n_kv_heads) * q_len, kv_len)
+    return torch.matmul(grouped, value).view(bsz, n_heads, q_len, -1)
+
+
+def grouped_scaled_dot_product_attention(
+    query: torch.Tensor, key: torch.Tensor, value: torch.Tensor, attn_mask=None, dropout_p: float = 0.0, is_causal: bool = False
+) -> torch.Tensor:
+    """
+    scaled_dot_product_attention() for key and value with fewer heads than
+    query. Uses native grouped-query support if available, otherwise falls
+    back to expanding key and value.
+    """
+    n_rep = query.shape[1] // key.shape[1]
+    kwargs = dict(attn_mask=attn_mask, dropout_p=dropout_p, is_causal=is_causal)
+    if n_rep == 1:
+        return torch.nn.functional.scaled_dot_product_attention(query, key, value, **kwargs)
+    if SDPA_SUPPORTS_GQA:
+        return torch.nn.functional.scaled_dot_product_attention(query, key, value, enable_gqa=True, **kwargs)
+    return torch.nn.functional.scaled_dot_product_attention(query, repeat_kv(key, n_rep), repeat_kv(value, n_rep), **kwargs)
@@ -0,0 +1,78 @@
+import json
+import os
+
+import torch
+from safetensors import safe_open
+
+# Checkpoints of models with tied embeddings may lack these tensors
+TIED_WEIGHT_ALIASES = {'lm_head.weight': 'model.embed_tokens.weight'}
+
+
+def is_lazy_model(model) -> bool:
+    """Check whether the parameters of model are to be loaded on demand, see model.loader.lazy_load_model()."""
+    return getattr(model, 'lazy_weights_path', None) is not None
+
+
+def get_weight_map(path: str) -> dict:
+    """Return map of tensor name to safetensors file, for the model at path."""
+    index_fn = os.path.join(path, 'model.safetensors.index.json')
+    if os.path.exists(index_fn):
+        with open(index_fn) as f:
+            weight_map = json.load(f)['weight_map']
+        return {name: os.path.join(path, fn) for name, fn in weight_map.items()}
+    fn = os.path.join(path, 'model.safetensors')
+    if not os.path.exists(fn):
+        raise FileNotFoundError(f"No safetensors files found in {path}")
+    with safe_open(fn, framework='pt') as f:
+        return {name: fn for name in f.keys()}
+
+
+def load_weights(model: torch.nn.Module, path: str, names, device, weight_map: dict = None):
+    """
+    Load parameters names of model from the safetensors checkpoint at path,
+    straight to device, in the dtype of the (meta) parameters. Only the shards
+    holding these parameters are opened.
+    """
+    if weight_map is None:
+        weight_map = get_weight_map(path)
+    per_file = {}
+    for name in names:
+        ckpt_name = name
+        if ckpt_name not in weight_map:
+            ckpt_name = TIED_WEIGHT_ALIASES.get(name, name)
+        if ckpt_name not in weight_map:
+            raise KeyError(f"Tensor {name} not found in checkpoint at {path}")
+        per_file.setdefault(weight_map[ckpt_name], []).append((name, ckpt_name))
+
+    for fn, fn_names in per_file.items():
+        with safe_open(fn, framework='pt', device=str(device)) as f:
+            for name, ckpt_name in fn_names:
+                module_name, _, tensor_name = name.rpartition('.')
+                module = model.get_submodule(module_name)
+                param = module._parameters[tensor_name]
+                tensor = f.get_tensor(ckpt_name)
+                if tuple(tensor.shape) != tuple(param.shape):
+                    raise ValueError(f"Shape mismatch for {name}: expected {tuple(param.shape)}, found {tuple(tensor.shape)}")
+                if tensor.dtype != param.dtype:
+                    tensor = tensor.to(param.dtype)
+                module._parameters[tensor_name] = torch.nn.Parameter(tensor, requires_grad=False)
+
+
+def unload_weights(model: torch.nn.Module, names):
+    """Put parameters names of model back on the meta device, releasing their memory."""
+    for name in names:
+        module_name, _, tensor_name = name.rpartition('.')
+        module = model.get_submodule(module_name)
+        param = module._parameters[tensor_name]
+        module._parameters[tensor_name] = torch.nn.Parameter(
+                torch.empty(param.shape, dtype=param.dtype, device='meta'),
+                requires_grad=False,
+        )
+
+
+def move_buffers(model: torch.nn.Module, device):
+    """Move buffers of model (not its parameters, which may be on the meta device) to device."""
+    for module in model.modules():
+        for name, buf in module._buffers.items():
+            if buf is not None and buf.device.type != 'meta':
+                module._buffers[name] = buf.to(device)
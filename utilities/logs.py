@@ -0,0 +1,157 @@
+# Logging for modules that run in evaluation workers, which don't import
+# bittensor (it pulls in rich and the chain client, see
+# tests/pretrain/test_eval_worker.py). They log through the standard library
+# logger that bt.logging writes to, so their records go through the bittensor
+# handlers in the validator, and through the log channel below in workers.
+
+import atexit
+import logging as stdlogging
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+# Name of the logger of bt.logging, as in bittensor.btlogging.defines
+BITTENSOR_LOGGER_NAME = 'bittensor'
+# Level of bt.logging.trace()
+TRACE = 5
+
+logger = stdlogging.getLogger(BITTENSOR_LOGGER_NAME)
+
+
+# Log records buffered between child processes and the parent; children drop records when it is full.
+LOG_QUEUE_SIZE = 10000
+# Debug (and lower level) records per second that a child process forwards; it drops the rest.
+LOG_DEBUG_RATE = 100
+
+
+class _ChildQueueHandler(QueueHandler):
+    """
+    Forwards log records of a child process to the parent, without ever
+    blocking the child: records are dropped when the queue is full, and debug
+    records beyond debug_rate per second. The number of dropped records is
+    reported with the next forwarded record.
+    """
+    def __init__(self, log_queue, debug_rate: int = LOG_DEBUG_RATE):
+        super().__init__(log_queue)
+        self.debug_rate = debug_rate
+        self.window_start = 0
+        self.window_count = 0
+        self.n_dropped = 0
+
+    def emit(self, record):
+        if record.levelno <= stdlogging.DEBUG:
+            now = time.monotonic()
+            if now - self.window_start >= 1:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            if self.window_count > self.debug_rate:
+                self.n_dropped += 1
+                return
+        if self.n_dropped:
+            n_dropped = self.n_dropped
+            self.n_dropped = 0
+            super().emit(stdlogging.makeLogRecord(dict(
+                    name=record.name,
+                    levelno=stdlogging.WARNING,
+                    levelname=stdlogging.getLevelName(stdlogging.WARNING),
+                    msg=f'{multiprocessing.current_process().name} dropped {n_dropped} log records',
+            )))
+        super().emit(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Exception:
+            # Queue full, or the channel is gone
+            self.n_dropped += 1
+
+
+class _RelogHandler(stdlogging.Handler):
+    """Passes records to the handlers of the bittensor logger, as they are at the time."""
+    def emit(self, record):
+        logger.handle(record)
+
+
+class _LogForwarder:
+    """
+    Channel for log records of child processes, re-logged through the
+    bittensor logger in this process. One channel serves all children started
+    with a given start method, for the lifetime of this process.
+
+    The queue lives in a manager process, and each child talks to it over its
+    own connection. A child that is killed while logging (e.g. on timeout)
+    can only break its own connection; with a plain multiprocessing.Queue, it
+    could leave the shared pipe with half a record, or its lock held, and
+    stall logging of all other children.
+    """
+    def __init__(self, ctx):
+        self.manager = ctx.Manager()
+        self.queue = self.manager.Queue(LOG_QUEUE_SIZE)
+        self.listener = QueueListener(self.queue, _RelogHandler())
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        try:
+            self.listener.stop()
+        except Exception:
+            pass
+        self.manager.shutdown()
+
+
+_log_forwarders = {}
+_log_forwarders_lock = threading.Lock()
+
+
+def get_log_queue(mode: str) -> Optional[queue.Queue]:
+    """
+    Return the queue that child processes started with mode ("spawn" or
+    "forkserver") should pass to forward_logging_to_queue(), creating the
+    channel on first use. Returns None for "fork", where children inherit
+    the log handlers, or if the channel can't be created.
+    """
+    if mode == 'fork':
+        return None
+    with _log_forwarders_lock:
+        forwarder = _log_forwarders.get(mode, None)
+        if forwarder is None:
+            try:
+                forwarder = _LogForwarder(multiprocessing.get_context(mode))
+            except Exception as e:
+                logger.warning(f'Non-fatal: failed to implement proper logging for child processes: {e}')
+                return None
+            _log_forwarders[mode] = forwarder
+    return forwarder.queue
+
+
+def forward_logging_to_queue(log_queue: queue.Queue, level: int = stdlogging.INFO):
+    """
+    Redirect bittensor logging in a (spawned) child process to log_queue,
+    for records of at least level.
+    """
+    # This feature is not (yet) available on bittensor
+    #bt.logging.set_queue(log_queue)
+    # Hack in a queue handler, avoid private variables where possible.
+    try:
+        while len(logger.handlers):
+            logger.removeHandler(logger.handlers[0])
+        # Evaluation workers don't import bittensor at all
+        bt = sys.modules.get('bittensor', None)
+        if bt is not None:
+            try:
+                # This is needed to prevent EOFError clutter on subprocess termination.
+                atexit.unregister(bt.logging._listener.stop)
+                bt.logging._listener.stop()
+            except Exception as e:
+                print(f'Non-fatal: exception trying to stop btlogger listener: {e}')
+        queue_handler = _ChildQueueHandler(log_queue)
+        logger.addHandler(queue_handler)
+        queue_handler.setLevel(level)
+        logger.setLevel(level)
+    except Exception as e:
+        print(f'Non-fatal: exception trying to implement proper logging: {e}')
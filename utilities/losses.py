@@ -0,0 +1,75 @@
+import torch
+import torch.nn.functional as F
+
+# Config attributes of models that post-process the lm_head output; such models
+# can not be evaluated using chunked_cross_entropy().
+LOGIT_TRANSFORM_ATTRS = ['final_logit_softcapping', 'logit_scale', 'logits_scaling', 'output_multiplier_scale']
+
+def get_decoder_and_head(model):
+    """
+    Return (decoder, lm_head) of a causal LM, if its logits are simply lm_head(decoder(...)[0]).
+    Return (None, None) otherwise.
+    """
+    decoder = getattr(model, 'model', None)
+    if not isinstance(decoder, torch.nn.Module):
+        return None, None
+    try:
+        lm_head = model.get_output_embeddings()
+    except Exception:
+        return None, None
+    if not isinstance(lm_head, torch.nn.Linear):
+        return None, None
+    config = getattr(model, 'config', None)
+    for attr in LOGIT_TRANSFORM_ATTRS:
+        if getattr(config, attr, None) is not None:
+            return None, None
+    return decoder, lm_head
+
+def chunked_cross_entropy(hidden_states, lm_head, labels, chunk_tokens, reduction='sum'):
+    """
+    Cross-entropy of lm_head(hidden_states) with respect to labels, without
+    materializing the full [n_tokens, vocab_size] logits. The lm_head and loss
+    are evaluated on chunks of at most chunk_tokens positions at a time, so peak
+    memory is bounded by chunk_tokens * vocab_size logits (in float32).
+
+    Parameters:
+        hidden_states (torch.Tensor): [n_tokens, hidden_size] final hidden states.
+        lm_head (torch.nn.Module): Maps hidden states to logits.
+        labels (torch.Tensor): [n_tokens] target token ids.
+        chunk_tokens (int): Number of positions per chunk.
+        reduction (str): 'sum', 'mean' or 'none' (returns per-token losses).
+
+    Returns:
+        torch.Tensor: Scalar loss, or [n_tokens] float32 losses for reduction 'none'.
+    """
+    n_tokens = hidden_states.shape[0]
+    token_losses = []
+    loss_sum = None
+    for start in range(0, n_tokens, chunk_tokens):
+        logits = lm_head(hidden_states[start:start+chunk_tokens]).float()
+        chunk_loss = F.cross_entropy(
+            logits,
+            labels[start:start+chunk_tokens],
+            reduction='none' if reduction == 'none' else 'sum'
+        )
+        del logits
+        if reduction == 'none':
+            token_losses.append(chunk_loss)
+        elif loss_sum is None:
+            loss_sum = chunk_loss
+        else:
+            loss_sum += chunk_loss
+
+    if reduction == 'none':
+        if len(token_losses) == 0:
+            return torch.zeros(0, dtype=torch.float32, device=hidden_states.device)
+        return torch.cat(token_losses)
+    if loss_sum is None:
+        loss_sum = torch.zeros((), dtype=torch.float32, device=hidden_states.device)
+    if reduction == 'mean':
+        return loss_sum / n_tokens
+    return loss_sum
+
+
+def is_oom_error(e: Exception) -> bool:
+    return isinstance(e, torch.cuda.OutOfMemoryError) or 'out of memory' in str(e)
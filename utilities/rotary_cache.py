@@ -0,0 +1,77 @@
+import threading
+
+import torch
+
+# Tables are built in multiples of this many positions, so that samples of similar lengths share one table
+ROTARY_TABLE_GRANULARITY = 256
+
+_lock = threading.Lock()
+# (rope key, dtype, device) -> ([n, dim] cos, [n, dim] sin)
+_tables = {}
+
+
+def get_rope_key(inv_freq: torch.Tensor, attention_scaling: float = 1.0) -> tuple:
+    """
+    Return a hashable description of rotary frequencies, identical for models
+    with identical rope configurations. Computing it synchronizes with the
+    device inv_freq lives on, so it should be computed once and kept.
+    """
+    return tuple(inv_freq.float().cpu().tolist()), float(attention_scaling)
+
+
+def get_module_rope_key(module: torch.nn.Module, attention_scaling: float = 1.0, inv_freq: torch.Tensor = None) -> tuple:
+    """
+    Return the rope key of a rotary embedding module, for its inv_freq buffer
+    unless another inv_freq is given. It is recomputed only when that tensor
+    is replaced (e.g. when the model is moved or cast).
+    """
+    if inv_freq is None:
+        inv_freq = module.inv_freq
+    memo = getattr(module, '_rope_key_memo', None)
+    if memo is None or memo[0] is not inv_freq or memo[1] != attention_scaling:
+        memo = (inv_freq, attention_scaling, get_rope_key(inv_freq, attention_scaling))
+        module._rope_key_memo = memo
+    return memo[2]
+
+
+def get_rotary_table(rope_key: tuple, length: int, dtype: torch.dtype, device) -> tuple:
+    """
+    Return ([length, dim] cos, [length, dim] sin) for positions 0..length-1,
+    computed in float32 and cast to dtype, as the rotary embeddings do.
+
+    The results are views of a single cached table per rope key, dtype and
+    device, which only grows when longer inputs come along. They must not be
+    modified in place.
+    """
+    key = (rope_key, dtype, str(device))
+    with _lock:
+        table = _tables.get(key, None)
+        if table is None or table[0].shape[0] < length:
+            size = -(-length // ROTARY_TABLE_GRANULARITY) * ROTARY_TABLE_GRANULARITY
+            _tables.pop(key, None)
+            del table
+            inv_freq_values, attention_scaling = rope_key
+            inv_freq = torch.tensor(inv_freq_values, dtype=torch.float32, device=device)
+            positions = torch.arange(size, dtype=torch.int64, device=device).float()
+            freqs = torch.outer(positions, inv_freq)
+            emb = torch.cat((freqs, freqs), dim=-1)
+            table = ((emb.cos() * attention_scaling).to(dtype), (emb.sin() * attention_scaling).to(dtype))
+            _tables[key] = table
+    cos, sin = table
+    return cos[:length], sin[:length]
+
+
+def get_rotary_cos_sin(rope_key: tuple, position_ids: torch.Tensor, dtype: torch.dtype) -> tuple:
+    """
+    Return ([batch, seq_len, dim] cos, [batch, seq_len, dim] sin) for
+    [batch, seq_len] position_ids, gathered from the shared table.
+    """
+    length = int(position_ids.max()) + 1 if position_ids.numel() else 0
+    cos, sin = get_rotary_table(rope_key, length, dtype, position_ids.device)
+    return cos[position_ids], sin[position_ids]
+
+
+def clear_rotary_cache():
+    """Release all cached tables."""
+    with _lock:
+        _tables.clear()
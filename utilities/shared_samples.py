@@ -0,0 +1,150 @@
+import collections
+import mmap
+import os
+import shutil
+import tempfile
+import uuid
+import weakref
+from typing import List, Optional
+
+import torch
+
+# Files in /dev/shm live in RAM; elsewhere they are at least in the page cache
+SHARED_SAMPLES_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+# Number of sample sets whose tensors a process keeps, e.g. the competition-wide samples
+# and those of a model-supplied tokenizer
+SAMPLES_CACHE_SIZE = 2
+
+# key -> list of tensors, in the processes using the samples
+_samples_cache = collections.OrderedDict()
+
+
+class SharedSamples:
+    """
+    Tokenized samples in one file, to be shared by the validator and its
+    evaluation workers without copying them through pipes. The file holds an
+    index of n_samples (offset, length) int64 pairs (length -1 for samples
+    that are None), followed by all tokens as int32.
+
+    Only the path, number of samples and a key are pickled, so passing the samples to
+    a worker costs the same for any number of samples. Workers map the file
+    and convert the samples to tensors once per sample set.
+    """
+    def __init__(self, path: str, n_samples: int):
+        self.path = path
+        self.n_samples = n_samples
+        # Identifies the contents in caches, also if the path is reused later
+        self.key = uuid.uuid4().hex
+        self._finalizer = None
+
+    @classmethod
+    def create(cls, batches: List[Optional[torch.Tensor]], path: Optional[str] = SHARED_SAMPLES_DIR) -> 'SharedSamples':
+        """
+        Write [1, seq_len] token tensors (or None) to a new file in directory
+        path. The file is removed by close(), or when the returned object is
+        garbage collected; copies in other processes don't own it.
+        """
+        index = torch.full((len(batches), 2), -1, dtype=torch.int64)
+        offset = 0
+        for i, batch in enumerate(batches):
+            if batch is not None:
+                index[i, 0] = offset
+                index[i, 1] = batch.shape[-1]
+                offset += batch.shape[-1]
+        tokens = [batch.reshape(-1) for batch in batches if batch is not None]
+        tokens = torch.cat(tokens) if len(tokens) else torch.zeros(0, dtype=torch.int64)
+        if len(tokens) and (tokens.min() < torch.iinfo(torch.int32).min or tokens.max() > torch.iinfo(torch.int32).max):
+            raise ValueError("Token ids don't fit in int32")
+
+        fd, file_path = tempfile.mkstemp(prefix='samples-', suffix='.bin', dir=path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(index.numpy().tobytes())
+                f.write(tokens.to(torch.int32).numpy().tobytes())
+        except Exception:
+            os.unlink(file_path)
+            raise
+        shared = cls(file_path, len(batches))
+        shared._finalizer = weakref.finalize(shared, _remove, file_path)
+        return shared
+
+    @classmethod
+    def copy_from(cls, fileobj, key: str, n_samples: int, path: Optional[str] = SHARED_SAMPLES_DIR) -> 'SharedSamples':
+        """
+        Write the contents of the file of the n_samples samples with key, read
+        from fileobj (e.g. a download from another host), to a new file in
+        directory path. The copy keeps key and owns its file, like the result
+        of create().
+        """
+        fd, file_path = tempfile.mkstemp(prefix='samples-', suffix='.bin', dir=path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(fileobj, f)
+        except Exception:
+            os.unlink(file_path)
+            raise
+        copy = cls(file_path, n_samples)
+        copy.key = key
+        copy._finalizer = weakref.finalize(copy, _remove, file_path)
+        return copy
+
+    def __getstate__(self):
+        return (self.path, self.n_samples, self.key)
+
+    def __setstate__(self, state):
+        self.path, self.n_samples, self.key = state
+        self._finalizer = None
+
+    def __len__(self):
+        return self.n_samples
+
+    def tensors(self) -> List[Optional[torch.Tensor]]:
+        """
+        Return the samples as a list of [1, seq_len] int64 tensors (or None).
+        The list is cached per process, so repeated calls for the same file
+        (e.g. one per evaluated model) don't read or convert it again.
+        """
+        samples = _samples_cache.get(self.key, None)
+        if samples is not None:
+            _samples_cache.move_to_end(self.key)
+            return samples
+
+        samples = []
+        if self.n_samples == 0:
+            return samples
+        with open(self.path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        index_bytes = 16*self.n_samples
+        index = torch.frombuffer(data, dtype=torch.int64, count=2*self.n_samples).view(-1, 2).tolist()
+        for offset, length in index:
+            if length < 0:
+                samples.append(None)
+            elif length == 0:
+                samples.append(torch.zeros((1, 0), dtype=torch.int64))
+            else:
+                tokens = torch.frombuffer(data, dtype=torch.int32, count=length, offset=index_bytes + 4*offset)
+                # int64 like the tokenizer output; the map is released once all views are converted
+                samples.append(tokens.to(torch.int64).view(1, -1))
+        _samples_cache[self.key] = samples
+        while len(_samples_cache) > SAMPLES_CACHE_SIZE:
+            _samples_cache.popitem(last=False)
+        return samples
+
+    def close(self):
+        """Remove the file, if this object created it."""
+        if self._finalizer is not None:
+            self._finalizer()
+
+
+def _remove(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def get_sample_tensors(batches) -> List[Optional[torch.Tensor]]:
+    """Return batches as a list of tensors, whether they are shared or not."""
+    if isinstance(batches, SharedSamples):
+        return batches.tensors()
+    return batches
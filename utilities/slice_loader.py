@@ -0,0 +1,118 @@
+import threading
+
+import torch
+
+
+def is_cuda_device(device) -> bool:
+    return device is not None and torch.cuda.is_available() and torch.device(device).type == 'cuda'
+
+
+def get_tensors(model_slice):
+    """List (module, kind, name, tensor) of all parameters and buffers of model_slice."""
+    ret = []
+    seen = set()
+    for module in model_slice.modules():
+        for kind, tensors in (('param', module._parameters), ('buffer', module._buffers)):
+            for name, t in tensors.items():
+                if t is None or id(t) in seen:
+                    continue
+                seen.add(id(t))
+                ret.append((module, kind, name, t.data))
+    return ret
+
+
+def set_tensors(tensors, device=None, non_blocking=False):
+    """
+    Put the tensors listed by get_tensors() back in their modules, or copies
+    of them on device, if specified. Putting back the original (host)
+    tensors releases the device copies without copying them to the host.
+    """
+    for module, kind, name, data in tensors:
+        if device is not None:
+            data = data.to(device, non_blocking=non_blocking)
+        if kind == 'param':
+            module._parameters[name].data = data
+        else:
+            module._buffers[name] = data
+
+
+class SliceLoader:
+    """
+    Moves model slices to a CUDA device on a side stream, in a background
+    thread, so that loading slice k+1 overlaps with evaluating slice k.
+
+    By default, a slice is unloaded by putting back its original (CPU) tensors,
+    which frees the device copies without copying them back to the host.
+    Alternatively, load_fn(model_slice) and unload_fn(model_slice) are used to
+    load and release the weights (e.g. straight from disk). Device tensors are
+    marked as used by the compute stream, so their memory is only reused after
+    pending kernels have finished.
+
+    Usage:
+        loader.load(slice_0)
+        for k: loader.wait(slice_k); loader.load(slice_k+1); evaluate(slice_k); loader.unload(slice_k)
+    """
+    def __init__(self, device, load_fn=None, unload_fn=None):
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device)
+        self.load_fn = load_fn
+        self.unload_fn = unload_fn
+        # id(model_slice) -> (model_slice, thread, event, exceptions, original tensors)
+        self.pending = {}
+        # id(model_slice) -> (model_slice, original tensors)
+        self.loaded = {}
+
+    def _copy(self, model_slice, tensors, event, exceptions):
+        try:
+            with torch.cuda.stream(self.stream):
+                if self.load_fn is not None:
+                    self.load_fn(model_slice)
+                else:
+                    set_tensors(tensors, self.device, non_blocking=True)
+                event.record(self.stream)
+        except Exception as e:
+            exceptions.append(e)
+
+    def load(self, model_slice):
+        """Start copying model_slice to the device."""
+        tensors = get_tensors(model_slice) if self.load_fn is None else []
+        event = torch.cuda.Event()
+        exceptions = []
+        thread = threading.Thread(target=self._copy, args=(model_slice, tensors, event, exceptions), daemon=True)
+        thread.start()
+        self.pending[id(model_slice)] = (model_slice, thread, event, exceptions, tensors)
+
+    def wait(self, model_slice):
+        """Wait until model_slice is on the device, and make the current stream wait for the copies."""
+        _, thread, event, exceptions, tensors = self.pending.pop(id(model_slice))
+        thread.join()
+        self.loaded[id(model_slice)] = (model_slice, tensors)
+        if len(exceptions):
+            self.unload(model_slice)
+            raise exceptions[0]
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_stream.wait_event(event)
+        for t in list(model_slice.parameters()) + list(model_slice.buffers()):
+            if t.device.type == 'cuda':
+                t.data.record_stream(compute_stream)
+
+    def _unload(self, model_slice, tensors):
+        if self.unload_fn is not None:
+            self.unload_fn(model_slice)
+            return
+        set_tensors(tensors)
+
+    def unload(self, model_slice):
+        """Release the device copies of model_slice."""
+        if id(model_slice) in self.loaded:
+            self._unload(*self.loaded.pop(id(model_slice)))
+
+    def close(self):
+        """Wait for pending copies and unload everything."""
+        for model_slice, thread, _, _, tensors in self.pending.values():
+            thread.join()
+            self._unload(model_slice, tensors)
+        self.pending = {}
+        for model_slice, tensors in self.loaded.values():
+            self._unload(model_slice, tensors)
+        self.loaded = {}
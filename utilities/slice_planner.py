@@ -0,0 +1,243 @@
+import typing
+
+import torch
+
+from utilities.slice_loader import is_cuda_device
+from utilities.sliced_model import SliceAdapter, gen_state_groups, get_pinned_slices, get_slice_adapter
+
+# Activation estimates are rough; leave some headroom for allocator fragmentation
+ACTIVATION_SAFETY_FACTOR = 1.25
+
+
+def get_param_bytes(model: torch.nn.Module) -> dict:
+    """
+    Measure parameter bytes of model per part, as classified by its
+    SliceAdapter: 'embed' (embeddings, first slice only), 'layers'
+    (list, per decoder layer), 'tail' (final norm and lm_head, last slice only)
+    and 'shared' (needed by all slices). Works for models on the meta device.
+    Tied parameters are counted in every part using them, as each slice gets
+    its own device copy.
+    """
+    adapter = get_slice_adapter(model) or SliceAdapter()
+    ret = {'embed': 0, 'layers': [0]*model.config.num_hidden_layers, 'tail': 0, 'shared': 0}
+    for pname, p in model.named_parameters(remove_duplicate=False):
+        nbytes = p.numel()*p.element_size()
+        part, layer_idx = adapter.classify(pname)
+        if part == 'layer':
+            ret['layers'][layer_idx] += nbytes
+        else:
+            ret[part] += nbytes
+    return ret
+
+
+def estimate_activation_bytes(config, max_len: int, dtype_bytes: int, logits_chunk_tokens: int = 0) -> dict:
+    """
+    Estimate peak device memory (bytes) needed for intermediate values when
+    evaluating a single sample of max_len tokens: 'layer' for running any
+    decoder layer, 'logits' for lm_head and loss in the last slice.
+    """
+    hidden = config.hidden_size
+    intermediate = getattr(config, 'intermediate_size', None) or 4*hidden
+    n_heads = config.num_attention_heads
+    n_kv_heads = getattr(config, 'num_key_value_heads', None) or n_heads
+    head_dim = hidden // n_heads
+    # Residual, normalized input, q/k/v, attention output; gate, up and activated MLP values
+    layer = max_len*dtype_bytes*(4*hidden + 2*n_kv_heads*head_dim + 3*intermediate)
+    if getattr(config, '_attn_implementation', None) == 'eager':
+        # Attention scores and their (float32) softmax
+        layer += n_heads*max_len*max_len*(dtype_bytes + 4)
+    logits_len = min(max_len, logits_chunk_tokens) if logits_chunk_tokens else max_len
+    # Logits, their float32 copy and the log-softmax in the loss
+    logits = logits_len*config.vocab_size*(dtype_bytes + 8)
+    return {
+            'layer': int(ACTIVATION_SAFETY_FACTOR*layer),
+            'logits': int(ACTIVATION_SAFETY_FACTOR*logits),
+    }
+
+
+def plan_start_layers(
+    param_bytes: dict, budget: int, layer_overhead: int = 0, last_overhead: int = 0, stream_slices: bool = False,
+    allow_single: bool = True
+) -> typing.Optional[typing.List[int]]:
+    """
+    Find start layers of slices such that every slice (or, if stream_slices,
+    every pair of consecutive slices) fits in budget bytes, including
+    layer_overhead for activations and, in the last slice, last_overhead.
+    If not allow_single, at least two slices are used.
+
+    The number of slices is minimized first, which also minimizes the number
+    of hidden state hand-overs between slices; ties are broken by minimizing
+    the largest slice, keeping the most headroom. Returns None if not even a
+    single layer per slice fits.
+    """
+    layers = param_bytes['layers']
+    n = len(layers)
+    cumulative = [0]
+    for nbytes in layers:
+        cumulative.append(cumulative[-1] + nbytes)
+
+    def slice_bytes(i, j):
+        nbytes = cumulative[j] - cumulative[i] + param_bytes['shared']
+        if i == 0:
+            nbytes += param_bytes['embed']
+        if j == n:
+            nbytes += param_bytes['tail'] + last_overhead
+        return nbytes
+
+    def cost(*slice_sizes):
+        return sum(slice_sizes) + layer_overhead
+
+    # best[(i, j)]: (n_slices, largest slice, start layers) for layers 0..j, with last slice i..j
+    best = {}
+    for j in range(1, n+1):
+        if cost(slice_bytes(0, j)) <= budget:
+            best[(0, j)] = (1, slice_bytes(0, j), [0])
+    for i in range(1, n):
+        for j in range(i+1, n+1):
+            size = slice_bytes(i, j)
+            if cost(size) > budget:
+                continue
+            candidates = []
+            for h in range(i):
+                prev = best.get((h, i), None)
+                if prev is None or (stream_slices and cost(slice_bytes(h, i), size) > budget):
+                    continue
+                candidates.append((prev[0]+1, max(prev[1], size), prev[2] + [i]))
+            if len(candidates):
+                best[(i, j)] = min(candidates, key=lambda c: c[:2])
+
+    plans = [best[(i, n)] for i in range(n) if (i, n) in best and (i > 0 or allow_single)]
+    if len(plans) == 0:
+        return None
+    return min(plans, key=lambda c: c[:2])[2]
+
+
+def plan_slices(
+    model: torch.nn.Module, samples: typing.List[typing.Optional[torch.Tensor]], budget: int,
+    logits_chunk_tokens: int = 0, stream_slices: bool = False, state_store: str = 'device', batch_tokens: int = 0,
+    schedule: str = 'slice'
+) -> typing.Optional[typing.List[int]]:
+    """
+    Plan start layers of slices of model for evaluating samples (one at a
+    time) within budget bytes of device memory, using measured parameter
+    sizes and activation estimates for the actual sample lengths. A single
+    slice ([0]) means the whole model fits, also when evaluating batches of
+    batch_tokens tokens at once, as unsliced evaluation does. Returns None
+    if no plan fits.
+
+    With the 'slice' schedule, the hidden states of all samples are kept
+    between slices (unless offloaded by the state store). Otherwise, states
+    are assumed to fit in the memory left, see get_state_budget().
+    """
+    lengths = [sample.shape[-1] for sample in samples if sample is not None]
+    max_len = max(lengths, default=1)
+    dtype_bytes = model.dtype.itemsize
+    param_bytes = get_param_bytes(model)
+    activations = estimate_activation_bytes(model.config, max_len, dtype_bytes, logits_chunk_tokens)
+    allow_single = True
+    if batch_tokens > max_len:
+        batched = estimate_activation_bytes(model.config, batch_tokens, dtype_bytes, logits_chunk_tokens)
+        model_bytes = param_bytes['embed'] + sum(param_bytes['layers']) + param_bytes['tail'] + param_bytes['shared']
+        allow_single = model_bytes + batched['layer'] + batched['logits'] <= budget
+    state_bytes = max_len*model.config.hidden_size*dtype_bytes
+    if state_store == 'device' and schedule == 'slice':
+        # Hidden states of all samples are kept between slices
+        stored_bytes = sum(lengths)*model.config.hidden_size*dtype_bytes
+    else:
+        # Only the current and the prefetched state are on the device
+        stored_bytes = 2*state_bytes
+    return plan_start_layers(
+            param_bytes,
+            budget,
+            layer_overhead=activations['layer'] + stored_bytes + state_bytes,
+            last_overhead=activations['logits'],
+            stream_slices=stream_slices,
+            allow_single=allow_single,
+    )
+
+
+def get_slice_bytes(param_bytes: dict, start_layers: typing.List[int], last_overhead: int = 0) -> typing.List[int]:
+    """
+    Return the parameter bytes of each slice of a model with param_bytes (see
+    get_param_bytes()) sliced at start_layers, plus last_overhead for the last slice.
+    """
+    n = len(param_bytes['layers'])
+    bounds = list(start_layers) + [n]
+    slice_bytes = []
+    for i, j in zip(bounds[:-1], bounds[1:]):
+        nbytes = sum(param_bytes['layers'][i:j]) + param_bytes['shared']
+        if i == 0:
+            nbytes += param_bytes['embed']
+        if j == n:
+            nbytes += param_bytes['tail'] + last_overhead
+        slice_bytes.append(nbytes)
+    return slice_bytes
+
+
+def get_state_budget(
+    model: torch.nn.Module, samples: typing.List[typing.Optional[torch.Tensor]], start_layers: typing.List[int], budget: int,
+    logits_chunk_tokens: int = 0, stream_slices: bool = False
+) -> int:
+    """
+    Return the bytes of device memory left for hidden states kept between
+    slices, when evaluating samples on model sliced at start_layers within
+    budget bytes: the budget minus the largest slice (or pair of consecutive
+    slices, if stream_slices), including activations.
+    """
+    lengths = [sample.shape[-1] for sample in samples if sample is not None]
+    max_len = max(lengths, default=1)
+    dtype_bytes = model.dtype.itemsize
+    param_bytes = get_param_bytes(model)
+    activations = estimate_activation_bytes(model.config, max_len, dtype_bytes, logits_chunk_tokens)
+    slice_bytes = get_slice_bytes(param_bytes, start_layers, last_overhead=activations['logits'])
+    peak = max(slice_bytes)
+    if stream_slices:
+        peak = max([peak] + [a + b for a, b in zip(slice_bytes[:-1], slice_bytes[1:])])
+    # The current state, and its successor, are also on the device
+    peak += activations['layer'] + 2*max_len*model.config.hidden_size*dtype_bytes
+    return max(budget - peak, 0)
+
+
+def plan_resident_slices(
+    model: torch.nn.Module, samples: typing.List[typing.Optional[torch.Tensor]], start_layers: typing.List[int], state_budget: int
+) -> typing.Tuple[int, int]:
+    """
+    Choose the number of slices that stay on the device between sample groups
+    in the 'group' schedule, from the state_budget bytes left after the slice
+    plan (see get_state_budget()). Pinned slices take from the memory for
+    hidden states, so groups get smaller and the other slices are loaded for
+    more groups. Returns resident_slices for SlicedModelWrapper and the state
+    budget left, for the choice that moves the fewest bytes to the device
+    while every sample's states still fit.
+    """
+    param_bytes = get_param_bytes(model)
+    slice_bytes = get_slice_bytes(param_bytes, start_layers)
+    state_bytes = {
+            i: sample.shape[-1]*model.config.hidden_size*model.dtype.itemsize
+            for i, sample in enumerate(samples) if sample is not None
+    }
+    max_state_bytes = max(state_bytes.values(), default=0)
+    n = len(slice_bytes)
+    best = (1, state_budget)
+    best_cost = None
+    # resident_slices pins all slices but the one being evaluated, or all of them
+    for resident_slices in list(range(1, n)) + [n]:
+        n_pinned = get_pinned_slices(n, resident_slices)
+        pinned_bytes = sum(slice_bytes[:n_pinned])
+        budget_left = state_budget - pinned_bytes
+        if budget_left < max_state_bytes:
+            break
+        n_groups = len(gen_state_groups(state_bytes, budget_left))
+        cost = pinned_bytes + n_groups*sum(slice_bytes[n_pinned:])
+        if best_cost is None or cost < best_cost:
+            best = (resident_slices, budget_left)
+            best_cost = cost
+    return best
+
+
+def get_device_budget(device, fraction: float) -> typing.Optional[int]:
+    """Return fraction of the free memory of CUDA device in bytes, None for other devices."""
+    if not is_cuda_device(device):
+        return None
+    free, total = torch.cuda.mem_get_info(device)
+    return int(fraction*free)
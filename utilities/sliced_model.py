@@ -0,0 +1,460 @@
+import copy
+import warnings
+
+import numpy as np
+import torch
+from transformers.utils import logging
+
+from utilities.lazy_weights import get_weight_map, is_lazy_model, load_weights, move_buffers, unload_weights
+from utilities.losses import chunked_cross_entropy, is_oom_error
+from utilities.slice_loader import SliceLoader, get_tensors, is_cuda_device, set_tensors
+from utilities.state_store import make_state_store
+
+logger = logging.get_logger(__name__)
+
+SCHEDULES = ['slice', 'group', 'auto']
+
+
+def get_pinned_slices(n_slices, resident_slices):
+    """
+    Number of the first slices that stay on the device between sample groups,
+    when resident_slices slices may be on the device: all, or all but the one
+    loaded for evaluation.
+    """
+    return n_slices if resident_slices >= n_slices else max(resident_slices-1, 0)
+
+
+def gen_state_groups(state_bytes, budget):
+    """
+    Group sample indices, in order, such that the hidden states of each group
+    (state_bytes: sample index -> bytes) fit in budget bytes; a sample larger
+    than budget is a group of its own. A budget of None means a single group.
+    """
+    groups = []
+    group_bytes = 0
+    for i,nbytes in state_bytes.items():
+        if len(groups) == 0 or (budget is not None and group_bytes + nbytes > budget):
+            groups.append([])
+            group_bytes = 0
+        groups[-1].append(i)
+        group_bytes += nbytes
+    return groups
+
+
+class SliceAdapter:
+    """
+    Describes how a model family is cut into slices, by module names:
+    embedding modules (first slice only), the decoder layer list, final norm
+    and head modules (last slice only). Parameters of any other module (e.g.
+    rotary embeddings) are needed by all slices.
+
+    The model's decoder must honour config.start_at_layer (input is then
+    inputs_embeds, holding the hidden states at that layer) and
+    config.return_states_at_layer (last_hidden_state then holds the hidden
+    states at that layer, before the final norm).
+    """
+    def __init__(self, embed=('model.embed_tokens',), layers='model.layers', final_norm=('model.norm',), head='lm_head', decoder='model'):
+        self.embed = tuple(embed)
+        self.layers = layers
+        self.final_norm = tuple(final_norm)
+        self.head = head
+        self.decoder = decoder
+
+    @staticmethod
+    def _in_module(pname, module_names):
+        return any(pname == name or pname.startswith(name + '.') for name in module_names)
+
+    def classify(self, pname):
+        """
+        Return ('embed', None), ('layer', index), ('tail', None) or ('shared', None),
+        for parameter pname.
+        """
+        if self._in_module(pname, self.embed):
+            return 'embed', None
+        if self._in_module(pname, self.final_norm + (self.head,)):
+            return 'tail', None
+        prefix = self.layers + '.'
+        if pname.startswith(prefix):
+            return 'layer', int(pname[len(prefix):].split('.')[0])
+        return 'shared', None
+
+    def get_decoder(self, model_slice):
+        return model_slice.get_submodule(self.decoder)
+
+    def get_head(self, model_slice):
+        return model_slice.get_submodule(self.head)
+
+
+def get_slice_adapter(model):
+    """Return the SliceAdapter of model, None if it can't be evaluated sliced."""
+    return getattr(model, 'slice_adapter', None)
+
+
+class SlicedModelWrapper:
+    """
+    Evaluates a model in slices of consecutive decoder layers, with only one
+    (or, when streaming, two) slices on the device at any time. Architecture
+    specifics are described by the model's SliceAdapter.
+    """
+    def __init__(self, model=None, n_slices=2, start_layers=None, device=None, logits_chunk_tokens=0, stream_slices=False, state_store='device', state_store_path=None,
+            schedule='slice', state_budget=None, resident_slices=1):
+        self.model = model
+        self.adapter = get_slice_adapter(model)
+        self.device = device
+        # If non-zero, evaluate lm_head and loss in chunks of this many positions
+        self.logits_chunk_tokens = logits_chunk_tokens
+        # Load the next slice to the (CUDA) device while evaluating the current one
+        self.stream_slices = stream_slices
+        # Where to keep hidden states between slices: 'device', 'host' or 'disk' (in state_store_path)
+        self.state_store = state_store
+        self.state_store_path = state_store_path
+        # Order of evaluation: 'slice' (all samples through each slice in turn), 'group' (groups of
+        # samples through all slices) or 'auto' (the one moving fewer bytes, see choose_schedule())
+        if schedule not in SCHEDULES:
+            raise ValueError(f"Unknown schedule {schedule}, expected one of {SCHEDULES}")
+        self.schedule = schedule
+        # Bytes of device memory for hidden states, which bounds the size of sample groups
+        self.state_budget = state_budget
+        # Number of slices on the device between sample groups (see get_pinned_slices()); the
+        # memory of the pinned slices is not part of state_budget
+        self.resident_slices = resident_slices
+        # Models created by lazy_load_model() have their weights loaded per slice, when evaluated
+        self.lazy = is_lazy_model(model)
+        # id(model_slice) -> host tensors of loaded slices of non-lazy models
+        self.host_tensors = {}
+        if start_layers is None:
+            start_layers = self.gen_start_layers(model.config.num_hidden_layers,n_slices)
+        start_layers.append(model.config.num_hidden_layers)
+        self.start_layers = start_layers
+        self.gen_slices()
+
+    def __repr__(self):
+        return f'SlicedModelWrapper(n_slices={len(self.slices)},device={self.device},start_layers={self.start_layers[:-1]},model={self.model})'
+
+    def __call__(self,*args,**kwargs):
+        raise Exception("cannot call SlicedModelWrapper(), use .evaluate_samples() to batch evaluate samples instead")
+
+    def to(self,*args,**kwargs):
+        warnings.warn('No need to .to() on SlicedModelWrapper; set the .device property instead')
+
+    def evaluate_samples(self,samples,reduction='mean',oom_failed=None):
+        """
+        Evaluate losses of samples on sliced model. Indices of samples that
+        failed because of running out of memory are appended to oom_failed,
+        if specified.
+        """
+        schedule, groups = self.choose_schedule(samples)
+        if schedule == 'group':
+            return self.evaluate_samples_grouped(samples,groups,reduction=reduction,oom_failed=oom_failed)
+        if self.stream_slices and is_cuda_device(self.device):
+            return self.evaluate_samples_streamed(samples,reduction=reduction,oom_failed=oom_failed)
+        output_states = make_state_store(self.state_store,self.device,self.state_store_path)
+        try:
+            for slice_idx,model_slice in enumerate(self.slices):
+                model_slice = self.load_slice(model_slice)
+                model_params = model_slice.num_parameters()
+                state_size = output_states.describe()
+                logger.info(f'evaluating slice {slice_idx}, n_params={model_params}, state_size={state_size}...')
+                try:
+                    losses = self.evaluate_losses_slice(model_slice,samples=samples,output_states=output_states,reduction=reduction,oom_failed=oom_failed)
+                finally:
+                    model_slice = self.unload_slice(model_slice)
+                torch.cuda.empty_cache()
+        finally:
+            output_states.close()
+        return losses
+
+    def load_slice(self,model_slice):
+        """
+        Put model_slice on the device; for lazy models, load its weights from disk.
+        """
+        if not self.lazy:
+            tensors = get_tensors(model_slice)
+            set_tensors(tensors,self.device)
+            self.host_tensors[id(model_slice)] = tensors
+            return model_slice
+        load_weights(model_slice,self.model.lazy_weights_path,model_slice.lazy_param_names,self.device,weight_map=self.weight_map)
+        move_buffers(model_slice,self.device)
+        return model_slice
+
+    def unload_slice(self,model_slice):
+        """
+        Release the device memory used by model_slice. Like SliceLoader, this
+        puts back the host tensors instead of copying the weights back.
+        """
+        if not self.lazy:
+            tensors = self.host_tensors.pop(id(model_slice),None)
+            if tensors is not None:
+                set_tensors(tensors)
+            return model_slice
+        unload_weights(model_slice,model_slice.lazy_param_names)
+        return model_slice
+
+    def evaluate_samples_streamed(self,samples,reduction='mean',oom_failed=None):
+        """
+        Evaluate losses of samples on sliced model, copying slice k+1 to the device
+        while slice k is evaluated. Two slices are on the device at the same time.
+        """
+        output_states = make_state_store(self.state_store,self.device,self.state_store_path)
+        loader = SliceLoader(self.device) if not self.lazy else SliceLoader(self.device,load_fn=self.load_slice,unload_fn=self.unload_slice)
+        try:
+            loader.load(self.slices[0])
+            for slice_idx,model_slice in enumerate(self.slices):
+                loader.wait(model_slice)
+                if slice_idx+1 < len(self.slices):
+                    loader.load(self.slices[slice_idx+1])
+                model_params = model_slice.num_parameters()
+                state_size = output_states.describe()
+                logger.info(f'evaluating slice {slice_idx} (streamed), n_params={model_params}, state_size={state_size}...')
+                losses = self.evaluate_losses_slice(model_slice,samples=samples,output_states=output_states,reduction=reduction,oom_failed=oom_failed)
+                loader.unload(model_slice)
+        finally:
+            loader.close()
+            output_states.close()
+            torch.cuda.empty_cache()
+        return losses
+
+    def evaluate_samples_grouped(self,samples,groups,reduction='mean',oom_failed=None):
+        """
+        Evaluate losses of samples on sliced model, taking each group of samples
+        through all slices before starting the next group. Only the hidden states
+        of one group are held at a time; when groups are sized to state_budget,
+        they stay on the device. The first get_pinned_slices() slices stay on
+        the device, the others are loaded again for every group.
+        """
+        n_slices = len(self.slices)
+        pinned = set(range(get_pinned_slices(n_slices,self.resident_slices)))
+        state_store = self.state_store if self.state_budget is None else 'device'
+        losses = [np.inf]*len(samples)
+        loaded = set()
+        try:
+            for group_idx,group in enumerate(groups):
+                group_samples = [samples[i] for i in group]
+                group_oom = []
+                output_states = make_state_store(state_store,self.device,self.state_store_path)
+                try:
+                    for slice_idx,model_slice in enumerate(self.slices):
+                        if slice_idx not in loaded:
+                            self.load_slice(model_slice)
+                            loaded.add(slice_idx)
+                        logger.info(f'evaluating group {group_idx} ({len(group)} samples) on slice {slice_idx}, state_size={output_states.describe()}...')
+                        try:
+                            group_losses = self.evaluate_losses_slice(model_slice,samples=group_samples,output_states=output_states,reduction=reduction,oom_failed=group_oom)
+                        finally:
+                            if slice_idx not in pinned:
+                                self.unload_slice(model_slice)
+                                loaded.discard(slice_idx)
+                finally:
+                    output_states.close()
+                for i,loss in zip(group,group_losses):
+                    losses[i] = loss
+                if oom_failed is not None:
+                    oom_failed.extend(group[j] for j in group_oom)
+        finally:
+            for slice_idx in loaded:
+                self.unload_slice(self.slices[slice_idx])
+            torch.cuda.empty_cache()
+        return losses
+
+    def slice_nbytes(self,model_slice):
+        """
+        Bytes of the parameters of model_slice, as transferred to the device.
+        """
+        if self.lazy:
+            params = [model_slice.get_parameter(name) for name in model_slice.lazy_param_names]
+        else:
+            params = list(model_slice.parameters())
+        return sum(p.numel()*p.element_size() for p in params)
+
+    def state_nbytes(self,sample):
+        """
+        Bytes of the hidden states of sample between slices.
+        """
+        return sample.shape[-1]*self.model.config.hidden_size*self.model.dtype.itemsize
+
+    def choose_schedule(self,samples):
+        """
+        Return the schedule to use for samples, 'slice' or 'group', and for
+        'group' the list of sample index groups, each within state_budget.
+
+        With 'auto', the schedule moving fewer bytes between host and device
+        is chosen, from the measured slice and state sizes: slice-major loads
+        every slice once, but needs the states of all samples (and with an
+        offloading state store, moves them out and back in between all
+        slices); group-major keeps one group of states on the device, but
+        reloads the non-pinned slices for every group. Slices are released
+        without copying them back, so only loads count.
+        """
+        if self.schedule == 'slice' or (self.schedule == 'auto' and self.state_budget is None):
+            return 'slice', None
+        state_bytes = {i: self.state_nbytes(sample) for i,sample in enumerate(samples) if sample is not None}
+        groups = gen_state_groups(state_bytes,self.state_budget)
+        if self.schedule == 'group':
+            return 'group', groups
+
+        slice_bytes = [self.slice_nbytes(model_slice) for model_slice in self.slices]
+        total_state_bytes = sum(state_bytes.values())
+        if self.state_store == 'device':
+            slice_cost = sum(slice_bytes) if total_state_bytes <= self.state_budget else np.inf
+        else:
+            slice_cost = sum(slice_bytes) + 2*(len(self.slices)-1)*total_state_bytes
+        n_pinned = get_pinned_slices(len(self.slices),self.resident_slices)
+        group_cost = sum(slice_bytes[:n_pinned]) + len(groups)*sum(slice_bytes[n_pinned:])
+        logger.info(f'schedule costs: slice-major {slice_cost} bytes, group-major {group_cost} bytes ({len(groups)} groups)')
+        if group_cost < slice_cost:
+            return 'group', groups
+        return 'slice', None
+
+    def evaluate_losses_slice(self,model_slice,samples=None,output_states=[],reduction='mean',oom_failed=None):
+        is_first_slice = model_slice.config.start_at_layer == 0
+        is_last_slice = model_slice.config.return_states_at_layer == model_slice.config.num_hidden_layers
+        decoder = self.adapter.get_decoder(model_slice)
+        if len(output_states)==0:
+            output_states.extend([None]*len(samples))
+        losses = None
+        if is_last_slice:
+            losses = [np.inf]*len(samples)
+
+        for i,sample in enumerate(samples):
+            if sample is None:
+                continue
+            ids = None
+            if is_first_slice or is_last_slice:
+                ids = sample.to(self.device)
+            sample_state = None
+            try:
+                if is_first_slice:
+                    # inject token ids
+                    logger.debug(f'evaluating sample {i} of length {len(ids[0])}/{len(sample[0])} in first slice...')
+                    outputs = decoder(input_ids=ids)
+                    sample_state = outputs.last_hidden_state
+                else:
+                    # resume with hidden states
+                    logger.debug(f'evaluating sample {i} in later slice...')
+                    outputs = decoder(inputs_embeds=output_states[i])
+                    sample_state = outputs.last_hidden_state
+            except Exception as e:
+                logger.warning(f'Exception evaluating sample {i}, length {len(sample[0])}: {e}')
+                if oom_failed is not None and is_oom_error(e):
+                    oom_failed.append(i)
+
+            if not is_last_slice:
+                output_states[i] = sample_state
+                continue
+            # States are not needed after the last slice
+            output_states[i] = None
+            if sample_state is None:
+                continue
+
+            # calculate losses
+            head = self.adapter.get_head(model_slice)
+            if self.logits_chunk_tokens:
+                # Never hold more than logits_chunk_tokens x vocab_size logits
+                loss = chunked_cross_entropy(
+                    sample_state[0][:-1],
+                    head,
+                    ids[0, 1:],
+                    self.logits_chunk_tokens,
+                    reduction=reduction
+                )
+            else:
+                logits = head(sample_state[0])
+                logits = logits.float()
+                labels = ids
+                shift_logits = logits[..., :-1, :].contiguous()
+                shift_labels = labels[..., 1:].contiguous()
+                # Flatten the tokens
+                loss_fct = torch.nn.CrossEntropyLoss(reduction=reduction)
+                shift_logits = shift_logits.view(-1, model_slice.config.vocab_size)
+                shift_labels = shift_labels.view(-1)
+                loss = loss_fct(shift_logits, shift_labels)
+                del logits, shift_logits
+            loss_value = loss.detach().item()
+            logger.debug(f'loss: {loss_value}')
+            losses[i] = loss_value
+
+        return losses
+
+    def gen_slices(self):
+        if self.lazy:
+            return self.gen_lazy_slices()
+        model_data = {}
+        # strip model, restore later
+        for pname, p in self.model.named_parameters():
+            model_data[pname] = p.data
+            p.data = torch.zeros(0)
+
+        self.slices = []
+        for i,layer_from in enumerate(self.start_layers[:-1]):
+            layer_to = self.start_layers[i+1]
+            logger.info(f'Generating slice #{i}: {layer_from}..{layer_to}')
+            params = self.filter_params(layer_from=layer_from,layer_to=layer_to)
+            model_slice = copy.deepcopy(self.model) # copy of empty model
+            for pname,p in model_slice.named_parameters():
+                if pname in params['param_names_kept']:
+                    p.data = model_data[pname]
+            model_slice.config.start_at_layer = layer_from
+            model_slice.config.return_states_at_layer = layer_to
+            self.slices.append(model_slice)
+
+    def gen_lazy_slices(self):
+        """
+        Generate slices of a model with all parameters on the meta device. The
+        weights of a slice are only loaded (straight to the device) when it is
+        evaluated, so the full model is never in CPU RAM.
+        """
+        self.weight_map = get_weight_map(self.model.lazy_weights_path)
+        self.slices = []
+        for i,layer_from in enumerate(self.start_layers[:-1]):
+            layer_to = self.start_layers[i+1]
+            logger.info(f'Generating lazy slice #{i}: {layer_from}..{layer_to}')
+            # Include tied parameters under each of their names, slices may need either
+            params = self.filter_params(layer_from=layer_from,layer_to=layer_to,remove_duplicate=False)
+            model_slice = copy.deepcopy(self.model) # copy of empty model
+            model_slice.lazy_param_names = sorted(params['param_names_kept'])
+            model_slice.config.start_at_layer = layer_from
+            model_slice.config.return_states_at_layer = layer_to
+            self.slices.append(model_slice)
+
+    @staticmethod
+    def gen_start_layers(n_layers,n_slices):
+        """
+        Generate a list of starting indices for each slice, equally distributing layers over n slices.
+        """
+        n_slices = min(n_slices,n_layers)
+        start_layers = [0]
+        while len(start_layers)<n_slices:
+            last_start = start_layers[-1]
+            remaining_slices = n_slices-len(start_layers)
+            remaining_layers = n_layers-last_start
+            next_start = last_start + remaining_layers//(remaining_slices+1)
+            start_layers.append(next_start)
+        return start_layers
+
+    def filter_params(self,layer_from=None,layer_to=None,remove_duplicate=True):
+        """
+        Filter parameters to use for a particular range of layers.
+        Embeddings are considered part of the first layer.
+        The head and final norm are considered part of the last layer.
+        Other parameters outside the decoder layers are needed for all layers.
+        """
+        params = []
+        param_names_kept = set()
+        param_idx_to_name = {}
+        n_layers = self.model.config.num_hidden_layers
+        for pname, p in self.model.named_parameters(remove_duplicate=remove_duplicate):
+            part, layer_idx = self.adapter.classify(pname)
+            if part == 'embed':
+                if layer_from > 0: continue
+            elif part == 'tail':
+                if layer_to < n_layers: continue
+            elif part == 'layer':
+                if not layer_from <= layer_idx < layer_to: continue
+            param_idx_to_name[len(params)] = pname
+            param_names_kept.add(pname)
+            params.append(p)
+        return {
+                'param_idx_to_name':param_idx_to_name,
+                'param_names_kept':param_names_kept,
+                'params':params,
+        }
@@ -0,0 +1,202 @@
+import mmap
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from utilities.slice_loader import is_cuda_device
+
+STATE_STORE_TYPES = ['device', 'host', 'disk']
+
+
+class StateStore:
+    """
+    List-like store of the hidden states of samples between slices of a sliced
+    model. This one keeps all states on the evaluation device.
+    """
+    location = 'device'
+
+    def __init__(self, device=None):
+        self.device = device
+        self.states = []
+        # (shape, dtype) of stored states, None if empty
+        self.meta = []
+
+    def __len__(self):
+        return len(self.states)
+
+    def extend(self, states):
+        for state in states:
+            self.states.append(None)
+            self.meta.append(None)
+            self[len(self.states)-1] = state
+
+    def __getitem__(self, i):
+        return self.states[i]
+
+    def __setitem__(self, i, state):
+        self.meta[i] = None if state is None else (tuple(state.shape), state.dtype)
+        self.states[i] = state
+
+    def numel(self) -> int:
+        return sum(int(torch.Size(meta[0]).numel()) for meta in self.meta if meta is not None)
+
+    def nbytes(self) -> int:
+        return sum(int(torch.Size(shape).numel())*dtype.itemsize for shape, dtype in filter(None, self.meta))
+
+    def describe(self) -> str:
+        return f'{self.numel()} ({self.nbytes()/1e6:.1f} MB on {self.location})'
+
+    def close(self):
+        self.states = []
+        self.meta = []
+
+
+class OffloadStateStore(StateStore):
+    """
+    Base class for stores that keep states off the evaluation device. When a
+    state is read, the next state in consumption order is fetched in the
+    background, so that it is on the device by the time it is needed.
+    """
+    def __init__(self, device=None):
+        super().__init__(device)
+        self.cuda = is_cuda_device(device)
+        self.stream = torch.cuda.Stream(device) if self.cuda else None
+        # Single worker, so that writes and reads are executed in order
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.prefetched = {}
+        # Order in which samples are read; ascending if None
+        self.order = None
+
+    def _offload(self, i, state):
+        raise NotImplementedError
+
+    def _fetch_host(self, stored, shape, dtype) -> torch.Tensor:
+        raise NotImplementedError
+
+    def _fetch(self, stored, shape, dtype) -> torch.Tensor:
+        host = self._fetch_host(stored, shape, dtype)
+        if not self.cuda:
+            return host.to(self.device, copy=True)
+        with torch.cuda.stream(self.stream):
+            state = host.to(self.device, non_blocking=True)
+        self.stream.synchronize()
+        return state
+
+    def set_order(self, order):
+        """Set the order in which samples will be read, for prefetching."""
+        self.order = list(order)
+
+    def next_index(self, i):
+        if self.order is None:
+            candidates = range(i+1, len(self.states))
+        else:
+            pos = self.order.index(i) if i in self.order else len(self.order)
+            candidates = self.order[pos+1:]
+        for j in candidates:
+            if self.states[j] is not None:
+                return j
+        return None
+
+    def prefetch(self, i):
+        """Start fetching state i to the device."""
+        if i is None or i in self.prefetched or self.states[i] is None:
+            return
+        self.prefetched[i] = self.executor.submit(self._fetch, self.states[i], *self.meta[i])
+
+    def __getitem__(self, i):
+        if self.states[i] is None:
+            return None
+        self.prefetch(i)
+        state = self.prefetched.pop(i).result()
+        self.prefetch(self.next_index(i))
+        if self.cuda:
+            state.record_stream(torch.cuda.current_stream(self.device))
+        return state
+
+    def __setitem__(self, i, state):
+        # A prefetched copy of the old state is stale
+        self.prefetched.pop(i, None)
+        if state is None:
+            self.meta[i] = None
+            self.states[i] = None
+            return
+        self.meta[i] = (tuple(state.shape), state.dtype)
+        self.states[i] = self._offload(i, state)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.prefetched = {}
+        super().close()
+
+
+class HostStateStore(OffloadStateStore):
+    """Keeps states in (pinned, if on CUDA) CPU memory."""
+    location = 'host'
+
+    def _offload(self, i, state):
+        host = torch.empty(state.shape, dtype=state.dtype, pin_memory=self.cuda)
+        host.copy_(state, non_blocking=self.cuda)
+        event = None
+        if self.cuda:
+            event = torch.cuda.Event()
+            event.record()
+        return (host, event)
+
+    def _fetch_host(self, stored, shape, dtype):
+        host, event = stored
+        if event is not None:
+            event.synchronize()
+        return host
+
+
+class DiskStateStore(OffloadStateStore):
+    """Keeps states in a temporary file (in directory path), read back through a memory map."""
+    location = 'disk'
+
+    def __init__(self, device=None, path=None):
+        super().__init__(device)
+        self.file = tempfile.TemporaryFile(dir=path)
+        self.file_size = 0
+        # Sample index -> (offset, capacity) in file
+        self.slots = {}
+        self.mmap = None
+
+    def _write(self, offset, host):
+        os.pwrite(self.file.fileno(), host.reshape(-1).view(torch.uint8).numpy(), offset)
+
+    def _offload(self, i, state):
+        host = state.detach().to('cpu').contiguous()
+        nbytes = host.numel()*host.element_size()
+        offset, capacity = self.slots.get(i, (0, 0))
+        if nbytes > capacity:
+            offset = self.file_size
+            self.file_size += nbytes
+            self.slots[i] = (offset, nbytes)
+        self.executor.submit(self._write, offset, host)
+        return (offset, nbytes)
+
+    def _fetch_host(self, stored, shape, dtype):
+        offset, nbytes = stored
+        if self.mmap is None or len(self.mmap) < offset + nbytes:
+            # Earlier maps are released when the tensors using them are freed
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY)
+        data = torch.frombuffer(self.mmap, dtype=torch.uint8, count=nbytes, offset=offset)
+        return data.view(dtype).view(shape)
+
+    def close(self):
+        super().close()
+        self.mmap = None
+        self.file.close()
+
+
+def make_state_store(store_type: str = 'device', device=None, path=None) -> StateStore:
+    """Create a state store: 'device', 'host' (pinned CPU memory) or 'disk' (temporary file in path)."""
+    if store_type == 'device':
+        return StateStore(device)
+    if store_type == 'host':
+        return HostStateStore(device)
+    if store_type == 'disk':
+        return DiskStateStore(device, path)
+    raise ValueError(f"Unknown state store type {store_type}, expected one of {STATE_STORE_TYPES}")
@@ -10,10 +10,8 @@ import bittensor as bt
 import constants
 
 # Needed to get proper logging between child and parent process
-from bittensor.btlogging.defines import BITTENSOR_LOGGER_NAME
 import logging as stdlogging
-from logging.handlers import QueueHandler,QueueListener
-import atexit
+from utilities.logs import BITTENSOR_LOGGER_NAME, forward_logging_to_queue, get_log_queue
 
 from model.data import ModelId, ModelMetadata
 
@@ -65,29 +63,11 @@ def get_hf_url(model_metadata: ModelMetadata) -> str:
     return f"https://huggingface.co/{model_metadata.id.namespace}/{model_metadata.id.name}/tree/{model_metadata.id.commit}"
 
 
-def _wrapped_func(func: functools.partial, log_queue: multiprocessing.Queue, queue: multiprocessing.Queue):
+def _wrapped_func(func: functools.partial, log_queue: Optional[Any], log_level: int, queue: multiprocessing.Queue):
     resource.setrlimit(resource.RLIMIT_NOFILE, (65000, 65000))
     try:
         if log_queue is not None:
-            # This feature is not (yet) available on bittensor
-            #bt.logging.set_queue(log_queue)
-            # Hack in a queue handler, avoid private variables where possible.
-            try:
-                logger = stdlogging.getLogger(BITTENSOR_LOGGER_NAME)
-                while len(logger.handlers):
-                    logger.removeHandler(logger.handlers[0])
-                try:
-                    # This is needed to prevent EOFError clutter on subprocess termination.
-                    atexit.unregister(bt.logging._listener.stop)
-                    bt.logging._listener.stop()
-                except Exception as e:
-                    print(f'Non-fatal: exception trying to stop btlogger listener: {e}')
-                queue_handler = QueueHandler(log_queue)
-                logger.addHandler(queue_handler)
-                queue_handler.setLevel(stdlogging.INFO)
-                logger.setLevel(stdlogging.INFO)
-            except Exception as e:
-                print(f'Non-fatal: exception trying to implement proper logging: {e}')
+            forward_logging_to_queue(log_queue, log_level)
         result = func()
         queue.put((result,))
     except (Exception, BaseException) as e:
@@ -110,36 +90,16 @@ def run_in_subprocess(func: functools.partial, ttl: int, mode="fork", expected_e
     """
     ctx = multiprocessing.get_context(mode)
     queue = ctx.Queue()
-    # When forking, the log queue survives, but when spawning a process, logging
-    # is re-initialized and the queue has to be set manually.
-    log_queue = None
-    listener = None
-    if mode == 'spawn':
-        # This can only work if bittensor would use mp.Manager().Queue() to
-        # create the right kind of queue.
-        #log_queue = bt.logging.get_queue()
-        # Roll our own, re-log to existing handlers, avoid bt.logging private variables.
-        try:
-            logger = stdlogging.getLogger(BITTENSOR_LOGGER_NAME)
-            log_queue = multiprocessing.Manager().Queue()
-            listener = QueueListener(log_queue, *logger.handlers, respect_handler_level=True)
-            listener.start()
-            atexit.register(listener.stop)
-        except Exception as e:
-            bt.logging.warning(f'Non-fatal: failed to implement proper logging for child process: {e}')
-    process = ctx.Process(target=_wrapped_func, args=[func, log_queue, queue])
+    # When forking, the log handlers survive, but when spawning a process, logging
+    # is re-initialized and has to be forwarded through the log queue.
+    log_queue = get_log_queue(mode)
+    log_level = stdlogging.getLogger(BITTENSOR_LOGGER_NAME).getEffectiveLevel()
+    process = ctx.Process(target=_wrapped_func, args=[func, log_queue, log_level, queue])
 
     process.start()
 
     process.join(timeout=ttl)
 
-    if listener is not None:
-        try:
-            listener.stop()
-            atexit.unregister(listener.stop)
-        except:
-            pass
-
     if process.is_alive():
         process.terminate()
         process.join()
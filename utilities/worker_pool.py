@@ -0,0 +1,357 @@
+import atexit
+import contextlib
+import functools
+import gc
+import importlib
+import multiprocessing
+import pickle
+import queue
+import resource
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.reduction import ForkingPickler
+from typing import Any, List, Optional
+
+# Workers don't import bittensor, see utilities/logs.py
+from utilities.logs import forward_logging_to_queue, get_log_queue, logger
+
+# Interval (seconds) for checking whether a worker is still alive while waiting for a result.
+POLL_INTERVAL = 1
+# Time (seconds) a worker gets to answer a health check, including start-up of a fresh worker.
+PING_TIMEOUT = 120
+
+
+class WorkerDied(Exception):
+    '''
+    Exception class to signal that a worker process exited while running a task.
+    '''
+    pass
+
+
+class TaskLost(Exception):
+    '''
+    Exception class to signal that a task was not completed because its worker
+    became unreachable, so that it can be run elsewhere.
+    '''
+    pass
+
+
+def _cleanup_after_task() -> bool:
+    """
+    Release memory held by the previous task. Returns False if the CUDA context
+    is broken (e.g. after an illegal memory access), which requires a new process.
+    """
+    gc.collect()
+    torch = sys.modules.get('torch', None)
+    if torch is None or not torch.cuda.is_initialized():
+        return True
+    try:
+        torch.cuda.synchronize()
+        torch.cuda.empty_cache()
+    except Exception as e:
+        print(f'CUDA context unusable after task: {e}', file=sys.stderr)
+        return False
+    return True
+
+
+def _worker_main(
+    task_queue: multiprocessing.Queue, result_queue: multiprocessing.Queue, log_queue: Optional[queue.Queue], log_level: int,
+    preload: List[str]
+):
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (65000, 65000))
+    except Exception as e:
+        print(f'Non-fatal: failed to raise open file limit: {e}', file=sys.stderr)
+    if log_queue is not None:
+        forward_logging_to_queue(log_queue, log_level)
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            logger.warning(f'Worker failed to preload {module}: {e}')
+
+    while True:
+        msg = task_queue.get()
+        if msg is None:
+            break
+        task_id, payload = msg
+        if payload is None:
+            # Health check
+            result_queue.put((task_id, None, True))
+            continue
+
+        healthy = True
+        try:
+            func = pickle.loads(payload)
+            result = (func(),)
+        except (Exception, BaseException) as e:
+            result = (e, traceback.format_exc())
+            if 'CUDA error' in str(e) or not isinstance(e, Exception):
+                healthy = False
+        func = None
+        healthy = _cleanup_after_task() and healthy
+        try:
+            data = bytes(ForkingPickler.dumps(result))
+        except Exception as e:
+            data = bytes(ForkingPickler.dumps((Exception(f'Failed to pickle task result: {e}'), traceback.format_exc())))
+        result = None
+        result_queue.put((task_id, data, healthy))
+        if not healthy:
+            break
+
+
+def unpack_result(data: bytes, expected_errors={}) -> Any:
+    """
+    Return the result of a task from the bytes a worker sent, or raise the
+    exception it raised. Exceptions with type names not in expected_errors are
+    logged with their stack trace in the worker.
+    """
+    result = pickle.loads(data)
+    if isinstance(result[0], BaseException):
+        e, stack_trace = result
+        if isinstance(e, Exception):
+            if type(e).__name__ not in expected_errors:
+                logger.error(f"Exception in worker:\n{stack_trace}")
+            raise e
+        logger.error(f"BaseException in worker:\n{stack_trace}")
+        raise Exception(f"BaseException raised in worker: {str(e)}")
+    return result[0]
+
+
+# Serializes use of _main_module(), so that concurrent worker starts can't restore each other's __main__
+_main_module_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _main_module(module_name: Optional[str]):
+    """
+    Make spawned processes started in this context import module_name as their
+    main module, instead of re-importing the parent's __main__ (e.g. a script
+    with many imports that the child doesn't need). Keep the context short
+    (just Process.start()): other threads see module_name as __main__ meanwhile.
+    """
+    if module_name is None:
+        yield
+        return
+    module = importlib.import_module(module_name)
+    with _main_module_lock:
+        saved = sys.modules['__main__']
+        sys.modules['__main__'] = module
+        try:
+            yield
+        finally:
+            sys.modules['__main__'] = saved
+
+
+class _Worker:
+    def __init__(self, ctx, preload: List[str], name: str, main_module: Optional[str] = None):
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.n_tasks = 0
+        self.next_task_id = 0
+        # When forking, the log handlers survive, but when spawning a process,
+        # logging is re-initialized and has to be forwarded to the parent,
+        # through the channel shared by all workers.
+        log_queue = get_log_queue(ctx.get_start_method())
+        log_level = logger.getEffectiveLevel()
+        self.process = ctx.Process(
+                target=_worker_main,
+                args=[self.task_queue, self.result_queue, log_queue, log_level, preload],
+                name=name,
+        )
+        with _main_module(main_module if ctx.get_start_method() != 'fork' else None):
+            self.process.start()
+
+    def submit(self, payload) -> int:
+        task_id = self.next_task_id
+        self.next_task_id += 1
+        self.task_queue.put((task_id, payload))
+        return task_id
+
+    def wait(self, task_id: int, ttl: float):
+        """
+        Wait at most ttl seconds for the result of task_id.
+        Returns (data, healthy); raises TimeoutError or WorkerDied.
+        """
+        deadline = time.monotonic() + ttl
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"No result after {ttl} seconds")
+            try:
+                msg_task_id, data, healthy = self.result_queue.get(timeout=min(remaining, POLL_INTERVAL))
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise WorkerDied(f"Worker {self.process.name} exited with code {self.process.exitcode}")
+                continue
+            if msg_task_id == task_id:
+                return data, healthy
+
+    def ping(self, timeout: float = PING_TIMEOUT) -> bool:
+        if not self.process.is_alive():
+            return False
+        try:
+            self.wait(self.submit(None), timeout)
+        except Exception as e:
+            logger.warning(f'Worker {self.process.name} failed health check: {e}')
+            return False
+        return True
+
+    def stop(self, timeout: float = 5):
+        if self.process.is_alive():
+            try:
+                self.task_queue.put(None)
+            except Exception:
+                pass
+            self.process.join(timeout=timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        for q in [self.task_queue, self.result_queue]:
+            q.cancel_join_thread()
+            q.close()
+
+
+class WorkerPool:
+    """
+    Pool of long-lived worker processes, to run tasks isolated from the main
+    process without paying process start-up (imports, CUDA context) per task.
+
+    Workers are health-checked before each task. A worker is killed and replaced
+    when a task exceeds its ttl, when it exits unexpectedly (e.g. killed by the OOM
+    killer), when its CUDA context is broken, or after max_tasks tasks.
+    """
+    def __init__(
+        self, n_workers: int = 1, mode: str = "spawn", preload: List[str] = [], max_tasks: int = 0, name: str = "worker",
+        main_module: Optional[str] = None
+    ):
+        """
+        Args:
+            n_workers (int): Number of worker processes.
+            mode: "fork", "spawn" or "forkserver"
+            preload (list): Modules to import on worker start-up.
+            max_tasks (int): Replace a worker after this many tasks, 0 for no limit.
+            name (str): Prefix for worker process names.
+            main_module (str): Module that spawned workers import as their main module,
+                instead of the main module of this process (None to keep the default).
+        """
+        self.ctx = multiprocessing.get_context(mode)
+        self.preload = preload
+        self.main_module = main_module
+        self.max_tasks = max_tasks
+        self.name = name
+        self.n_started = 0
+        self.lock = threading.Lock()
+        self.workers = []
+        self.idle = queue.Queue()
+        for _ in range(n_workers):
+            worker = self._start_worker()
+            self.workers.append(worker)
+            self.idle.put(worker)
+        atexit.register(self.shutdown)
+
+    def _start_worker(self) -> _Worker:
+        with self.lock:
+            name = f'{self.name}-{self.n_started}'
+            self.n_started += 1
+        logger.debug(f'Starting worker process {name}')
+        return _Worker(self.ctx, self.preload, name, self.main_module)
+
+    def _replace_worker(self, worker: _Worker) -> Optional[_Worker]:
+        """
+        Stop worker and start a new one in its place. If the new worker fails
+        to start, the stopped worker is dropped and None is returned; None in
+        the idle queue is an empty slot, filled by the next run().
+        """
+        worker.stop()
+        try:
+            new_worker = self._start_worker()
+        except Exception as e:
+            logger.error(f'Failed to start a worker to replace {worker.process.name}: {e}')
+            new_worker = None
+        with self.lock:
+            self.workers = [new_worker if w is worker else w for w in self.workers]
+            self.workers = [w for w in self.workers if w is not None]
+        return new_worker
+
+    def _fill_slot(self) -> _Worker:
+        """Start a worker in the slot of one that failed to be replaced."""
+        worker = self._start_worker()
+        with self.lock:
+            self.workers.append(worker)
+        return worker
+
+    def run(self, func: functools.partial, ttl: int, expected_errors={}) -> Any:
+        """Runs the provided function on a worker with 'ttl' seconds to complete.
+
+        Args:
+            func (functools.partial): Function to be run, must be picklable.
+            ttl (int): How long to try for in seconds.
+            expected_errors: exception type names that are expected and don't need to be logged here
+
+        Returns:
+            Any: The value returned by 'func'
+        """
+        func_name = func.func.__name__ if isinstance(func, functools.partial) else str(func)
+        payload = bytes(ForkingPickler.dumps(func))
+
+        worker = self.idle.get()
+        try:
+            if worker is None:
+                worker = self._fill_slot()
+            elif not worker.ping():
+                worker = self._replace_worker(worker)
+                if worker is None:
+                    raise WorkerDied(f"Failed to start a worker to {func_name}")
+            task_id = worker.submit(payload)
+            try:
+                data, healthy = worker.wait(task_id, ttl)
+            except TimeoutError:
+                worker = self._replace_worker(worker)
+                raise TimeoutError(f"Failed to {func_name} after {ttl} seconds") from None
+            except WorkerDied as e:
+                worker = self._replace_worker(worker)
+                raise Exception(f"Worker died while running {func_name}: {e}") from None
+
+            worker.n_tasks += 1
+            if not healthy:
+                logger.warning(f'Worker {worker.process.name} is unhealthy after {func_name}, replacing')
+                worker = self._replace_worker(worker)
+            elif self.max_tasks and worker.n_tasks >= self.max_tasks:
+                logger.debug(f'Worker {worker.process.name} ran {worker.n_tasks} tasks, replacing')
+                worker = self._replace_worker(worker)
+        finally:
+            self.idle.put(worker)
+
+        return unpack_result(data, expected_errors)
+
+    def check_health(self):
+        """Check idle workers, replace those that don't respond."""
+        for _ in range(self.idle.qsize()):
+            try:
+                worker = self.idle.get(block=False)
+            except queue.Empty:
+                break
+            try:
+                if worker is None:
+                    worker = self._fill_slot()
+                elif not worker.ping():
+                    worker = self._replace_worker(worker)
+            finally:
+                self.idle.put(worker)
+
+    def shutdown(self):
+        with self.lock:
+            workers = self.workers
+            self.workers = []
+        for worker in workers:
+            worker.stop()
+        try:
+            atexit.unregister(self.shutdown)
+        except Exception:
+            pass